@@ -27,6 +27,12 @@ def load_config_from_env():
         DB_KEEPALIVE_IDLE=int(os.getenv("DB_KEEPALIVE_IDLE", default=60)),
         DB_KEEPALIVE_INTERVAL=int(os.getenv("DB_KEEPALIVE_INTERVAL", default=15)),
         DB_KEEPALIVE_COUNT=int(os.getenv("DB_KEEPALIVE_COUNT", default=5)),
+        # Maximum seconds a stage's service loop waits to be notified of new work before running anyway
+        SERVICE_LOOP_MAX_WAIT=int(os.getenv("SERVICE_LOOP_MAX_WAIT", default=60)),
+        # Number of documents a stage process claims from the database at a time
+        DB_CLAIM_BATCH_SIZE=int(os.getenv("DB_CLAIM_BATCH_SIZE", default=1)),
+        # Seconds after which a claimed document that hasn't finished a stage can be claimed again
+        DB_CLAIM_LEASE_SECONDS=int(os.getenv("DB_CLAIM_LEASE_SECONDS", default=3 * 60 * 60)),
         # Azure Storage Account Connection String
         # This can be found in the Azure Portal > Storage Account > Access Keys
         STORAGE_CONNECTION_STR=os.getenv("AZURE_STORAGE_CONNECTION_STRING"),
@@ -47,8 +53,14 @@ def load_config_from_env():
             LIMIT_ENABLED=os.getenv("LIMIT_ENABLED", "no"),
             LIMIT_TO_REPORTING_ORGS=limit_to_reporting_orgs,
             LIMIT_TO_DATASETS=limit_to_datasets,
-            # Number of parallel processes to run the refresh loop with
-            PARALLEL_PROCESSES=10,
+            # Maximum number of datasets to download at once
+            DOWNLOAD_CONCURRENCY=int(os.getenv("REFRESHER_DOWNLOAD_CONCURRENCY", default=200)),
+            # Maximum number of datasets to download at once from any one host
+            MAX_DOWNLOADS_PER_HOST=int(os.getenv("REFRESHER_MAX_DOWNLOADS_PER_HOST", default=100)),
+            # Size in bytes of the blocks downloads are streamed into the source container in
+            DOWNLOAD_BLOCK_SIZE=int(os.getenv("REFRESHER_DOWNLOAD_BLOCK_SIZE", default=4 * 1024 * 1024)),
+            # Number of bytes from the start of a download used to detect its charset
+            CHARSET_SNIFF_BYTES=int(os.getenv("REFRESHER_CHARSET_SNIFF_BYTES", default=64 * 1024)),
             # How long to sleep in seconds between loops if ETags are available
             SERVICE_LOOP_SLEEP=os.getenv("REFRESH_STAGE_LOOP_SLEEP", 60),
             # How many refresh loops to run before re-trying files with download errors
@@ -75,6 +87,14 @@ def load_config_from_env():
         VALIDATION=dict(
             # Number of parallel processes to run the validation loop with
             PARALLEL_PROCESSES=1,
+            # Number of requests in flight to the validator APIs at first, per process. This is adapted to how the
+            # validator copes (halved on HTTP 429/5xx responses or timeouts), up to MAX_CONCURRENCY
+            CONCURRENCY=int(os.getenv("VALIDATION_CONCURRENCY") or 4),
+            MAX_CONCURRENCY=int(os.getenv("VALIDATION_MAX_CONCURRENCY") or 16),
+            # Whether to gzip the documents sent to the validator APIs ("yes"/"no"). The APIs must accept
+            # Content-Encoding: gzip request bodies
+            GZIP_REQUESTS=os.getenv("VALIDATION_GZIP_REQUESTS", "no"),
+            GZIP_LEVEL=int(os.getenv("VALIDATION_GZIP_LEVEL", default=6)),
             # Schema Validation API URL/key
             SCHEMA_VALIDATION_URL=os.getenv("SCHEMA_VALIDATION_API_URL"),
             SCHEMA_VALIDATION_KEY_NAME=os.getenv("SCHEMA_VALIDATION_KEY_NAME"),
@@ -99,6 +119,13 @@ def load_config_from_env():
         CLEAN=dict(
             # Number of parallel processes to run the clean loop with
             PARALLEL_PROCESSES=1,
+            # Number of valid documents to claim and copy to the clean container at once, and the number of copies
+            # to have in flight at once
+            COPY_BATCH_SIZE=int(os.getenv("CLEAN_COPY_BATCH_SIZE", default=500)),
+            COPY_CONCURRENCY=int(os.getenv("CLEAN_COPY_CONCURRENCY", default=50)),
+            # Seconds between checks on copies that haven't finished, and to wait for them to finish
+            COPY_POLL_INTERVAL=int(os.getenv("CLEAN_COPY_POLL_INTERVAL", default=2)),
+            COPY_TIMEOUT=int(os.getenv("CLEAN_COPY_TIMEOUT", default=600)),
             PROM_PORT=9093,
             PROM_METRIC_DEFS=[
                 ("valid_datasets_to_progress", "The number of valid datasets to progress to flatten stage"),
@@ -108,6 +135,8 @@ def load_config_from_env():
         FLATTEN=dict(
             # Number of parallel processes to run the flatten loop with
             PARALLEL_PROCESSES=1,
+            # Number of flattened activities to write to the database in one statement
+            ACTIVITY_BATCH_SIZE=int(os.getenv("FLATTEN_ACTIVITY_BATCH_SIZE") or 100),
             PROM_PORT=9094,
             PROM_METRIC_DEFS=[
                 ("datasets_to_flatten", "The number of datasets that need flattening"),
@@ -116,6 +145,10 @@ def load_config_from_env():
         LAKIFY=dict(
             # Number of parallel processes to run the lakify loop with
             PARALLEL_PROCESSES=3,
+            # Number of threads uploading activities to the lake in each process
+            UPLOAD_THREADS=int(os.getenv("LAKIFY_UPLOAD_THREADS") or 8),
+            # Maximum number of activity uploads queued or running in each process
+            MAX_PENDING_UPLOADS=int(os.getenv("LAKIFY_MAX_PENDING_UPLOADS") or 32),
             PROM_PORT=9095,
             PROM_METRIC_DEFS=[
                 ("datasets_to_lakify", "The number of datasets that need lakifying"),
@@ -130,10 +163,29 @@ def load_config_from_env():
             SOLR_PASSWORD=os.getenv("SOLR_PASSWORD"),
             # Elements to explode into their own collections with one solr document per element
             EXPLODE_ELEMENTS='["transaction", "budget"]',
+            # Whether to only send the solr documents whose activity data has changed since a document was last
+            # solrized, and delete those that have gone, rather than re-adding all of them ("yes"/"no"). The solr
+            # collections' schemas must support atomic updates, see the Solrize section of the README
+            INCREMENTAL=os.getenv("SOLR_INCREMENTAL", "no"),
             # Maximum number of solr documents to index in one request
             MAX_BATCH_LENGTH=500,
+            # Maximum size in bytes of the JSON solr documents to index in one request
+            MAX_BATCH_BYTES=int(os.getenv("SOLR_MAX_BATCH_BYTES") or 10 * 1024 * 1024),
+            # Maximum number of serialised solr documents to hold in memory waiting to be streamed to Solr
+            STREAM_QUEUE_LENGTH=int(os.getenv("SOLR_STREAM_QUEUE_LENGTH") or 100),
+            # Milliseconds within which Solr should commit indexed documents (a soft commit, unless the cores'
+            # solrconfig.xml says otherwise), or 0 to leave commits to the cores' autoCommit settings
+            COMMIT_WITHIN=int(os.getenv("SOLR_COMMIT_WITHIN") or 0),
+            # Maximum number of activity lake blobs to download ahead of indexing them
+            LAKE_PREFETCH_MAX_IN_FLIGHT=int(os.getenv("SOLR_LAKE_PREFETCH_MAX_IN_FLIGHT") or 8),
+            # Approximate maximum size in bytes of downloaded activity lake blobs waiting to be indexed
+            LAKE_PREFETCH_MAX_BYTES=int(os.getenv("SOLR_LAKE_PREFETCH_MAX_BYTES") or 64 * 1024 * 1024),
+            # Number of flattened activities to fetch from the database at a time
+            FLATTENED_ACTIVITY_FETCH_SIZE=int(os.getenv("SOLR_FLATTENED_ACTIVITY_FETCH_SIZE") or 100),
             # Timeout for pysolr package
             PYSOLR_TIMEOUT=600,
+            # Seconds between pings to check the Solr cores are up, which are also pinged after any Solr error
+            SOLR_PING_INTERVAL=int(os.getenv("SOLR_PING_INTERVAL", default=300)),
             # Time in seconds to sleep after receiving a 5XX error from Solr
             SOLR_500_SLEEP=os.getenv("SOLR_500_SLEEP"),
             PROM_PORT=9096,
@@ -1 +1 @@
-__version__ = {"number": "2.9.2", "migration": 27}
+__version__ = {"number": "2.9.2", "migration": 32}
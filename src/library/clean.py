@@ -1,8 +1,9 @@
 import time
 import traceback
-from io import BytesIO
-from multiprocessing import Process
-from typing import Any
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import islice
+from typing import Iterable
 
 import sentry_sdk
 from azure.core import exceptions as AzureExceptions
@@ -19,45 +20,24 @@ logger = getLogger("clean")
 
 
 def copy_valid_documents(documents):
-    """copy valid activities documents to clean container storage
+    """copy valid activities documents to clean container storage, COPY_BATCH_SIZE documents at a time
 
     Args:
-        documents (list): list of tuples that contain the hash and id of the documents to copy
+        documents (iterable): tuples that contain the hash and id of the documents to copy
     """
     try:
         conn = db.getDirectConnection()
+        blob_service_client = BlobServiceClient.from_connection_string(config["STORAGE_CONNECTION_STR"])
+        documents = iter(documents)
 
-        for document in documents:
-            hash = document[0]
-            id = document[1]
-
-            logger.info(f"Copying source xml to clean container for valid activity document id: {id} and hash: {hash}")
-            blob_name = f"{hash}.xml"
-
-            db.startClean(conn, id)
-
-            try:
-                blob_service_client = BlobServiceClient.from_connection_string(config["STORAGE_CONNECTION_STR"])
+        with ThreadPoolExecutor(max_workers=config["CLEAN"]["COPY_CONCURRENCY"]) as executor:
+            while True:
+                batch = list(islice(documents, config["CLEAN"]["COPY_BATCH_SIZE"]))
+                if len(batch) == 0:
+                    break
+                copy_batch(conn, blob_service_client, executor, batch)
 
-                source_blob_client = blob_service_client.get_blob_client(
-                    container=config["SOURCE_CONTAINER_NAME"], blob=blob_name
-                )
-
-                clean_blob = blob_service_client.get_blob_client(
-                    container=config["CLEAN_CONTAINER_NAME"], blob=blob_name
-                )
-                clean_blob.start_copy_from_url(source_blob_client.url)
-                clean_blob.set_blob_tags({"document_id": id})
-            except AzureExceptions.ResourceNotFoundError:
-                err_msg = (
-                    f"Blob not found for hash: {hash} and id: {id} updating as "
-                    "Not Downloaded for the refresher to pick up."
-                )
-                logger.warning(err_msg)
-                db.updateCleanError(conn, id, err_msg)
-                db.updateFileAsNotDownloaded(conn, id)
-
-            db.completeClean(conn, id)
+        conn.close()
     except Exception as e:
         sentry_sdk.capture_exception(e)
         logger.error("ERROR with copying valid documents to clean storage")
@@ -72,52 +52,205 @@ def copy_valid_documents(documents):
             pass
 
 
+def copy_batch(conn, blob_service_client, executor, batch):
+    """Copies a batch of documents from the source to the clean container, server side
+
+    The copies are started concurrently on executor, with the document_id tag set by the copy itself. Copies that
+    don't finish straight away are polled together every COPY_POLL_INTERVAL seconds, for up to COPY_TIMEOUT
+    seconds. The start and completion of the clean are each recorded for the whole batch in one statement.
+    """
+    doc_ids = [id for _, id in batch]
+    logger.info(f"Copying source xml to clean container for {len(batch)} valid activity documents")
+
+    db.startCleanBatch(conn, doc_ids)
+
+    copied, pending = start_copies(conn, blob_service_client, executor, batch)
+    copied += poll_copies(conn, executor, pending)
+
+    for id in pending:
+        logger.warning(f"Copy to clean container did not finish for id: {id}")
+        db.updateCleanError(conn, id, "Copy did not finish")
+
+    if len(copied) > 0:
+        db.completeCleanBatch(conn, copied)
+
+
+def start_copies(conn, blob_service_client, executor, batch):
+    """Starts the copies of a batch of documents concurrently on executor, recording any that can't be started
+
+    Returns:
+        tuple: the ids of the documents copied straight away, and the clean blob clients of the copies still
+        pending, by document id
+    """
+    start_futures = {id: executor.submit(start_copy, blob_service_client, hash, id) for hash, id in batch}
+
+    copied = []
+    pending = {}
+    for hash, id in batch:
+        try:
+            clean_blob, copy_status = start_futures[id].result()
+        except AzureExceptions.ResourceNotFoundError:
+            logger.warning(
+                f"Blob not found for hash: {hash} and id: {id} updating as "
+                "Not Downloaded for the refresher to pick up."
+            )
+            db.updateFileAsNotDownloaded(conn, id)
+            continue
+        except AzureExceptions.AzureError as e:
+            logger.warning(f"Could not copy blob for hash: {hash} and id: {id}: {e}")
+            db.updateCleanError(conn, id, "Could not copy")
+            continue
+        if copy_status == "success":
+            copied.append(id)
+        else:
+            pending[id] = clean_blob
+
+    return copied, pending
+
+
+def poll_copies(conn, executor, pending):
+    """Polls pending copies every COPY_POLL_INTERVAL seconds, for up to COPY_TIMEOUT seconds
+
+    Copies that finish are removed from pending, and any that failed are recorded. Copies still pending at the
+    end are left in pending.
+
+    Returns:
+        list: the ids of the documents that were copied successfully
+    """
+    copied = []
+    deadline = time.monotonic() + config["CLEAN"]["COPY_TIMEOUT"]
+    while len(pending) > 0 and time.monotonic() < deadline:
+        time.sleep(config["CLEAN"]["COPY_POLL_INTERVAL"])
+        status_futures = {id: executor.submit(get_copy_status, clean_blob) for id, clean_blob in pending.items()}
+        for id, future in status_futures.items():
+            copy_status = get_polled_copy_status(id, future)
+            if copy_status == "pending":
+                continue
+            del pending[id]
+            if copy_status == "success":
+                copied.append(id)
+            else:
+                logger.warning(f"Copy to clean container {copy_status} for id: {id}")
+                db.updateCleanError(conn, id, f"Copy {copy_status}")
+    return copied
+
+
+def get_polled_copy_status(id, future):
+    """Returns the copy status from a get_copy_status future, treating a failure to get it as still pending"""
+    try:
+        return future.result()
+    except AzureExceptions.AzureError as e:
+        logger.warning(f"Could not get copy status for id: {id}: {e}")
+        return "pending"
+
+
+def start_copy(blob_service_client, hash, id):
+    """Starts a server side copy of a document from the source to the clean container
+
+    The copy keeps the source blob's metadata, e.g. its cached charset.
+
+    Returns:
+        tuple: the destination blob client, and the copy status ("success" or "pending")
+    """
+    blob_name = f"{hash}.xml"
+    source_blob_client = blob_service_client.get_blob_client(container=config["SOURCE_CONTAINER_NAME"], blob=blob_name)
+    clean_blob = blob_service_client.get_blob_client(container=config["CLEAN_CONTAINER_NAME"], blob=blob_name)
+    copy = clean_blob.start_copy_from_url(source_blob_client.url, tags={"document_id": id})
+    return clean_blob, copy["copy_status"]
+
+
+def get_copy_status(blob_client):
+    return blob_client.get_blob_properties().copy.status
+
+
+def process_claimed_valid_documents(run_started):
+    """Claims and processes valid activities documents to copy until there are none left, see db.iterateClaimed"""
+    copy_valid_documents(
+        db.iterateClaimed(
+            db.claimValidActivitiesDocsToCopy,
+            config["CLEAN"]["COPY_BATCH_SIZE"],
+            config["DB_CLAIM_LEASE_SECONDS"],
+            run_started,
+        )
+    )
+
+
 def copy_valid():
-    """gets list of valid documents to copy and sets up up multiprocessing"""
+    """counts valid documents to copy and sets up up multiprocessing"""
     logger.info("Starting copy of valid activities documents to clean container...")
 
-    conn = db.getDirectConnection()
-
-    logger.info("Resetting those unfinished")
+    run_started = datetime.now()
 
-    db.resetUnfinishedCleans(conn)
+    conn = db.getDirectConnection()
 
-    documents = db.getValidActivitiesDocsToCopy(conn)
+    num_documents = db.getNumValidActivitiesDocsToCopy(conn, config["DB_CLAIM_LEASE_SECONDS"], run_started)
 
-    set_prom_metric("valid_datasets_to_progress", len(documents))
+    set_prom_metric("valid_datasets_to_progress", num_documents)
 
     if config["CLEAN"]["PARALLEL_PROCESSES"] == 1:
-        logger.info(f"Copying {len(documents)} valid IATI files in a single process.")
-        copy_valid_documents(documents)
+        logger.info(f"Copying {num_documents} valid IATI files in a single process.")
+        process_claimed_valid_documents(run_started)
     else:
-        chunked_doc_lists = list(utils.chunk_list(documents, config["CLEAN"]["PARALLEL_PROCESSES"]))
-
-        processes = []
-
         logger.info(
-            f"Copying {len(documents)} valid IATI files in a maximum of "
+            f"Copying {num_documents} valid IATI files in a maximum of "
             f"{config['CLEAN']['PARALLEL_PROCESSES']} parallel processes."
         )
 
-        for chunk in chunked_doc_lists:
-            if len(chunk) == 0:
-                continue
-            process = Process(target=copy_valid_documents, args=(chunk,))
-            process.start()
-            processes.append(process)
-
-        for process in processes:
-            process.join()
+        utils.run_in_processes(process_claimed_valid_documents, (run_started,), config["CLEAN"]["PARALLEL_PROCESSES"])
 
     conn.close()
     logger.info("copy_valid Finished.")
 
 
-def clean_invalid_documents(documents: list[tuple[str, str, list[dict[str, Any]]]]):
+def write_valid_activities(source, valid_indices, output):
+    """Streams the activities whose index is in valid_indices from an activities document to output, as UTF-8
+
+    The root element and its attributes are kept. Each activity is cleared once it has been read, so only one is
+    in memory at a time. Only the root's iati-activity children are written, and counted for valid_indices, so any
+    other children (e.g. comments, processing instructions, or other elements and the activities inside them)
+    are dropped.
+
+    If the document can't be parsed, XMLSyntaxError is raised part way through, after some of the output may
+    have been written. For a StagedBlockBlobWriter, the blocks staged by then are left uncommitted, so the blob
+    is unchanged, and Azure discards them if nothing commits them.
+
+    Args:
+        source (file-like): the activities document to read
+        valid_indices (set): the index of each valid activity in the document
+        output (file-like): where to write the clean document
+
+    Returns:
+        int: the number of activities written
+    """
+    context = etree.iterparse(source, events=("start", "end"), huge_tree=True)
+    num_written = 0
+
+    with etree.xmlfile(output, encoding="utf-8") as xf:
+        # the first event is the start of the root element, which has its attributes but not its children yet
+        _, root = next(context)
+        with xf.element(root.tag, dict(root.attrib), nsmap=root.nsmap):
+            i = 0
+            for event, element in context:
+                if event != "end" or element.getparent() is not root:
+                    continue
+                if element.tag == "iati-activity":
+                    if i in valid_indices:
+                        xf.write(element)
+                        num_written += 1
+                    i += 1
+                element.clear()
+                while element.getprevious() is not None:
+                    del root[0]
+
+    return num_written
+
+
+def clean_invalid_documents(documents: Iterable[tuple[str, str, list[int], int]]):
     """removes invalid activities from documents and saves to clean container storage
 
     Args:
-        documents (list): list of tuples that contain the hash, id, and validation index of the documents to clean
+        documents (iterable): tuples that contain the hash, id, valid activity indices and number of activities of
+            the documents to clean
     """
     try:
         conn = db.getDirectConnection()
@@ -125,11 +258,11 @@ def clean_invalid_documents(documents: list[tuple[str, str, list[dict[str, Any]]
         for document in documents:
             hash: str = document[0]
             id: str = document[1]
-            index: list[dict[str, Any]] = document[2]
-            valid_dict: dict[int, bool] = {act["index"]: act["valid"] for act in index if act["valid"] is True}
+            valid_indices: set[int] = set(document[2])
+            num_activities: int = document[3]
 
             logger.info(
-                f"Copying {len(valid_dict)} valid of {len(index)} total activities xml to "
+                f"Copying {len(valid_indices)} valid of {num_activities} total activities xml to "
                 f"clean container for invalid activity document id: {id} and hash: {hash}"
             )
 
@@ -137,18 +270,21 @@ def clean_invalid_documents(documents: list[tuple[str, str, list[dict[str, Any]]
 
             blob_name = hash + ".xml"
 
+            blob_service_client = BlobServiceClient.from_connection_string(config["STORAGE_CONNECTION_STR"])
+            source_blob_client = blob_service_client.get_blob_client(
+                container=config["SOURCE_CONTAINER_NAME"], blob=blob_name
+            )
+            clean_blob_client = blob_service_client.get_blob_client(
+                container=config["CLEAN_CONTAINER_NAME"], blob=blob_name
+            )
+
+            # save valid activities in a doc to "clean" container, streaming them from the source doc
+            clean_writer = utils.StagedBlockBlobWriter(clean_blob_client)
             try:
-                blob_service_client = BlobServiceClient.from_connection_string(config["STORAGE_CONNECTION_STR"])
-                blob_client = blob_service_client.get_blob_client(
-                    container=config["SOURCE_CONTAINER_NAME"], blob=blob_name
+                downloader = source_blob_client.download_blob()
+                num_written = write_valid_activities(
+                    utils.ChunkReader(downloader.chunks()), valid_indices, clean_writer
                 )
-
-                downloader = blob_client.download_blob()
-
-                large_parser = etree.XMLParser(huge_tree=True)
-                root = etree.parse(BytesIO(downloader.content_as_bytes()), parser=large_parser)
-                iati_activities_el = root.getroot()
-                file_encoding = "utf-8"
             except AzureExceptions.ResourceNotFoundError:
                 logger.warning(
                     f"Blob not found for hash: {hash} and id: {id} - updating as "
@@ -159,43 +295,18 @@ def clean_invalid_documents(documents: list[tuple[str, str, list[dict[str, Any]]
             except etree.XMLSyntaxError as e:
                 sentry_sdk.capture_exception(e)
                 logger.warning(f"Cannot parse entire XML for hash: {hash} id: {id}: {e}. ")
-                try:
-                    _, file_encoding = utils.get_text_from_blob(downloader, hash, True)
-                except:
-                    logger.warning(f"Cannot identify charset for hash: {hash} id: {id} to remove invalid activities.")
                 db.updateCleanError(conn, id, "Could not parse")
                 continue
 
-            # loop and save valid activities to clean doc
-            activities = iati_activities_el.xpath("iati-activity")
-
-            cleanDoc = etree.Element("iati-activities")
-
-            # copy attributes from the iati-activities element over to the new element
-            for att in iati_activities_el.attrib:
-                cleanDoc.attrib[att] = iati_activities_el.attrib[att]
-
-            i = 0
-            for activity in activities:
-                if i in valid_dict:
-                    cleanDoc.append(activity)
-                i += 1
-
-            if len(cleanDoc) == 0:
+            if num_written == 0:
                 logger.info(f"No valid activities for hash: {hash} id: {id}. ")
                 db.updateCleanError(conn, id, "No valid activities")
                 continue
 
-            # save valid activities in a doc to "clean" container
-            activities_xml = etree.tostring(cleanDoc, encoding=file_encoding)
-            blob_client = blob_service_client.get_blob_client(container=config["CLEAN_CONTAINER_NAME"], blob=blob_name)
-            blob_client.upload_blob(activities_xml, overwrite=True, encoding=file_encoding)
-            blob_client.set_blob_tags({"dataset_hash": hash, "document_id": id})
-
-            del iati_activities_el
-            del activities
-            del cleanDoc
-            del i
+            clean_writer.commit(
+                metadata={utils.CHARSET_METADATA_KEY: "utf-8"},
+                tags={"dataset_hash": hash, "document_id": id},
+            )
 
             db.completeClean(conn, id)
 
@@ -215,43 +326,43 @@ def clean_invalid_documents(documents: list[tuple[str, str, list[dict[str, Any]]
             pass
 
 
+def process_claimed_invalid_documents(run_started):
+    """Claims and processes invalid activities documents to clean until there are none left, see db.iterateClaimed"""
+    clean_invalid_documents(
+        db.iterateClaimed(
+            db.claimInvalidActivitiesDocsToClean,
+            config["DB_CLAIM_BATCH_SIZE"],
+            config["DB_CLAIM_LEASE_SECONDS"],
+            run_started,
+        )
+    )
+
+
 def clean_invalid():
-    """gets list of invalid documents to clean and sets up up multiprocessing"""
+    """counts invalid documents to clean and sets up up multiprocessing"""
     logger.info("Starting clean of invalid activities documents to save to clean container...")
 
-    conn = db.getDirectConnection()
-
-    logger.info("Resetting those unfinished")
+    run_started = datetime.now()
 
-    db.resetUnfinishedCleans(conn)
+    conn = db.getDirectConnection()
 
-    # get invalid docs that have valid activities
-    documents = db.getInvalidActivitiesDocsToClean(conn)
+    # count invalid docs that have valid activities
+    num_documents = db.getNumInvalidActivitiesDocsToClean(conn, config["DB_CLAIM_LEASE_SECONDS"], run_started)
 
-    set_prom_metric("invalid_datasets_to_clean", len(documents))
+    set_prom_metric("invalid_datasets_to_clean", num_documents)
 
     if config["CLEAN"]["PARALLEL_PROCESSES"] == 1:
-        logger.info(f"Cleaning and storing {len(documents)} IATI files in a single process.")
-        clean_invalid_documents(documents)
+        logger.info(f"Cleaning and storing {num_documents} IATI files in a single process.")
+        process_claimed_invalid_documents(run_started)
     else:
-        chunked_doc_lists = list(utils.chunk_list(documents, config["CLEAN"]["PARALLEL_PROCESSES"]))
-
-        processes = []
-
         logger.info(
-            f"Cleaning and storing {len(documents)} IATI files in a maximum of "
+            f"Cleaning and storing {num_documents} IATI files in a maximum of "
             f"{config['CLEAN']['PARALLEL_PROCESSES']} parallel processes."
         )
 
-        for chunk in chunked_doc_lists:
-            if len(chunk) == 0:
-                continue
-            process = Process(target=clean_invalid_documents, args=(chunk,))
-            process.start()
-            processes.append(process)
-
-        for process in processes:
-            process.join()
+        utils.run_in_processes(
+            process_claimed_invalid_documents, (run_started,), config["CLEAN"]["PARALLEL_PROCESSES"]
+        )
 
     conn.close()
     logger.info("clean_invalid Finished.")
@@ -260,7 +371,9 @@ def clean_invalid():
 def service_loop():
     logger.info("Start service loop")
 
+    listener = db.StageListener([db.DOCUMENT_VALIDATED_CHANNEL])
+
     while True:
         copy_valid()
         clean_invalid()
-        time.sleep(60)
+        listener.wait(config["SERVICE_LOOP_MAX_WAIT"])
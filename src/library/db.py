@@ -1,10 +1,16 @@
 import importlib
+import json
 import pathlib
+import select
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
+from io import StringIO
+from itertools import islice
 
 import psycopg2
+import psycopg2.sql
 import sentry_sdk
+from psycopg2.extras import execute_values
 
 from constants.config import config
 from constants.version import __version__
@@ -12,6 +18,13 @@ from library.logger import getLogger
 
 logger = getLogger()
 
+# Channels NOTIFYed when a document finishes a stage, so the stages after it can start straight away
+DOCUMENT_DOWNLOADED_CHANNEL = "document_downloaded"
+DOCUMENT_VALIDATED_CHANNEL = "document_validated"
+DOCUMENT_CLEANED_CHANNEL = "document_cleaned"
+DOCUMENT_FLATTENED_CHANNEL = "document_flattened"
+DOCUMENT_LAKIFIED_CHANNEL = "document_lakified"
+
 
 def getDirectConnection(retry_counter=0):
     try:
@@ -53,6 +66,77 @@ def getDirectConnection(retry_counter=0):
         raise e
 
 
+def _notify(curs, channel, doc_id):
+    """NOTIFYs channel with the document id, which is sent to listeners when the transaction commits"""
+    curs.execute("SELECT pg_notify(%(channel)s, %(doc_id)s)", {"channel": channel, "doc_id": doc_id})
+
+
+def _notifyAll(curs, channel, doc_ids):
+    """NOTIFYs channel with each of the document ids, see _notify"""
+    curs.execute(
+        "SELECT pg_notify(%(channel)s, doc_id) FROM unnest(%(doc_ids)s) as doc_id",
+        {"channel": channel, "doc_ids": list(doc_ids)},
+    )
+
+
+class StageListener:
+    """LISTENs for notifications on its own connection, so a service loop can wait for new work"""
+
+    def __init__(self, channels):
+        self.channels = channels
+        self.conn = None
+        self._connect()
+
+    def _connect(self):
+        self.conn = getDirectConnection()
+        self.conn.autocommit = True
+        with self.conn.cursor() as curs:
+            for channel in self.channels:
+                curs.execute(psycopg2.sql.SQL("LISTEN {}").format(psycopg2.sql.Identifier(channel)))
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def wait(self, timeout):
+        """Blocks until one of the channels is notified, or timeout seconds have passed
+
+        Notifications that arrived while the service loop was busy return straight away, so no work is missed.
+        If the connection has been lost this reconnects, and returns True so the loop catches up on anything
+        that was missed in the meantime.
+
+        :return: True if a notification was received
+        """
+        try:
+            if self.conn is None:
+                self._connect()
+                return True
+            return self._wait_for_notification(time.monotonic() + timeout)
+        except psycopg2.Error as e:
+            logger.warning("Lost connection listening for {}: {}".format(", ".join(self.channels), str(e).strip()))
+            self.close()
+            time.sleep(timeout)
+            return False
+
+    def _wait_for_notification(self, deadline):
+        """Polls the connection until a notification arrives (returning True) or the deadline passes (False)"""
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if select.select([self.conn], [], [], remaining)[0] and self._drain_notifications():
+                return True
+
+    def _drain_notifications(self):
+        """Reads what's arrived on the connection, and clears any notifications, returning whether there were any"""
+        self.conn.poll()
+        if not self.conn.notifies:
+            return False
+        self.conn.notifies.clear()
+        return True
+
+
 def _exec_with_deadlock_retry(conn, sql, params=None, max_attempts=3):
     for attempt in range(1, max_attempts + 1):
         try:
@@ -173,13 +257,18 @@ def migrateIfRequired():
 def getRefreshDataset(conn, retry_errors=False):
     cursor = conn.cursor()
 
+    columns = (
+        "id, hash, cached_dataset_url, cached_dataset_etag, cached_dataset_last_modified, "
+        "cached_dataset_content_length"
+    )
+
     if retry_errors:
         sql = (
-            "SELECT id, hash, cached_dataset_url FROM document WHERE downloaded is null "
+            "SELECT " + columns + " FROM document WHERE downloaded is null "
             "AND (download_error != 4 OR download_error is null)"
         )
     else:
-        sql = "SELECT id, hash, cached_dataset_url FROM document WHERE downloaded is null AND download_error is null"
+        sql = "SELECT " + columns + " FROM document WHERE downloaded is null AND download_error is null"
 
     cursor.execute(sql)
     results = cursor.fetchall()
@@ -196,26 +285,6 @@ def getCursor(conn, itersize, sql):
     return cursor
 
 
-def getUnvalidatedDatasets(conn):
-    cur = conn.cursor()
-    sql = """
-    SELECT document.hash, document.downloaded, document.id, document.url, document.publisher,
-           publisher.name, document.file_schema_valid, publisher.black_flag
-    FROM document
-    LEFT JOIN publisher
-        ON document.publisher = publisher.org_id
-    WHERE downloaded is not null
-    AND download_error is null
-    AND hash != ''
-    AND (validation is Null OR regenerate_validation_report is True)
-    ORDER BY regenerate_validation_report DESC, downloaded
-    """
-    cur.execute(sql)
-    results = cur.fetchall()
-    cur.close()
-    return results
-
-
 def removeBlackFlag(conn, org_id):
     cur = conn.cursor()
     sql = """
@@ -290,133 +359,354 @@ def updateBlackFlagNotified(conn, org_id, notified=True):
     cur.close()
 
 
-def getValidActivitiesDocsToCopy(conn):
+def getFlattenedActivitiesForDoc(conn, id, fetch_size=100):
+    """Yields the flattened activities for a document, in order, fetching fetch_size at a time
+
+    This uses a server side cursor, so only fetch_size activities are held in memory at once. The cursor is
+    declared WITH HOLD, so it is still valid if the connection commits while the activities are being read.
+    """
     sql = """
-    SELECT doc.hash, doc.id
-    FROM document as doc
-    LEFT JOIN validation as val ON doc.validation = val.id
+    SELECT activity
+    FROM flattened_activity
+    WHERE document_id = %(id)s
+    ORDER BY activity_index
+    """
+    data = {"id": id}
+
+    with conn.cursor(name="flattened_activities_" + id, withhold=True) as curs:
+        curs.itersize = fetch_size
+        curs.execute(sql, data)
+        for row in curs:
+            yield row[0]
+
+
+def _getClaimData(limit, lease_seconds, retry_errors_before):
+    now = datetime.now()
+    return {
+        "now": now,
+        "limit": limit,
+        "lease_expired": now - timedelta(seconds=lease_seconds),
+        "retry_errors_before": retry_errors_before,
+    }
+
+
+def _claim(conn, sql, data):
+    with conn.cursor() as curs:
+        curs.execute(sql, data)
+        results = curs.fetchall()
+    conn.commit()
+    return results
+
+
+def _count(conn, where_sql, data):
+    sql = "SELECT COUNT(*) FROM document as doc LEFT JOIN validation as val ON doc.validation = val.id " + where_sql
+    with conn.cursor() as curs:
+        curs.execute(sql, data)
+        return curs.fetchone()[0]
+
+
+def iterateClaimed(claim_function, limit, lease_seconds, retry_errors_before):
+    """Yields documents claimed with claim_function, claiming limit at a time until there are none left
+
+    Claims are made lazily, so a document is only leased shortly before it is processed, and other processes
+    (or replicas) can claim the rest of the backlog in the meantime.
+    """
+    conn = getDirectConnection()
+    try:
+        while True:
+            documents = claim_function(conn, limit, lease_seconds, retry_errors_before)
+            if len(documents) == 0:
+                break
+            yield from documents
+    finally:
+        conn.close()
+
+
+# The claim functions below mark the next limit documents for a stage as started, and return them. They use
+# FOR UPDATE SKIP LOCKED, so concurrent claims (from any number of processes or replicas) get different
+# documents. The stage's start timestamp acts as a lease, so a document whose processing died part way through
+# can be claimed again once lease_seconds have passed. Documents that errored can be claimed again straight
+# away by a run that started after they were last claimed (retry_errors_before), so errors are still retried
+# once per loop. Claiming clears the stage's error, so a document being retried has no error, and only the lease
+# lets another run claim it.
+
+_UNVALIDATED_DATASETS_WHERE = """
+    WHERE doc.downloaded is not null
+    AND doc.download_error is null
+    AND doc.hash != ''
+    AND (doc.validation is Null OR doc.regenerate_validation_report is True)
+    AND NOT (
+        doc.file_schema_valid is False
+        AND (
+            doc.downloaded > %(safety_check_start)s
+            OR EXISTS (
+                SELECT 1 FROM publisher as flagged
+                WHERE flagged.org_id = doc.publisher AND flagged.black_flag is not null
+            )
+        )
+    )
+    AND (
+        doc.validation_start is null
+        OR doc.validation_start < %(lease_expired)s
+        OR (doc.validation_api_error is not null AND doc.validation_start < %(retry_errors_before)s)
+    )
+"""
+
+
+def _getValidationClaimData(limit, lease_seconds, retry_errors_before):
+    data = _getClaimData(limit, lease_seconds, retry_errors_before)
+    data["safety_check_start"] = data["now"] - timedelta(hours=config["VALIDATION"]["SAFETY_CHECK_PERIOD"])
+    return data
+
+
+def claimUnvalidatedDatasets(conn, limit, lease_seconds, retry_errors_before):
+    """Schema invalid documents waiting for the safety check aren't claimed until it allows Full Validation,
+    and validate releases the claim on any it skips for it (releaseValidationClaim), so they're claimed as soon
+    as they're allowed
+    """
+    sql = (
+        """
+    UPDATE document
+    SET validation_start = %(now)s, validation_api_error = null
+    FROM (
+        SELECT doc.id, pub.name, pub.black_flag
+        FROM document as doc
+        LEFT JOIN publisher as pub ON doc.publisher = pub.org_id
+    """
+        + _UNVALIDATED_DATASETS_WHERE
+        + """
+        ORDER BY doc.regenerate_validation_report DESC, doc.downloaded
+        LIMIT %(limit)s
+        FOR UPDATE OF doc SKIP LOCKED
+    ) AS claimed
+    WHERE document.id = claimed.id
+    RETURNING document.hash, document.downloaded, document.id, document.url, document.publisher, claimed.name,
+        document.file_schema_valid, claimed.black_flag, document.regenerate_validation_report
+    """
+    )
+    return _claim(conn, sql, _getValidationClaimData(limit, lease_seconds, retry_errors_before))
+
+
+def getNumUnvalidatedDatasets(conn, lease_seconds, retry_errors_before):
+    return _count(conn, _UNVALIDATED_DATASETS_WHERE, _getValidationClaimData(0, lease_seconds, retry_errors_before))
+
+
+def releaseValidationClaim(conn, id):
+    sql = "UPDATE document SET validation_start=null WHERE id=%(id)s"
+
+    with conn.cursor() as curs:
+        curs.execute(sql, {"id": id})
+    conn.commit()
+
+
+_VALID_ACTIVITIES_DOCS_TO_COPY_WHERE = """
     WHERE
     doc.downloaded is not null
     AND doc.hash != ''
-    AND doc.clean_start is null
-    AND clean_end is null
+    AND doc.clean_end is null
+    AND (
+        doc.clean_start is null
+        OR doc.clean_start < %(lease_expired)s
+        OR (doc.clean_error is not null AND doc.clean_start < %(retry_errors_before)s)
+    )
     AND val.valid = true
     AND val.report ->> 'fileType' = 'iati-activities'
+"""
+
+
+def claimValidActivitiesDocsToCopy(conn, limit, lease_seconds, retry_errors_before):
+    sql = (
+        """
+    UPDATE document
+    SET clean_start = %(now)s, clean_error = null
+    FROM (
+        SELECT doc.id
+        FROM document as doc
+        LEFT JOIN validation as val ON doc.validation = val.id
     """
+        + _VALID_ACTIVITIES_DOCS_TO_COPY_WHERE
+        + """
+        LIMIT %(limit)s
+        FOR UPDATE OF doc SKIP LOCKED
+    ) AS claimed
+    WHERE document.id = claimed.id
+    RETURNING document.hash, document.id
+    """
+    )
+    return _claim(conn, sql, _getClaimData(limit, lease_seconds, retry_errors_before))
 
-    with conn.cursor() as curs:
-        curs.execute(sql)
-        return curs.fetchall()
 
+def getNumValidActivitiesDocsToCopy(conn, lease_seconds, retry_errors_before):
+    return _count(conn, _VALID_ACTIVITIES_DOCS_TO_COPY_WHERE, _getClaimData(0, lease_seconds, retry_errors_before))
 
-def getInvalidActivitiesDocsToClean(conn):
-    sql = """
-    SELECT doc.hash, doc.id, val.report -> 'iati-activities' as valid_index
-    FROM document as doc
-    LEFT JOIN validation as val ON doc.validation = val.id
+
+_INVALID_ACTIVITIES_DOCS_TO_CLEAN_WHERE = """
     WHERE
     doc.downloaded is not null
     AND doc.hash != ''
-    AND doc.clean_start is null
-    AND clean_end is null
+    AND doc.clean_end is null
+    AND (
+        doc.clean_start is null
+        OR doc.clean_start < %(lease_expired)s
+        OR (doc.clean_error is not null AND doc.clean_start < %(retry_errors_before)s)
+    )
     AND val.valid = false
     AND val.report ->> 'fileType' = 'iati-activities'
     AND val.report ? 'iatiVersion' AND report->>'iatiVersion' != ''
     AND report->>'iatiVersion' NOT LIKE '1%%'
-    AND report->>'iati-activities' LIKE '%%"valid": true%%'
+    AND val.report -> 'iati-activities' @> '[{"valid": true}]'
+"""
+
+
+def claimInvalidActivitiesDocsToClean(conn, limit, lease_seconds, retry_errors_before):
+    sql = (
+        """
+    UPDATE document
+    SET clean_start = %(now)s, clean_error = null
+    FROM (
+        SELECT doc.id,
+            ARRAY(
+                SELECT (act ->> 'index')::integer
+                FROM jsonb_array_elements(val.report -> 'iati-activities') as act
+                WHERE act @> '{"valid": true}'
+            ) as valid_indices,
+            jsonb_array_length(val.report -> 'iati-activities') as num_activities
+        FROM document as doc
+        LEFT JOIN validation as val ON doc.validation = val.id
     """
+        + _INVALID_ACTIVITIES_DOCS_TO_CLEAN_WHERE
+        + """
+        LIMIT %(limit)s
+        FOR UPDATE OF doc SKIP LOCKED
+    ) AS claimed
+    WHERE document.id = claimed.id
+    RETURNING document.hash, document.id, claimed.valid_indices, claimed.num_activities
+    """
+    )
+    return _claim(conn, sql, _getClaimData(limit, lease_seconds, retry_errors_before))
 
-    with conn.cursor() as curs:
-        curs.execute(sql)
-        return curs.fetchall()
 
+def getNumInvalidActivitiesDocsToClean(conn, lease_seconds, retry_errors_before):
+    return _count(conn, _INVALID_ACTIVITIES_DOCS_TO_CLEAN_WHERE, _getClaimData(0, lease_seconds, retry_errors_before))
 
-def getUnflattenedDatasets(conn):
-    sql = """
-    SELECT hash, downloaded, doc.id, flatten_api_error
-    FROM document as doc
+
+_UNFLATTENED_DATASETS_WHERE = """
     WHERE doc.downloaded is not Null
     AND doc.clean_end is not Null
-    AND doc.flatten_start is Null
-    ORDER BY downloaded
-    """
-    with conn.cursor() as curs:
-        curs.execute(sql)
-        return curs.fetchall()
+    AND doc.flatten_end is Null
+    AND (
+        doc.flatten_start is Null
+        OR doc.flatten_start < %(lease_expired)s
+        OR (doc.flatten_api_error is not Null AND doc.flatten_start < %(retry_errors_before)s)
+    )
+"""
 
 
-def getFlattenedActivitiesForDoc(conn, id):
-    cur = conn.cursor()
-    sql = """
-    SELECT flattened_activities
-    FROM document as doc
-    WHERE doc.id = %(id)s
+def claimUnflattenedDatasets(conn, limit, lease_seconds, retry_errors_before):
+    sql = (
+        """
+    UPDATE document
+    SET flatten_start = %(now)s, flatten_api_error = null
+    FROM (
+        SELECT doc.id, doc.flatten_api_error
+        FROM document as doc
     """
-    data = {"id": id}
+        + _UNFLATTENED_DATASETS_WHERE
+        + """
+        ORDER BY doc.downloaded
+        LIMIT %(limit)s
+        FOR UPDATE SKIP LOCKED
+    ) AS claimed
+    WHERE document.id = claimed.id
+    RETURNING document.hash, document.downloaded, document.id, claimed.flatten_api_error
+    """
+    )
+    return _claim(conn, sql, _getClaimData(limit, lease_seconds, retry_errors_before))
 
-    cur.execute(sql, data)
-    results = cur.fetchall()
-    cur.close()
 
-    try:
-        return results[0]
-    except Exception:
-        return None
+def getNumUnflattenedDatasets(conn, lease_seconds, retry_errors_before):
+    return _count(conn, _UNFLATTENED_DATASETS_WHERE, _getClaimData(0, lease_seconds, retry_errors_before))
 
 
-def getUnsolrizedDatasets(conn):
-    cur = conn.cursor()
-    sql = """
-    SELECT doc.hash, doc.id, doc.solr_api_error
-    FROM document as doc
-    LEFT JOIN validation as val ON doc.validation = val.id
+_UNSOLRIZED_DATASETS_WHERE = """
     WHERE downloaded is not null
     AND doc.flatten_end is not null
     AND doc.lakify_end is not null
     AND doc.hash != ''
     AND val.report ? 'iatiVersion' AND report->>'iatiVersion' != ''
-    AND report->>'iatiVersion' NOT LIKE '1%'
+    AND report->>'iatiVersion' NOT LIKE '1%%'
     AND (doc.solrize_end is null OR doc.solrize_reindex is True)
-    AND doc.flattened_activities != '[]'
-    ORDER BY doc.downloaded
+    AND (
+        doc.solrize_start is null
+        OR doc.solrize_start < %(lease_expired)s
+        OR doc.solrize_end >= doc.solrize_start
+        OR (doc.solr_api_error is not null AND doc.solrize_start < %(retry_errors_before)s)
+    )
+    AND EXISTS (SELECT 1 FROM flattened_activity as fa WHERE fa.document_id = doc.id)
+"""
+
+
+def claimUnsolrizedDatasets(conn, limit, lease_seconds, retry_errors_before):
+    sql = (
+        """
+    UPDATE document
+    SET solrize_start = %(now)s, solr_api_error = null
+    FROM (
+        SELECT doc.id, doc.solr_api_error
+        FROM document as doc
+        LEFT JOIN validation as val ON doc.validation = val.id
     """
-    cur.execute(sql)
-    results = cur.fetchall()
-    cur.close()
-    return results
+        + _UNSOLRIZED_DATASETS_WHERE
+        + """
+        ORDER BY doc.downloaded
+        LIMIT %(limit)s
+        FOR UPDATE OF doc SKIP LOCKED
+    ) AS claimed
+    WHERE document.id = claimed.id
+    RETURNING document.hash, document.id, claimed.solr_api_error, document.solrize_reindex
+    """
+    )
+    return _claim(conn, sql, _getClaimData(limit, lease_seconds, retry_errors_before))
 
 
-def getUnlakifiedDatasets(conn):
-    cur = conn.cursor()
-    sql = """
-    SELECT hash, downloaded, doc.id
-    FROM document as doc
-    LEFT JOIN validation as val ON doc.validation = val.id
+def getNumUnsolrizedDatasets(conn, lease_seconds, retry_errors_before):
+    return _count(conn, _UNSOLRIZED_DATASETS_WHERE, _getClaimData(0, lease_seconds, retry_errors_before))
+
+
+_UNLAKIFIED_DATASETS_WHERE = """
     WHERE doc.downloaded is not null
     AND doc.clean_end is not Null
-    AND doc.lakify_start is Null
+    AND doc.lakify_end is Null
     AND doc.lakify_error is Null
-    ORDER BY downloaded
-    """
-    cur.execute(sql)
-    results = cur.fetchall()
-    cur.close()
-    return results
+    AND (doc.lakify_start is Null OR doc.lakify_start < %(lease_expired)s)
+"""
 
 
-def resetUnfinishedLakifies(conn):
-    sql = """
-        UPDATE document
-        SET lakify_start = null
-        WHERE id IN (
-            SELECT id FROM document
-            WHERE lakify_end IS NULL
-            AND lakify_error IS NULL
-            ORDER BY id
-            FOR UPDATE
-        )
+def claimUnlakifiedDatasets(conn, limit, lease_seconds, retry_errors_before):
+    """Lakify errors are not retried (see sendLakifyErrorToClean), so retry_errors_before is unused"""
+    sql = (
+        """
+    UPDATE document
+    SET lakify_start = %(now)s
+    FROM (
+        SELECT doc.id
+        FROM document as doc
     """
-    _exec_with_deadlock_retry(conn, sql)
+        + _UNLAKIFIED_DATASETS_WHERE
+        + """
+        ORDER BY doc.downloaded
+        LIMIT %(limit)s
+        FOR UPDATE SKIP LOCKED
+    ) AS claimed
+    WHERE document.id = claimed.id
+    RETURNING document.hash, document.downloaded, document.id
+    """
+    )
+    return _claim(conn, sql, _getClaimData(limit, lease_seconds, retry_errors_before))
+
+
+def getNumUnlakifiedDatasets(conn, lease_seconds, retry_errors_before):
+    return _count(conn, _UNLAKIFIED_DATASETS_WHERE, _getClaimData(0, lease_seconds, retry_errors_before))
 
 
 def resetUnfoundLakify(conn, doc_id):
@@ -438,34 +728,6 @@ def resetUnfoundLakify(conn, doc_id):
     cur.close()
 
 
-def resetUnfinishedFlattens(conn):
-    sql = """
-        UPDATE document
-        SET flatten_start = null
-        WHERE id IN (
-            SELECT id FROM document
-            WHERE flatten_end IS NULL
-            ORDER BY id
-            FOR UPDATE
-        )
-    """
-    _exec_with_deadlock_retry(conn, sql)
-
-
-def resetUnfinishedCleans(conn):
-    sql = """
-        UPDATE document
-        SET clean_start = null
-        WHERE id IN (
-            SELECT id FROM document
-            WHERE clean_end IS NULL
-            ORDER BY id
-            FOR UPDATE
-        )
-    """
-    _exec_with_deadlock_retry(conn, sql)
-
-
 def updateDocumentSchemaValidationStatus(conn, id, valid):
     sql = "UPDATE document SET file_schema_valid=%(valid)s WHERE id=%(id)s"
 
@@ -497,7 +759,7 @@ def updateValidationRequestDate(conn, id):
 
 def updateSolrizeStartDate(conn, id):
     cur = conn.cursor()
-    sql = "UPDATE document SET solrize_start=%(dt)s WHERE id=%(id)s"
+    sql = "UPDATE document SET solrize_start=%(dt)s, solr_api_error=null WHERE id=%(id)s"
 
     date = datetime.now()
 
@@ -625,21 +887,47 @@ def updateCleanError(conn, doc_id, error):
     conn.commit()
 
 
-def completeFlatten(conn, doc_id, flattened_activities):
-    cur = conn.cursor()
+def completeFlatten(conn, doc_id, flattened_activities, batch_size=100):
+    """Replaces the flattened activities stored for a document and marks the flatten as complete
 
-    sql = """
+    flattened_activities can be any iterable (e.g. a generator), and is only read batch_size activities at a
+    time. Everything happens in one transaction, which is rolled back if anything (including reading
+    flattened_activities) fails.
+    """
+    delete_sql = """
+        DELETE FROM flattened_activity
+        WHERE document_id = %(doc_id)s
+    """
+
+    insert_sql = """
+        INSERT INTO flattened_activity (document_id, activity_index, activity)
+        VALUES %s
+    """
+
+    complete_sql = """
         UPDATE document
-        SET flatten_end = %(now)s, flattened_activities = %(flat_act)s, flatten_api_error = null
+        SET flatten_end = %(now)s, flatten_api_error = null
         WHERE id = %(doc_id)s
     """
 
-    data = {"doc_id": doc_id, "now": datetime.now(), "flat_act": flattened_activities}
+    data = {"doc_id": doc_id, "now": datetime.now()}
 
-    cur.execute(sql, data)
+    activities = enumerate(flattened_activities)
 
-    conn.commit()
-    cur.close()
+    try:
+        with conn.cursor() as curs:
+            curs.execute(delete_sql, data)
+            while True:
+                batch = [(doc_id, index, json.dumps(activity)) for index, activity in islice(activities, batch_size)]
+                if len(batch) == 0:
+                    break
+                execute_values(curs, insert_sql, batch, page_size=batch_size)
+            curs.execute(complete_sql, data)
+            _notify(curs, DOCUMENT_FLATTENED_CHANNEL, doc_id)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
 
 
 def completeClean(conn, doc_id):
@@ -656,6 +944,44 @@ def completeClean(conn, doc_id):
 
     with conn.cursor() as curs:
         curs.execute(sql, data)
+        _notify(curs, DOCUMENT_CLEANED_CHANNEL, doc_id)
+    conn.commit()
+
+
+def startCleanBatch(conn, doc_ids):
+    """startClean for a batch of documents, in one statement"""
+    sql = """
+        UPDATE document
+        SET clean_start = %(now)s, clean_error = null
+        WHERE id = ANY(%(doc_ids)s)
+    """
+
+    data = {
+        "doc_ids": list(doc_ids),
+        "now": datetime.now(),
+    }
+
+    with conn.cursor() as curs:
+        curs.execute(sql, data)
+    conn.commit()
+
+
+def completeCleanBatch(conn, doc_ids):
+    """completeClean for a batch of documents, in one statement"""
+    sql = """
+        UPDATE document
+        SET clean_end = %(now)s, clean_error = null
+        WHERE id = ANY(%(doc_ids)s)
+    """
+
+    data = {
+        "doc_ids": list(doc_ids),
+        "now": datetime.now(),
+    }
+
+    with conn.cursor() as curs:
+        curs.execute(sql, data)
+        _notifyAll(curs, DOCUMENT_CLEANED_CHANNEL, doc_ids)
     conn.commit()
 
 
@@ -715,12 +1041,18 @@ def completeLakify(conn, doc_id):
     }
 
     cur.execute(sql, data)
+    _notify(cur, DOCUMENT_LAKIFIED_CHANNEL, doc_id)
 
     conn.commit()
     cur.close()
 
 
-def completeSolrize(conn, id):
+def completeSolrize(conn, id, fingerprints=None, batch_size=1000):
+    """Marks a document as solrized, replacing the fingerprints of its Solr docs
+
+    :param fingerprints: (core, solr id, fingerprint) tuples of every doc in Solr for the document, or None if
+        they weren't worked out, in which case no fingerprints are kept
+    """
     cur = conn.cursor()
 
     sql = """
@@ -739,11 +1071,45 @@ def completeSolrize(conn, id):
 
     cur.execute(sql, data)
 
+    cur.execute("DELETE FROM solr_fingerprint WHERE document_id = %(id)s", {"id": id})
+    if fingerprints is not None:
+        execute_values(
+            cur,
+            "INSERT INTO solr_fingerprint (document_id, core, solr_id, fingerprint) VALUES %s",
+            ((id, core, solr_id, fingerprint) for core, solr_id, fingerprint in fingerprints),
+            page_size=batch_size,
+        )
+
     conn.commit()
     cur.close()
 
 
-def updateFileAsDownloaded(conn, id):
+def getSolrFingerprints(conn, id):
+    """Returns the fingerprints stored by completeSolrize for a document's Solr docs, by core and Solr id"""
+    sql = "SELECT core, solr_id, fingerprint FROM solr_fingerprint WHERE document_id = %(id)s"
+
+    fingerprints = {}
+    with conn.cursor() as curs:
+        curs.execute(sql, {"id": id})
+        for core, solr_id, fingerprint in curs:
+            fingerprints.setdefault(core, {})[solr_id] = fingerprint
+    conn.commit()
+    return fingerprints
+
+
+def deleteSolrFingerprints(conn, id):
+    """Forgets the fingerprints of a document's Solr docs, so the next solrize of it sends every doc"""
+    with conn.cursor() as curs:
+        curs.execute("DELETE FROM solr_fingerprint WHERE document_id = %(id)s", {"id": id})
+    conn.commit()
+
+
+def updateFileAsDownloaded(conn, id, validators=None):
+    """Marks a document as downloaded
+
+    :param dict validators: The etag, last_modified and content_length of the download, to make conditional
+        requests with next time. If None the stored ones are left as they are (e.g. after a 304 response).
+    """
     cur = conn.cursor()
 
     sql = """
@@ -752,6 +1118,14 @@ def updateFileAsDownloaded(conn, id):
         WHERE id = %(id)s
     """
 
+    validators_sql = """
+        UPDATE document
+        SET cached_dataset_etag = %(etag)s,
+            cached_dataset_last_modified = %(last_modified)s,
+            cached_dataset_content_length = %(content_length)s
+        WHERE id = %(id)s
+    """
+
     date = datetime.now()
 
     data = {
@@ -760,6 +1134,9 @@ def updateFileAsDownloaded(conn, id):
     }
 
     cur.execute(sql, data)
+    if validators is not None:
+        cur.execute(validators_sql, {"id": id, **validators})
+    _notify(cur, DOCUMENT_DOWNLOADED_CHANNEL, id)
     conn.commit()
     cur.close()
 
@@ -843,19 +1220,58 @@ def updatePublisherAsSeen(conn, name, last_seen):
     conn.commit()
 
 
-def insertOrUpdateDocument(conn, dt: datetime, dataset: dict):
-    sql1 = """
+def _copyTextValue(value):
+    """Formats a value for COPY ... FROM STDIN in the default text format"""
+    if value is None:
+        return "\\N"
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def syncDocuments(conn, dt: datetime, datasets: list[dict]):
+    """Inserts or updates all of the given documents, and finds the changed and stale ones, in one transaction
+
+    The datasets are COPYed into a temporary table, and the document table is updated from it with set based
+    SQL. As with one document at a time, a document whose hash has changed has all of its processing state
+    reset, and every document in datasets has its last_seen set to dt.
+
+    :param datasets: dicts with the keys id, hash, url, cached_dataset_url, publisher_id and name. If an id
+        appears more than once the last one is used.
+    :return: a tuple of the changed documents and the stale documents (those not in datasets), each a list of
+        (id, old hash) tuples
+    """
+    create_sql = """
+        CREATE TEMPORARY TABLE document_sync (
+            id character varying PRIMARY KEY,
+            hash character varying,
+            url character varying,
+            publisher character varying,
+            name character varying,
+            cached_dataset_url character varying
+        ) ON COMMIT DROP
+    """
+
+    changed_sql = """
+        SELECT document.id, document.hash
+        FROM document
+        JOIN document_sync ON document.id = document_sync.id
+        WHERE document.hash != document_sync.hash
+    """
+
+    upsert_sql = """
         INSERT INTO document (id, hash, url, first_seen, last_seen, publisher, name, cached_dataset_url)
-        VALUES (%(id)s, %(hash)s, %(url)s, %(dt)s, %(dt)s, %(publisher_id)s, %(name)s, %(cached_dataset_url)s)
+        SELECT id, hash, url, %(dt)s, %(dt)s, publisher, name, cached_dataset_url
+        FROM document_sync
+        ORDER BY id
         ON CONFLICT (id) DO
-            UPDATE SET hash = %(hash)s,
-                url = %(url)s,
-                name = %(name)s,
+            UPDATE SET hash = EXCLUDED.hash,
+                url = EXCLUDED.url,
+                name = EXCLUDED.name,
                 modified = %(dt)s,
-                cached_dataset_url = %(cached_dataset_url)s,
+                cached_dataset_url = EXCLUDED.cached_dataset_url,
                 downloaded = null,
                 download_error = null,
                 validation_request = null,
+                validation_start = null,
                 validation_api_error = null,
                 validation = null,
                 file_schema_valid = null,
@@ -870,63 +1286,60 @@ def insertOrUpdateDocument(conn, dt: datetime, dataset: dict):
                 solr_api_error = null,
                 clean_start = null,
                 clean_end = null,
-                clean_error = null
-            WHERE document.id=%(id)s and document.hash != %(hash)s;
+                clean_error = null,
+                cached_dataset_etag = null,
+                cached_dataset_last_modified = null,
+                cached_dataset_content_length = null
+            WHERE document.hash != EXCLUDED.hash
     """
 
-    sql2 = """
-            UPDATE document SET
-            last_seen = %(dt)s,
-            publisher = %(publisher_id)s,
-            name = %(name)s
-            WHERE document.id=%(id)s;
+    seen_sql = """
+        UPDATE document
+        SET last_seen = %(dt)s,
+            publisher = document_sync.publisher,
+            name = document_sync.name
+        FROM document_sync
+        WHERE document.id = document_sync.id
     """
 
-    data = {
-        "id": dataset["id"],
-        "hash": dataset["hash"],
-        "url": dataset["url"],
-        "cached_dataset_url": dataset["cached_dataset_url"],
-        "publisher_id": dataset["publisher_id"],
-        "name": dataset["name"],
-        "dt": dt,
-    }
-
-    with conn.cursor() as curs:
-        curs.execute(sql1, data)
-        curs.execute(sql2, data)
-    conn.commit()
-
-
-def getFileWhereHashChanged(conn, id, hash):
-    cur = conn.cursor()
-
-    sql = """
-        SELECT id, hash FROM document
-        WHERE document.id=%(id)s and document.hash != %(hash)s;
+    stale_sql = """
+        SELECT id, hash FROM document WHERE last_seen < %(dt)s
     """
 
-    data = {"id": id, "hash": hash}
+    data = {"dt": dt}
+
+    datasets_by_id = {dataset["id"]: dataset for dataset in datasets}
+    copy_buffer = StringIO()
+    for dataset in datasets_by_id.values():
+        row = [
+            dataset["id"],
+            dataset["hash"],
+            dataset["url"],
+            dataset["publisher_id"],
+            dataset["name"],
+            dataset["cached_dataset_url"],
+        ]
+        copy_buffer.write("\t".join(_copyTextValue(value) for value in row) + "\n")
+    copy_buffer.seek(0)
 
-    cur.execute(sql, data)
-    results = cur.fetchone()
-    cur.close()
-    return results
-
-
-def getFilesNotSeenAfter(conn, dt):
-    cur = conn.cursor()
-
-    sql = """
-        SELECT id, hash FROM document WHERE last_seen < %s
-    """
-
-    data = (dt,)
+    try:
+        with conn.cursor() as curs:
+            curs.execute(create_sql)
+            curs.copy_expert(
+                "COPY document_sync (id, hash, url, publisher, name, cached_dataset_url) FROM STDIN", copy_buffer
+            )
+            curs.execute(changed_sql)
+            changed = curs.fetchall()
+            curs.execute(upsert_sql, data)
+            curs.execute(seen_sql, data)
+            curs.execute(stale_sql, data)
+            stale = curs.fetchall()
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
 
-    cur.execute(sql, data)
-    results = cur.fetchall()
-    cur.close()
-    return results
+    return changed, stale
 
 
 def removeFilesNotSeenAfter(conn, dt):
@@ -975,7 +1388,18 @@ def removePublishersNotSeenAfter(conn, dt):
     cur.close()
 
 
-def updateValidationState(conn, doc_id, doc_hash, doc_url, publisher, state, report, publisher_name):
+def updateValidationState(
+    conn,
+    doc_id,
+    doc_hash,
+    doc_url,
+    publisher,
+    state,
+    report,
+    publisher_name,
+    file_schema_valid=None,
+    validation_api_error=None,
+):
 
     cur = conn.cursor()
 
@@ -990,9 +1414,10 @@ def updateValidationState(conn, doc_id, doc_hash, doc_url, publisher, state, rep
     sql = """
         WITH new_id AS (
             INSERT INTO validation (document_id, document_hash, document_url, created,
-                valid, report, publisher, publisher_name)
+                valid, report, publisher, publisher_name, file_schema_valid, validation_api_error)
             VALUES (%(doc_id)s, %(doc_hash)s, %(doc_url)s, %(created)s,
-                %(valid)s, %(report)s, %(publisher)s, %(publisher_name)s)
+                %(valid)s, %(report)s, %(publisher)s, %(publisher_name)s, %(file_schema_valid)s,
+                %(validation_api_error)s)
             RETURNING id
         )
         UPDATE document
@@ -1010,9 +1435,88 @@ def updateValidationState(conn, doc_id, doc_hash, doc_url, publisher, state, rep
         "report": report,
         "publisher": publisher,
         "publisher_name": publisher_name,
+        "file_schema_valid": file_schema_valid,
+        "validation_api_error": validation_api_error,
     }
 
     cur.execute(sql, data)
+    _notify(cur, DOCUMENT_VALIDATED_CHANNEL, doc_id)
+    conn.commit()
+
+
+# Report fields identifying the version of the validator, and the rules and codelists it used, that made a report
+VALIDATOR_VERSION_FIELDS = ["apiVersion", "rulesetCommitSha", "codelistCommitSha", "orgIdPrefixFileName"]
+
+
+def getValidatorVersion(report):
+    """Returns the VALIDATOR_VERSION_FIELDS of a report from the validator, by field"""
+    return {field: None if report.get(field) is None else str(report[field]) for field in VALIDATOR_VERSION_FIELDS}
+
+
+def getCachedValidation(conn, doc_hash, validator_version):
+    """Returns (id, file_schema_valid) of the latest validation of the same content, or None
+
+    Only validations made by validator_version (see getValidatorVersion) are returned, so reports made before
+    the validator (or its rules or codelists) changed aren't reused.
+    """
+    version_match = " ".join(
+        "AND val.report ->> '{0}' IS NOT DISTINCT FROM %({0})s".format(field) for field in VALIDATOR_VERSION_FIELDS
+    )
+    sql = (
+        """
+    SELECT val.id, val.file_schema_valid
+    FROM validation as val
+    WHERE val.document_hash = %(doc_hash)s
+    AND val.file_schema_valid is not null
+    """
+        + version_match
+        + """
+    ORDER BY val.id DESC
+    LIMIT 1
+    """
+    )
+
+    data = {field: validator_version.get(field) for field in VALIDATOR_VERSION_FIELDS}
+    data["doc_hash"] = doc_hash
+
+    with conn.cursor() as curs:
+        curs.execute(sql, data)
+        return curs.fetchone()
+
+
+def reuseValidation(conn, doc_id, doc_url, publisher, publisher_name, validation_id):
+    """Validates a document with a copy of the report in an existing validation of the same content"""
+    sql = """
+        WITH new_val AS (
+            INSERT INTO validation (document_id, document_hash, document_url, created,
+                valid, report, publisher, publisher_name, file_schema_valid, validation_api_error)
+            SELECT %(doc_id)s, document_hash, %(doc_url)s, %(created)s,
+                valid, report, %(publisher)s, %(publisher_name)s, file_schema_valid, validation_api_error
+            FROM validation
+            WHERE id = %(validation_id)s
+            RETURNING id, file_schema_valid, validation_api_error
+        )
+        UPDATE document
+            SET validation = new_val.id,
+            file_schema_valid = new_val.file_schema_valid,
+            validation_api_error = new_val.validation_api_error,
+            regenerate_validation_report = 'f'
+            FROM new_val
+            WHERE document.id = %(doc_id)s;
+        """
+
+    data = {
+        "doc_id": doc_id,
+        "doc_url": doc_url,
+        "created": datetime.now(),
+        "publisher": publisher,
+        "publisher_name": publisher_name,
+        "validation_id": validation_id,
+    }
+
+    with conn.cursor() as curs:
+        curs.execute(sql, data)
+        _notify(curs, DOCUMENT_VALIDATED_CHANNEL, doc_id)
     conn.commit()
 
 
@@ -1,9 +1,7 @@
 import json
-import os
-import tempfile
-import time
 import traceback
-from multiprocessing import Process
+from datetime import datetime
+from io import BytesIO
 
 import dateutil.parser
 import sentry_sdk
@@ -26,14 +24,66 @@ class Flattener:
     def __init__(self, sub_list_elements=config_explode_elements):
         self.sub_list_elements = sub_list_elements
 
-    def process(self, input_filename):
-        # Check right type of XML file, get attributes from root
-        large_parser = etree.XMLParser(huge_tree=True, recover=True, remove_comments=True)
-        root = etree.parse(input_filename, parser=large_parser).getroot()
+    def process(self, source, encoding=None):
+        """Flattens an IATI activities XML document, parsing it once.
 
-        if root.tag != "iati-activities":
+        :param source: A filename, or a file-like object that returns bytes
+        :param str encoding: Overrides the encoding the document declares. Use for documents that are
+            not UTF-8 and have had their charset detected.
+        :return: A list of the flattened activities
+        """
+        return list(self.iterate(source, encoding=encoding))
+
+    def iterate(self, source, encoding=None):
+        """Like process, but yields each flattened activity as soon as it has been parsed"""
+        root_attributes = None
+
+        # Process
+        context = etree.iterparse(
+            source,
+            events=("start", "end"),
+            tag=("iati-activities", "iati-activity"),
+            encoding=encoding,
+            huge_tree=True,
+            recover=True,
+            remove_comments=True,
+        )
+        for event, activity in context:
+            if root_attributes is None:
+                # Check right type of XML file, get attributes from root
+                if event != "start" or activity.tag != "iati-activities" or activity.getparent() is not None:
+                    raise FlattenerException("Non-IATI XML")
+                root_attributes = self._get_root_attributes(activity)
+                continue
+
+            if event != "end" or activity.tag != "iati-activity":
+                continue
+
+            nsmap = activity.nsmap
+            # Start
+            activity_output = root_attributes.copy()
+            sub_lists = {child_tag_name: [] for child_tag_name in self.sub_list_elements}
+            # Activity Data and Sub lists, in one pass over the activity
+            self._process_activity(activity, activity_output, sub_lists, nsmap=nsmap)
+            for child_tag_name in self.sub_list_elements:
+                if sub_lists[child_tag_name]:
+                    activity_output["@" + child_tag_name] = sub_lists[child_tag_name]
+            # We have output
+            yield activity_output
+            self._free_activity(activity)
+
+        if root_attributes is None:
             raise FlattenerException("Non-IATI XML")
 
+    def _free_activity(self, activity):
+        # Only for activities at the top level, as nested ones are part of their parent
+        parent = activity.getparent()
+        if parent is not None and parent.getparent() is None:
+            activity.clear(keep_tail=True)
+            while activity.getprevious() is not None:
+                del parent[0]
+
+    def _get_root_attributes(self, root):
         root_attributes = {}
 
         # Previous tool always added version, even if it was blank
@@ -43,57 +93,51 @@ class Flattener:
         if root.attrib.get("linked-data-default"):
             self._add_to_output("dataset_linked_data_default", root.attrib.get("linked-data-default"), root_attributes)
 
-        del root
+        return root_attributes
 
-        # Start Output
-        output = []
+    def _process_activity(self, activity_tag, activity_output, sub_lists, nsmap={}):
+        """Processes an activity, putting data from any sub list elements in both the activity and the sub list.
 
-        # Process
-        context = etree.iterparse(
-            input_filename, tag="iati-activity", huge_tree=True, recover=True, remove_comments=True
-        )
-        for _, activity in context:
-            nsmap = activity.nsmap
-            # Start
-            activity_output = root_attributes.copy()
-            # Activity Data
-            self._process_tag(activity, activity_output, nsmap=nsmap)
-            # Sub lists?
-            for child_tag_name in self.sub_list_elements:
-                child_tags = activity.findall(child_tag_name)
-                if child_tags:
-                    activity_output["@" + child_tag_name] = []
-                    for child_tag in child_tags:
-                        child_tag_data = {}
-                        # TODO this isn't the most efficient as we are parsing the same tag twice
-                        # (here & above for activity)
-                        # But for now, we'll do this to prove functionality then look at speed.
-                        self._process_tag(child_tag, child_tag_data, prefix=child_tag_name, nsmap=nsmap)
-                        activity_output["@" + child_tag_name].append(child_tag_data)
-            # We have output
-            output.append(activity_output)
+        The sub list elements are direct children of the activity, and their canonical names are the same
+        whether they are processed as part of the activity or on their own. So they are processed once, with
+        every value added to both outputs.
+        """
+        # Attributes
+        for attrib_k, attrib_v in activity_tag.attrib.items():
+            self._add_to_outputs(self._convert_name_to_canonical(attrib_k, nsmap=nsmap), attrib_v, (activity_output,))
 
-        # Return
-        return output
+        # Child tags
+        for child_xml_tag in activity_tag.getchildren():
+            prefix = self._convert_name_to_canonical(child_xml_tag.tag, nsmap=nsmap)
+            outputs = (activity_output,)
+            if child_xml_tag.tag in sub_lists:
+                child_tag_data = {}
+                sub_lists[child_xml_tag.tag].append(child_tag_data)
+                if prefix == child_xml_tag.tag:
+                    outputs = (activity_output, child_tag_data)
+                else:
+                    # The names differ (e.g. the tag has a "-" in), so it can't share a pass
+                    self._process_tag(child_xml_tag, (child_tag_data,), prefix=child_xml_tag.tag, nsmap=nsmap)
+            self._process_tag(child_xml_tag, outputs, prefix=prefix, nsmap=nsmap)
 
-    def _process_tag(self, xml_tag, output, prefix="", nsmap={}):
+    def _process_tag(self, xml_tag, outputs, prefix="", nsmap={}):
 
         # Attributes
         for attrib_k, attrib_v in xml_tag.attrib.items():
 
-            self._add_to_output(
-                self._convert_name_to_canonical(attrib_k, prefix=prefix, nsmap=nsmap), attrib_v, output
+            self._add_to_outputs(
+                self._convert_name_to_canonical(attrib_k, prefix=prefix, nsmap=nsmap), attrib_v, outputs
             )
 
         # Immediate text
         if xml_tag.text and xml_tag.text.strip() and prefix:
-            self._add_to_output(prefix, xml_tag.text.strip(), output)
+            self._add_to_outputs(prefix, xml_tag.text.strip(), outputs)
 
         # Child tags
         for child_xml_tag in xml_tag.getchildren():
             self._process_tag(
                 child_xml_tag,
-                output,
+                outputs,
                 prefix=self._convert_name_to_canonical(child_xml_tag.tag, prefix=prefix, nsmap=nsmap),
                 nsmap=nsmap,
             )
@@ -101,6 +145,9 @@ class Flattener:
     CANONICAL_NAMES_WITH_DATE_TIMES = ["iso_date", "value_date", "extraction_date", "_datetime"]
 
     def _add_to_output(self, canonical_name, value, output):
+        self._add_to_outputs(canonical_name, value, (output,))
+
+    def _add_to_outputs(self, canonical_name, value, outputs):
         # Basic processing
         value = value.strip()
 
@@ -122,14 +169,15 @@ class Flattener:
                 # If can't parse, don't add as solr will error
                 return
 
-        # Add to output
-        if canonical_name in output:
-            if isinstance(output[canonical_name], list):
-                output[canonical_name].append(value)
+        # Add to outputs
+        for output in outputs:
+            if canonical_name in output:
+                if isinstance(output[canonical_name], list):
+                    output[canonical_name].append(value)
+                else:
+                    output[canonical_name] = [output[canonical_name], value]
             else:
-                output[canonical_name] = [output[canonical_name], value]
-        else:
-            output[canonical_name] = value
+                output[canonical_name] = value
 
     DEFAULT_NAMESPACES = {"xml": "http://www.w3.org/XML/1998/namespace"}
 
@@ -152,16 +200,15 @@ class FlattenerException(Exception):
 def process_hash_list(document_datasets):
 
     conn = db.getDirectConnection()
+    blob_service_client = BlobServiceClient.from_connection_string(config["STORAGE_CONNECTION_STR"])
     flattener = Flattener()
 
     for file_data in document_datasets:
-        tempfile_name = None
         try:
             file_hash = file_data[0]
             downloaded = file_data[1]
             doc_id = file_data[2]
             prior_error = file_data[3]
-            tempfile_handle, tempfile_name = tempfile.mkstemp(prefix="flatten" + file_hash)
 
             # Explicit error codes returned from Flattener
             if prior_error == 422 or prior_error == 400 or prior_error == 413:
@@ -181,27 +228,24 @@ def process_hash_list(document_datasets):
             )
             blob_name = file_hash + ".xml"
 
-            blob_service_client = BlobServiceClient.from_connection_string(config["STORAGE_CONNECTION_STR"])
             blob_client = blob_service_client.get_blob_client(container=config["CLEAN_CONTAINER_NAME"], blob=blob_name)
 
             downloader = blob_client.download_blob()
+            blob_bytes = downloader.content_as_bytes()
 
             try:
-                payload = utils.get_text_from_blob(downloader, file_hash)
+                charset = utils.get_cached_charset(downloader) or utils.get_charset_for_bytes(blob_bytes, file_hash)
             except:
                 logger.warning("Can not identify charset for hash {} doc id {}".format(file_hash, doc_id))
                 continue
 
-            os.write(tempfile_handle, payload.encode("utf-8"))
-            os.close(tempfile_handle)
-
-            del payload
-
-            flattenedObject = flattener.process(tempfile_name)
-
-            db.completeFlatten(conn, doc_id, json.dumps(flattenedObject))
+            # lxml reads UTF-8 itself; other charsets override whatever the document declares
+            flattened_activities = flattener.iterate(
+                BytesIO(blob_bytes), encoding=None if charset == "utf-8" else charset
+            )
 
-            os.remove(tempfile_name)
+            # activities are flattened as they are written, so only a batch of them is in memory at once
+            db.completeFlatten(conn, doc_id, flattened_activities, config["FLATTEN"]["ACTIVITY_BATCH_SIZE"])
 
         except AzureExceptions.ResourceNotFoundError:
             logger.warning(
@@ -223,12 +267,6 @@ def process_hash_list(document_datasets):
                 pass
             # Log to DB
             db.updateFlattenError(conn, doc_id, 1)
-            # Delete temp file
-            if tempfile_name:
-                try:
-                    os.remove(tempfile_name)
-                except:
-                    pass
 
     conn.close()
 
@@ -236,49 +274,46 @@ def process_hash_list(document_datasets):
 def service_loop():
     logger.info("Start service loop")
 
+    listener = db.StageListener([db.DOCUMENT_CLEANED_CHANNEL])
+
     while True:
         main()
-        time.sleep(60)
+        listener.wait(config["SERVICE_LOOP_MAX_WAIT"])
+
+
+def process_claimed_datasets(run_started):
+    """Claims and processes unflattened datasets until there are none left, see db.iterateClaimed"""
+    process_hash_list(
+        db.iterateClaimed(
+            db.claimUnflattenedDatasets, config["DB_CLAIM_BATCH_SIZE"], config["DB_CLAIM_LEASE_SECONDS"], run_started
+        )
+    )
 
 
 def main():
     logger.info("Starting to flatten...")
 
-    conn = db.getDirectConnection()
-
-    logger.info("Resetting those unfinished")
+    run_started = datetime.now()
 
-    db.resetUnfinishedFlattens(conn)
+    conn = db.getDirectConnection()
 
-    file_hashes = db.getUnflattenedDatasets(conn)
+    num_datasets = db.getNumUnflattenedDatasets(conn, config["DB_CLAIM_LEASE_SECONDS"], run_started)
 
-    set_prom_metric("datasets_to_flatten", len(file_hashes))
+    set_prom_metric("datasets_to_flatten", num_datasets)
 
     if config["FLATTEN"]["PARALLEL_PROCESSES"] == 1:
-        logger.info("Flattening and storing " + str(len(file_hashes)) + " IATI files in a single process.")
-        process_hash_list(file_hashes)
+        logger.info("Flattening and storing " + str(num_datasets) + " IATI files in a single process.")
+        process_claimed_datasets(run_started)
     else:
-        chunked_hash_lists = list(utils.chunk_list(file_hashes, config["FLATTEN"]["PARALLEL_PROCESSES"]))
-
-        processes = []
-
         logger.info(
             "Flattening and storing "
-            + str(len(file_hashes))
+            + str(num_datasets)
             + " IATI files in a maximum of "
             + str(config["FLATTEN"]["PARALLEL_PROCESSES"])
             + " parallel processes."
         )
 
-        for chunk in chunked_hash_lists:
-            if len(chunk) == 0:
-                continue
-            process = Process(target=process_hash_list, args=(chunk,))
-            process.start()
-            processes.append(process)
-
-        for process in processes:
-            process.join()
+        utils.run_in_processes(process_claimed_datasets, (run_started,), config["FLATTEN"]["PARALLEL_PROCESSES"])
 
     conn.close()
     logger.info("Finished.")
@@ -1,3 +1,6 @@
+import threading
+from contextlib import contextmanager
+
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
@@ -8,6 +11,7 @@ def requests_retry_session(
     backoff_factor=0.3,
     status_forcelist=(),
     session=None,
+    pool_maxsize=10,
 ):
     session = session or requests.Session()
     retry = Retry(
@@ -17,7 +21,75 @@ def requests_retry_session(
         backoff_factor=backoff_factor,
         status_forcelist=status_forcelist,
     )
-    adapter = HTTPAdapter(max_retries=retry)
+    adapter = HTTPAdapter(max_retries=retry, pool_maxsize=pool_maxsize)
     session.mount("http://", adapter)
     session.mount("https://", adapter)
     return session
+
+
+class AdaptiveConcurrencyLimiter:
+    """Limits the number of requests in flight to a service, adapting the limit to how well the service copes
+
+    The limit grows by one each time a limit's worth of requests succeed, up to max_limit, and halves, down to
+    min_limit, each time a request is throttled (HTTP 429), fails with a server error (HTTP 5xx), times out or
+    can't connect. So the limit settles around the concurrency the service can handle.
+    """
+
+    def __init__(self, limit, max_limit, min_limit=1):
+        self.min_limit = min_limit
+        self.max_limit = max(max_limit, min_limit)
+        self.limit = float(min(max(limit, self.min_limit), self.max_limit))
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, overloaded=False):
+        with self.condition:
+            self.in_flight -= 1
+            if overloaded:
+                self.limit = max(self.limit / 2, self.min_limit)
+            else:
+                self.limit = min(self.limit + 1 / self.limit, self.max_limit)
+            self.condition.notify_all()
+
+    @contextmanager
+    def slot(self):
+        """Holds a place under the limit for a piece of work that makes one or more requests
+
+        The place can be taken before the work starts, e.g. before downloading what is to be sent, so the limit
+        also bounds how much of that is held at once. The limit is adapted to the outcome of the requests made
+        with the LimiterSlot yielded, once the place is given up.
+        """
+        self.acquire()
+        slot = LimiterSlot()
+        try:
+            yield slot
+        finally:
+            self.release(slot.overloaded)
+
+    def request(self, session, method, url, **kwargs):
+        """Makes a request with session once there's room under the limit, and adapts the limit to its outcome"""
+        with self.slot() as slot:
+            return slot.request(session, method, url, **kwargs)
+
+
+class LimiterSlot:
+    """A place held under an AdaptiveConcurrencyLimiter's limit, which records if the service was overloaded"""
+
+    def __init__(self):
+        self.overloaded = False
+
+    def request(self, session, method, url, **kwargs):
+        try:
+            response = session.request(method, url, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            self.overloaded = True
+            raise
+        if response.status_code == 429 or response.status_code >= 500:
+            self.overloaded = True
+        return response
@@ -1,7 +1,6 @@
 import json
-import time
+from datetime import datetime
 from io import BytesIO
-from multiprocessing import Process
 
 import sentry_sdk
 from azure.core.exceptions import ResourceNotFoundError
@@ -52,11 +51,23 @@ def recursive_json_nest(element, output):
     return output
 
 
+def upload_activity_blob(blob_service_client, blob_name, data, file_hash):
+    act_blob_client = blob_service_client.get_blob_client(
+        container=config["ACTIVITIES_LAKE_CONTAINER_NAME"], blob=blob_name
+    )
+    act_blob_client.upload_blob(data, overwrite=True, tags={"dataset_hash": file_hash})
+
+
 def process_hash_list(document_datasets):
 
     conn = db.getDirectConnection()
+    blob_service_client = BlobServiceClient.from_connection_string(config["STORAGE_CONNECTION_STR"])
+    upload_executor = utils.BoundedExecutor(
+        config["LAKIFY"]["UPLOAD_THREADS"], config["LAKIFY"]["MAX_PENDING_UPLOADS"]
+    )
 
     for file_data in document_datasets:
+        upload_futures = []
         try:
             file_hash = file_data[0]
             downloaded = file_data[1]
@@ -74,7 +85,6 @@ def process_hash_list(document_datasets):
             )
             blob_name = file_hash + ".xml"
 
-            blob_service_client = BlobServiceClient.from_connection_string(config["STORAGE_CONNECTION_STR"])
             blob_client = blob_service_client.get_blob_client(container=config["CLEAN_CONTAINER_NAME"], blob=blob_name)
 
             downloader = blob_client.download_blob()
@@ -101,24 +111,32 @@ def process_hash_list(document_datasets):
 
                     # XML
                     activity_xml = etree.tostring(activity, encoding="utf-8")
-                    act_blob_client = blob_service_client.get_blob_client(
-                        container=config["ACTIVITIES_LAKE_CONTAINER_NAME"], blob="{}/{}.xml".format(doc_id, id_hash)
+                    upload_futures.append(
+                        upload_executor.submit(
+                            upload_activity_blob,
+                            blob_service_client,
+                            "{}/{}.xml".format(doc_id, id_hash),
+                            activity_xml,
+                            file_hash,
+                        )
                     )
-                    act_blob_client.upload_blob(activity_xml, overwrite=True)
-                    act_blob_client.set_blob_tags({"dataset_hash": file_hash})
 
                     # JSON
                     activity_json = recursive_json_nest(activity, {})
-                    act_blob_json_client = blob_service_client.get_blob_client(
-                        container=config["ACTIVITIES_LAKE_CONTAINER_NAME"], blob="{}/{}.json".format(doc_id, id_hash)
+                    upload_futures.append(
+                        upload_executor.submit(
+                            upload_activity_blob,
+                            blob_service_client,
+                            "{}/{}.json".format(doc_id, id_hash),
+                            json.dumps(activity_json, ensure_ascii=False)
+                            .replace("{http://www.w3.org/XML/1998/namespace}", "xml:")
+                            .encode("utf-8"),
+                            file_hash,
+                        )
                     )
-                    act_blob_json_client.upload_blob(
-                        json.dumps(activity_json, ensure_ascii=False)
-                        .replace("{http://www.w3.org/XML/1998/namespace}", "xml:")
-                        .encode("utf-8"),
-                        overwrite=True,
-                    )
-                    act_blob_json_client.set_blob_tags({"dataset_hash": file_hash})
+
+                    # stop early if an upload has failed, and stop the list of futures growing
+                    utils.raise_first_failure(upload_futures)
                 # Free memory
                 activity.clear()
                 for ancestor in activity.xpath("ancestor-or-self::*"):
@@ -129,6 +147,9 @@ def process_hash_list(document_datasets):
                             break
             del context
 
+            # only complete once every upload for the document has succeeded
+            utils.raise_first_failure(upload_futures, wait=True)
+
             db.completeLakify(conn, doc_id)
 
         except ResourceNotFoundError as e:
@@ -164,58 +185,59 @@ def process_hash_list(document_datasets):
                 "ERROR with Lakifiying hash {} and doc id {}. Error: {}".format(file_hash, doc_id, err_message)
             )
             db.lakifyError(conn, doc_id, err_message)
+        finally:
+            for upload_future in upload_futures:
+                upload_future.cancel()
 
+    upload_executor.shutdown()
     conn.close()
 
 
 def service_loop():
     logger.info("Start service loop")
 
+    listener = db.StageListener([db.DOCUMENT_CLEANED_CHANNEL])
+
     while True:
         main()
-        time.sleep(60)
+        listener.wait(config["SERVICE_LOOP_MAX_WAIT"])
+
+
+def process_claimed_datasets(run_started):
+    """Claims and processes unlakified datasets until there are none left, see db.iterateClaimed"""
+    process_hash_list(
+        db.iterateClaimed(
+            db.claimUnlakifiedDatasets, config["DB_CLAIM_BATCH_SIZE"], config["DB_CLAIM_LEASE_SECONDS"], run_started
+        )
+    )
 
 
 def main():
     logger.info("Starting to Lakify...")
 
-    conn = db.getDirectConnection()
-
-    logger.info("Resetting those unfinished")
+    run_started = datetime.now()
 
-    db.resetUnfinishedLakifies(conn)
+    conn = db.getDirectConnection()
 
-    file_hashes = db.getUnlakifiedDatasets(conn)
+    num_datasets = db.getNumUnlakifiedDatasets(conn, config["DB_CLAIM_LEASE_SECONDS"], run_started)
 
-    set_prom_metric("datasets_to_lakify", len(file_hashes))
+    set_prom_metric("datasets_to_lakify", num_datasets)
 
     logger.info("Got unlakified datasets")
 
     if config["LAKIFY"]["PARALLEL_PROCESSES"] == 1:
-        logger.info("Lakifiying " + str(len(file_hashes)) + " IATI docs in a single process")
-        process_hash_list(file_hashes)
+        logger.info("Lakifiying " + str(num_datasets) + " IATI docs in a single process")
+        process_claimed_datasets(run_started)
     else:
-        chunked_hash_lists = list(utils.chunk_list(file_hashes, config["LAKIFY"]["PARALLEL_PROCESSES"]))
-
-        processes = []
-
         logger.info(
             "Lakifiying "
-            + str(len(file_hashes))
+            + str(num_datasets)
             + " IATI docs in a maximum of "
             + str(config["LAKIFY"]["PARALLEL_PROCESSES"])
             + " parallel processes"
         )
 
-        for chunk in chunked_hash_lists:
-            if len(chunk) == 0:
-                continue
-            process = Process(target=process_hash_list, args=(chunk,))
-            process.start()
-            processes.append(process)
-
-        for process in processes:
-            process.join()
+        utils.run_in_processes(process_claimed_datasets, (run_started,), config["LAKIFY"]["PARALLEL_PROCESSES"])
 
     conn.close()
     logger.info("Finished.")
@@ -1,8 +1,9 @@
-import json
-import multiprocessing
+import threading
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+from urllib.parse import urlparse
 
 import chardet
 import requests
@@ -12,6 +13,7 @@ from azure.storage.blob import BlobServiceClient
 from psycopg2 import Error as DbError
 
 import library.db as db
+import library.utils as utils
 from constants.config import config
 from constants.version import __version__
 from library.bulk_data_service import (
@@ -23,10 +25,7 @@ from library.bulk_data_service import (
 from library.http import requests_retry_session
 from library.logger import getLogger
 from library.prometheus import set_prom_metric
-from library.solrize import addCore
-
-multiprocessing.set_start_method("spawn", True)
-
+from library.solrize import SolrConnections, addCore
 
 logger = getLogger("refresher")
 
@@ -86,16 +85,10 @@ def clean_datasets(stale_datasets, changed_datasets):
         )
 
         # prep solr connections
+        solr_connections = SolrConnections(add_core=addCore)
+        solr_cores = solr_connections.cores
         try:
-            solr_cores = {}
-            solr_cores["activity"] = addCore("activity")
-            explode_elements = json.loads(config["SOLRIZE"]["EXPLODE_ELEMENTS"])
-
-            for core_name in explode_elements:
-                solr_cores[core_name] = addCore(core_name)
-
-            for core_name in solr_cores:
-                solr_cores[core_name].ping()
+            solr_connections.get_cores("to delete stale or changed documents")
         except Exception as e:
             sentry_sdk.capture_exception(e)
             logger.error("ERROR with Initialising Solr to delete stale or changed documents")
@@ -301,54 +294,29 @@ def sync_documents(dataset_list: list[dict]):
         conn.close()
         raise
 
-    changed_datasets = []
-
-    for dataset in all_datasets:
-
-        if (
-            config["REFRESHER"]["LIMIT_ENABLED"] == "yes"
-            and dataset["name"] not in config["REFRESHER"]["LIMIT_TO_DATASETS"]
-        ):
-            continue
+    if config["REFRESHER"]["LIMIT_ENABLED"] == "yes":
+        all_datasets = [
+            dataset for dataset in all_datasets if dataset["name"] in config["REFRESHER"]["LIMIT_TO_DATASETS"]
+        ]
 
-        try:
-            changed = db.getFileWhereHashChanged(conn, dataset["id"], dataset["hash"])
-            if changed is not None:
-                changed_datasets += [changed]
-            db.insertOrUpdateDocument(conn, start_dt, dataset)
-        except DbError as e:
-            sentry_sdk.capture_exception(e)
-            e_message = ""
-            if e.pgerror is not None:
-                e_message = e.pgerror
-            logger.warning(
-                "Failed to sync document with hash: "
-                + dataset["hash"]
-                + " and id: "
-                + dataset["id"]
-                + " : DbError: "
-                + e_message
-            )
-            conn.rollback()
-            conn.close()
-            raise e
-        except Exception as e:
-            sentry_sdk.capture_exception(e)
-            logger.error(
-                "Failed to sync document with hash: "
-                + dataset["hash"]
-                + " and id: "
-                + dataset["id"]
-                + ": Unexpected Error: "
-                + str(e)
-            )
-            conn.close()
-            raise e
+    try:
+        changed_datasets, stale_datasets = db.syncDocuments(conn, start_dt, all_datasets)
+    except DbError as e:
+        sentry_sdk.capture_exception(e)
+        e_message = ""
+        if e.pgerror is not None:
+            e_message = e.pgerror
+        logger.warning("Failed to sync " + str(len(all_datasets)) + " documents: DbError: " + e_message)
+        conn.close()
+        raise e
+    except Exception as e:
+        sentry_sdk.capture_exception(e)
+        logger.error("Failed to sync " + str(len(all_datasets)) + " documents: Unexpected Error: " + str(e))
+        conn.close()
+        raise e
 
     set_prom_metric("datasets_changed", len(changed_datasets))
 
-    stale_datasets = db.getFilesNotSeenAfter(conn, start_dt)
-
     known_documents_num_after = db.getNumDocuments(conn)
 
     logger.info(
@@ -408,27 +376,19 @@ def reload(retry_errors):
 
     set_prom_metric("datasets_to_download", len(datasets))
 
-    chunked_datasets = list(split(datasets, config["REFRESHER"]["PARALLEL_PROCESSES"]))
-
-    processes = []
-
     logger.info(
         "Downloading "
         + str(len(datasets))
-        + " files in a maximum of "
-        + str(config["REFRESHER"]["PARALLEL_PROCESSES"])
-        + " processes."
+        + " files with a maximum of "
+        + str(config["REFRESHER"]["DOWNLOAD_CONCURRENCY"])
+        + " concurrent downloads ("
+        + str(config["REFRESHER"]["MAX_DOWNLOADS_PER_HOST"])
+        + " per host)."
     )
 
-    for chunk in chunked_datasets:
-        if len(chunk) == 0:
-            continue
-        process = multiprocessing.Process(target=download_chunk, args=(chunk, blob_service_client, datasets))
-        process.start()
-        processes.append(process)
+    download_datasets(conn, blob_service_client, datasets)
 
-    for process in processes:
-        process.join()
+    conn.close()
 
     logger.info("Reload complete.")
 
@@ -474,123 +434,223 @@ def service_loop():
             time.sleep(service_loop_sleep)
 
 
-def split(lst, n):
-    k, m = divmod(len(lst), n)
-    return (lst[i * k + min(i, m) : (i + 1) * k + min(i + 1, m)] for i in range(n))
+def download_datasets(conn, blob_service_client, datasets):
+    """Downloads datasets on a pool of threads, sharing a pool of keep-alive connections
 
+    At most DOWNLOAD_CONCURRENCY downloads are in flight at once, and at most MAX_DOWNLOADS_PER_HOST to any one
+    host. The results are recorded in the DB from this thread, on conn, as each download finishes.
+    """
+    session = requests_retry_session(retries=3, pool_maxsize=config["REFRESHER"]["MAX_DOWNLOADS_PER_HOST"])
+    host_semaphores = {
+        urlparse(dataset[2]).netloc: threading.BoundedSemaphore(config["REFRESHER"]["MAX_DOWNLOADS_PER_HOST"])
+        for dataset in datasets
+        if dataset[2] is not None
+    }
 
-def download_chunk(chunk, blob_service_client, datasets):
-    conn = db.getDirectConnection()
+    with ThreadPoolExecutor(max_workers=config["REFRESHER"]["DOWNLOAD_CONCURRENCY"]) as executor:
+        futures = {
+            executor.submit(download_dataset, session, host_semaphores, blob_service_client, dataset): dataset[0]
+            for dataset in datasets
+        }
+        for future in as_completed(futures):
+            id = futures[future]
+            try:
+                download_error, validators = future.result()
+            except Exception:
+                # already logged, and left to be retried by the next reload
+                continue
+            if download_error is None:
+                db.updateFileAsDownloaded(conn, id, validators)
+            else:
+                db.updateFileAsDownloadError(conn, id, download_error)
 
-    for dataset in chunk:
+    session.close()
 
-        id = dataset[0]
-        hash = dataset[1]
-        cached_dataset_url = dataset[2]
 
-        if cached_dataset_url is None:
-            db.updateFileAsDownloadError(conn, id, 4)
-            continue
+def source_blob_matches(blob_client, content_length):
+    """Checks a dataset's source blob exists, and is the size it was when it was downloaded"""
+    try:
+        return blob_client.get_blob_properties().size == content_length
+    except AzureExceptions.ResourceNotFoundError:
+        return False
 
-        try:
-            blob_client = blob_service_client.get_blob_client(
-                container=config["SOURCE_CONTAINER_NAME"], blob=hash + ".xml"
-            )
-            headers = {"User-Agent": "iati-unified-platform-refresher/" + __version__["number"]}
-            logger.info("Trying to download url: " + cached_dataset_url + " and hash: " + hash + " and id: " + id)
-            download_response = requests_retry_session(retries=3).get(
-                url=cached_dataset_url,
-                headers=headers,
-                timeout=config["REFRESHER"]["BULK_DATA_SERVICE_HTTP_TIMEOUT"],
-            )
-            download_xml = download_response.content
-            if download_response.status_code == 200:
-                try:
-                    detect_result = chardet.detect(download_xml)
-                    charset = detect_result["encoding"]
-                    # log error for undetectable charset, prevent PDFs from being downloaded to Unified Platform
-                    if charset is None:
-                        db.updateFileAsDownloadError(conn, id, 2)
-                        clean_containers_by_id(blob_service_client, id)
-                        continue
-                except:
-                    charset = "UTF-8"
-                blob_client.upload_blob(download_xml, overwrite=True, encoding=charset)
-                blob_client.set_blob_tags({"document_id": id})
-                db.updateFileAsDownloaded(conn, id)
-                logger.debug(
-                    "Successfully downloaded url: " + cached_dataset_url + " and hash: " + hash + " and id: " + id
-                )
-            else:
-                db.updateFileAsDownloadError(conn, id, download_response.status_code)
-                clean_containers_by_id(blob_service_client, id)
-                logger.debug(
-                    "HTTP "
-                    + str(download_response.status_code)
-                    + " when downloading url: "
-                    + cached_dataset_url
-                    + " and hash: "
-                    + hash
-                    + " and id: "
-                    + id
-                )
-        except requests.exceptions.SSLError:
-            logger.debug(
-                "SSLError while downloading url: " + cached_dataset_url + " and hash: " + hash + " and id: " + id
-            )
-            db.updateFileAsDownloadError(conn, id, 1)
-            clean_containers_by_id(blob_service_client, id)
-        except requests.exceptions.ConnectionError:
-            logger.debug(
-                "ConnectionError while downloading url: "
-                + cached_dataset_url
-                + " and hash: "
-                + hash
-                + " and id: "
-                + id
-            )
-            db.updateFileAsDownloadError(conn, id, 0)
-            clean_containers_by_id(blob_service_client, id)
-        except requests.exceptions.InvalidSchema as e:
-            logger.warning("Failed to download file with hash: " + hash + " and id: " + id + " Error: " + e.args[0])
-            db.updateFileAsDownloadError(conn, id, 3)
+
+# download_error recorded for the requests exceptions that mean a dataset couldn't be downloaded, most specific
+# first, as SSLError is a ConnectionError
+REQUESTS_DOWNLOAD_ERRORS = [
+    (requests.exceptions.SSLError, 1),
+    (requests.exceptions.ConnectionError, 0),
+    (requests.exceptions.InvalidSchema, 3),
+]
+
+
+def download_dataset(session, host_semaphores, blob_service_client, dataset):
+    """Downloads a dataset to the source container
+
+    If the dataset was downloaded before, this makes a conditional request with the validators from then, and
+    if the dataset hasn't changed and is still in the source container it isn't uploaded again.
+
+    :return: a tuple of the download_error to record for the dataset (None if it was downloaded), and the
+        validators to record for the download (None to keep the existing ones)
+    :raises Exception: if the download failed in a way that shouldn't be recorded
+    """
+    if dataset[2] is None:
+        return 4, None
+
+    try:
+        blob_client = blob_service_client.get_blob_client(
+            container=config["SOURCE_CONTAINER_NAME"], blob=dataset[1] + ".xml"
+        )
+        if dataset[3] is None and dataset[4] is None:
+            return request_dataset(session, host_semaphores, blob_service_client, blob_client, dataset, {})
+        return download_dataset_if_modified(session, host_semaphores, blob_service_client, blob_client, dataset)
+    except Exception as e:
+        result = get_download_error(e, blob_service_client, dataset)
+        if result is None:
+            raise
+        return result
+
+
+def download_dataset_if_modified(session, host_semaphores, blob_service_client, blob_client, dataset):
+    """Downloads a dataset with a conditional request, using the validators from when it was last downloaded
+
+    If the dataset hasn't changed, but its source blob has gone (or isn't the size it was), it's downloaded again
+    with an unconditional request.
+    """
+    id, hash, cached_dataset_url, etag, last_modified, content_length = dataset
+    conditional_headers = {}
+    if etag is not None:
+        conditional_headers["If-None-Match"] = etag
+    if last_modified is not None:
+        conditional_headers["If-Modified-Since"] = last_modified
+
+    result = request_dataset(session, host_semaphores, blob_service_client, blob_client, dataset, conditional_headers)
+    if result[0] != 304:
+        return result
+
+    if source_blob_matches(blob_client, content_length):
+        logger.debug(
+            "Not modified since last download, url: " + cached_dataset_url + " and hash: " + hash + " and id: " + id
+        )
+        return None, None
+
+    # the source blob has gone, so download it again without the validators
+    return request_dataset(session, host_semaphores, blob_service_client, blob_client, dataset, {})
+
+
+def request_dataset(session, host_semaphores, blob_service_client, blob_client, dataset, extra_headers):
+    """Requests a dataset, and saves it to its source blob if the response is a 200
+
+    A 304 is returned as the download_error without cleaning the containers, for download_dataset_if_modified.
+    """
+    id, hash, cached_dataset_url = dataset[:3]
+    headers = {"User-Agent": "iati-unified-platform-refresher/" + __version__["number"], **extra_headers}
+    logger.info("Trying to download url: " + cached_dataset_url + " and hash: " + hash + " and id: " + id)
+    with (
+        host_semaphores[urlparse(cached_dataset_url).netloc],
+        session.get(
+            url=cached_dataset_url,
+            headers=headers,
+            timeout=config["REFRESHER"]["BULK_DATA_SERVICE_HTTP_TIMEOUT"],
+            stream=True,
+        ) as download_response,
+    ):
+        if download_response.status_code == 200:
+            return save_dataset(blob_service_client, blob_client, dataset, download_response)
+
+    if download_response.status_code != 304:
+        clean_containers_by_id(blob_service_client, id)
+    logger.debug(
+        "HTTP "
+        + str(download_response.status_code)
+        + " when downloading url: "
+        + cached_dataset_url
+        + " and hash: "
+        + hash
+        + " and id: "
+        + id
+    )
+    return download_response.status_code, None
+
+
+def save_dataset(blob_service_client, blob_client, dataset, download_response):
+    """Streams a successful download of a dataset into its source blob"""
+    id, hash, cached_dataset_url = dataset[:3]
+    download_chunks = download_response.iter_content(chunk_size=config["REFRESHER"]["DOWNLOAD_BLOCK_SIZE"])
+    # sniff the charset from the start of the file, so the whole file is never held in memory
+    download_prefix = b""
+    for download_chunk in download_chunks:
+        download_prefix += download_chunk
+        if len(download_prefix) >= config["REFRESHER"]["CHARSET_SNIFF_BYTES"]:
+            break
+    try:
+        detect_result = chardet.detect(download_prefix[: config["REFRESHER"]["CHARSET_SNIFF_BYTES"]])
+        charset = detect_result["encoding"]
+        # log error for undetectable charset, prevent PDFs from being downloaded to Unified Platform
+        if charset is None:
             clean_containers_by_id(blob_service_client, id)
-        except AzureExceptions.ResourceNotFoundError as e:
-            sentry_sdk.capture_exception(e)
+            return 2, None
+    except Exception:
+        pass
+    blob_writer = utils.StagedBlockBlobWriter(blob_client, config["REFRESHER"]["DOWNLOAD_BLOCK_SIZE"])
+    blob_writer.write(download_prefix)
+    del download_prefix
+    for download_chunk in download_chunks:
+        blob_writer.write(download_chunk)
+    blob_writer.commit(tags={"document_id": id})
+    logger.debug("Successfully downloaded url: " + cached_dataset_url + " and hash: " + hash + " and id: " + id)
+    return None, {
+        "etag": download_response.headers.get("ETag"),
+        "last_modified": download_response.headers.get("Last-Modified"),
+        "content_length": blob_writer.length,
+    }
+
+
+def get_download_error(e, blob_service_client, dataset):
+    """Works out the download_error to record for an exception raised while downloading a dataset
+
+    :return: a tuple of the download_error and validators, as for download_dataset, or None if the exception
+        shouldn't be recorded and should be raised
+    """
+    id, hash, cached_dataset_url = dataset[:3]
+    for exception_type, download_error in REQUESTS_DOWNLOAD_ERRORS:
+        if isinstance(e, exception_type):
             logger.debug(
-                "ResourceNotFoundError while downloading url: "
+                type(e).__name__
+                + " while downloading url: "
                 + cached_dataset_url
                 + " and hash: "
                 + hash
                 + " and id: "
                 + id
             )
-            db.updateFileAsDownloadError(conn, id, e.status_code)
             clean_containers_by_id(blob_service_client, id)
-        except AzureExceptions.ServiceResponseError as e:
-            sentry_sdk.capture_exception(e)
-            logger.warning(
-                "Failed to upload file with url: "
-                + cached_dataset_url
-                + " and hash: "
-                + hash
-                + " and id: "
-                + id
-                + " - Azure error message: "
-                + e.message
-            )
-        except Exception as e:
-            sentry_sdk.capture_exception(e)
-            e_message = ""
-            if hasattr(e, "args"):
-                e_message = e.args[0]
-            logger.warning(
-                "Failed to upload or download file with url: "
-                + cached_dataset_url
-                + " and hash: "
-                + hash
-                + " and id: "
-                + id
-                + " Error: "
-                + e_message
-            )
+            return download_error, None
+
+    sentry_sdk.capture_exception(e)
+    if isinstance(e, AzureExceptions.ResourceNotFoundError):
+        logger.debug(
+            "ResourceNotFoundError while downloading url: "
+            + cached_dataset_url
+            + " and hash: "
+            + hash
+            + " and id: "
+            + id
+        )
+        clean_containers_by_id(blob_service_client, id)
+        return e.status_code, None
+
+    if isinstance(e, AzureExceptions.ServiceResponseError):
+        e_message = " - Azure error message: " + e.message
+    else:
+        e_message = " Error: " + (e.args[0] if len(e.args) > 0 else "")
+    logger.warning(
+        "Failed to upload or download file with url: "
+        + cached_dataset_url
+        + " and hash: "
+        + hash
+        + " and id: "
+        + id
+        + e_message
+    )
+    return None
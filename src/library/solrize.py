@@ -1,10 +1,17 @@
+import hashlib
 import json
+import queue
 import re
+import threading
 import time
 import traceback
-from multiprocessing import Process
+from collections import ChainMap, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import chain
 
 import pysolr
+import requests
 import sentry_sdk
 from azure.storage.blob import BlobServiceClient
 
@@ -15,9 +22,21 @@ from library.logger import getLogger
 from library.prometheus import set_prom_metric
 
 logger = getLogger("solrize")
-solr_cores = {}
+solr_cores: dict[str, pysolr.Solr] = {}
 explode_elements = json.loads(config["SOLRIZE"]["EXPLODE_ELEMENTS"])  # type: ignore
 
+# Solr field holding the generation of the solrize that added a doc, see SolrWriteBuffer
+GENERATION_FIELD = "iati_activities_document_generation"
+
+# Fields with the same value in every Solr doc of a document, which change whenever any of the document does, so
+# aren't part of a doc's fingerprint (see SolrWriteBuffer)
+DOCUMENT_FIELDS = [
+    "iati_activities_document_hash",
+    "dataset_version",
+    "dataset_generated_datetime",
+    "dataset_linked_data_default",
+]
+
 
 def parse_status_code(error_str):
     status_code = 0
@@ -76,13 +95,122 @@ def sleep_solr(file_hash, file_id, err_type=""):
     )
 
 
-def addCore(core_name):
-    return pysolr.Solr(
+def addCore(core_name, session=None):
+    solr = pysolr.Solr(
         config["SOLRIZE"]["SOLR_API_URL"] + core_name + "_solrize/",
         always_commit=False,
         auth=(config["SOLRIZE"]["SOLR_USER"], config["SOLRIZE"]["SOLR_PASSWORD"]),
         timeout=config["SOLRIZE"]["PYSOLR_TIMEOUT"],
     )
+    if session is not None:
+        # pysolr only makes its own session if it doesn't have one
+        solr.session = session
+    return solr
+
+
+class SolrConnections:
+    """Long-lived clients for the activity core and a core for each explode element
+
+    The clients are made the first time they're needed, and share one requests session, so connections to Solr
+    are pooled and kept alive across documents. The cores are pinged the first time they're used, then only once
+    every SOLR_PING_INTERVAL seconds, or after mark_unhealthy() is called when a request to Solr fails.
+
+    The first time each core is pinged, its schema is checked for GENERATION_FIELD, as without it the
+    delete-by-query in SolrWriteBuffer.delete_older_generations would match (and delete) every doc of a document.
+    In incremental mode, it's also checked for fields that atomic updates would lose (see get_unstored_fields).
+    """
+
+    def __init__(self, cores=None, add_core=addCore):
+        self.cores = cores if cores is not None else {}
+        self.add_core = add_core
+        self.session = None
+        self.last_ping = None
+        self.checked_schemas = set()
+
+    def get_cores(self, description):
+        """Returns the cores by name, pinging them first if they're due a health check
+
+        :param str description: What the cores are for, for the message of a SolrPingError
+        :raises SolrPingError: if any core can't be pinged
+        """
+        if len(self.cores) == 0:
+            self.session = requests.Session()
+            self.cores["activity"] = self.add_core("activity", session=self.session)
+            for core_name in explode_elements:
+                self.cores[core_name] = self.add_core(core_name, session=self.session)
+
+        if self.last_ping is None or time.monotonic() - self.last_ping >= config["SOLRIZE"]["SOLR_PING_INTERVAL"]:
+            for core_name in self.cores:
+                try:
+                    self.cores[core_name].ping()
+                    self.check_schema(core_name)
+                except Exception as e:
+                    self.mark_unhealthy()
+                    e_message = e.args[0] if hasattr(e, "args") else ""
+                    raise SolrPingError(
+                        "PINGING " + description + ", from collection with name " + core_name + ": " + e_message
+                    )
+            self.last_ping = time.monotonic()
+
+        return self.cores
+
+    def check_schema(self, core_name):
+        """Raises an exception if the core's schema can't be used by SolrWriteBuffer"""
+        if core_name in self.checked_schemas:
+            return
+        solr = self.cores[core_name]
+        if get_schema(solr, "fields/" + GENERATION_FIELD) is None:
+            raise Exception("Schema has no " + GENERATION_FIELD + " field, see the Solrize section of the README")
+        if config["SOLRIZE"]["INCREMENTAL"] == "yes":
+            unstored_fields = get_unstored_fields(solr)
+            if len(unstored_fields) > 0:
+                raise Exception(
+                    "Schema fields "
+                    + ", ".join(unstored_fields)
+                    + " must be stored or have docValues for SOLR_INCREMENTAL, see the Solrize section of the README"
+                )
+        self.checked_schemas.add(core_name)
+
+    def mark_unhealthy(self):
+        """Makes the next get_cores() ping the cores"""
+        self.last_ping = None
+
+
+solr_connections = SolrConnections(solr_cores)
+
+
+def get_schema(solr, path, **params):
+    """Gets path (e.g. fields/<name>) from a core's Schema API, or None if the schema doesn't have it"""
+    response = solr.get_session().get(
+        solr.url.rstrip("/") + "/schema/" + path,
+        params={"wt": "json", **params},
+        auth=solr.auth,
+        timeout=solr.timeout,
+    )
+    if response.status_code == 404:
+        return None
+    if response.status_code != 200:
+        raise Exception("Could not get schema " + path + " (HTTP " + str(response.status_code) + ")")
+    return response.json()
+
+
+def get_unstored_fields(solr):
+    """Returns the names of a core's fields and dynamic fields that are neither stored nor have docValues
+
+    An atomic update rebuilds the whole doc from the values Solr has kept, so it would lose the values of these.
+    Copy field destinations are left out, as Solr copies them again, and so are Solr's own fields, e.g. _root_.
+    """
+    fields = get_schema(solr, "fields", showDefaults="true")["fields"]
+    dynamic_fields = get_schema(solr, "dynamicfields", showDefaults="true")["dynamicFields"]
+    copy_field_destinations = {copy_field["dest"] for copy_field in get_schema(solr, "copyfields")["copyFields"]}
+    return [
+        field["name"]
+        for field in fields + dynamic_fields
+        if not field.get("stored")
+        and not field.get("docValues")
+        and field["name"] not in copy_field_destinations
+        and not (field["name"].startswith("_") and field["name"].endswith("_"))
+    ]
 
 
 def validateLatLon(point_pos):
@@ -97,76 +225,142 @@ def validateLatLon(point_pos):
     return None
 
 
+def download_lake_blob(blob_service_client, blob_name):
+    blob_client = blob_service_client.get_blob_client(
+        container=config["ACTIVITIES_LAKE_CONTAINER_NAME"], blob=blob_name
+    )
+    return blob_client.download_blob().content_as_bytes()
+
+
+def submit_lake_blob_downloads(executor, blob_service_client, file_id, fa):
+    if "iati_identifier" not in fa:
+        return (fa, None, None, None)
+
+    hashed_iati_identifier = utils.get_hash_for_identifier(fa["iati_identifier"])
+    return (
+        fa,
+        hashed_iati_identifier,
+        executor.submit(download_lake_blob, blob_service_client, "{}/{}.xml".format(file_id, hashed_iati_identifier)),
+        executor.submit(download_lake_blob, blob_service_client, "{}/{}.json".format(file_id, hashed_iati_identifier)),
+    )
+
+
+def prefetched_bytes(pending):
+    return sum(
+        len(future.result())
+        for item in pending
+        for future in item[2:]
+        if future is not None and future.done() and future.exception() is None
+    )
+
+
+def prefetch_lake_blobs(blob_service_client, file_id, activities):
+    """Downloads the XML and JSON activity lake blobs for activities on a thread pool ahead of them being needed
+
+    At most LAKE_PREFETCH_MAX_IN_FLIGHT blobs are downloading or waiting to be used at any one time, and no new
+    downloads are started while the downloaded blobs waiting to be used take up more than
+    LAKE_PREFETCH_MAX_BYTES.
+
+    :param str file_id: The id of the document the activities are from
+    :param iterable activities: The flattened activities of the document
+    :return: A generator of (activity, hashed iati-identifier, XML future, JSON future) tuples, in the same order
+        as activities. Each future resolves to the bytes of that blob, or raises the download error. Activities
+        with no iati-identifier are yielded with None for the last three items.
+    """
+    max_activities_in_flight = max(config["SOLRIZE"]["LAKE_PREFETCH_MAX_IN_FLIGHT"] // 2, 1)
+    max_bytes = config["SOLRIZE"]["LAKE_PREFETCH_MAX_BYTES"]
+
+    pending = deque()
+    activities_iter = iter(activities)
+    activities_left = True
+
+    with ThreadPoolExecutor(max_workers=max_activities_in_flight * 2) as executor:
+        try:
+            while activities_left or len(pending) > 0:
+                while (
+                    activities_left
+                    and len(pending) < max_activities_in_flight
+                    and (len(pending) == 0 or prefetched_bytes(pending) < max_bytes)
+                ):
+                    fa = next(activities_iter, None)
+                    if fa is None:
+                        activities_left = False
+                    else:
+                        pending.append(submit_lake_blob_downloads(executor, blob_service_client, file_id, fa))
+
+                if len(pending) > 0:
+                    yield pending.popleft()
+        finally:
+            for item in pending:
+                for future in item[2:]:
+                    if future is not None:
+                        future.cancel()
+
+
 def process_hash_list(document_datasets):
     """
 
-    :param list document_datasets: A list of documents to be Solrized. Each item in the
-        list is itself a list with the following elements: doc.hash, doc.id,
-        doc.solr_api_error
+    :param iterable document_datasets: The documents to be Solrized. Each item is
+        itself a list with the following elements: doc.hash, doc.id,
+        doc.solr_api_error, doc.solrize_reindex
     """
 
     conn = db.getDirectConnection()
     blob_service_client = BlobServiceClient.from_connection_string(config["STORAGE_CONNECTION_STR"])
 
     for file_data in document_datasets:
+        write_buffers = {}
         try:
             file_hash = file_data[0]
             file_id = file_data[1]
+            solrize_reindex = file_data[3]
 
-            flattened_activities = db.getFlattenedActivitiesForDoc(conn, file_id)
+            flattened_activities = db.getFlattenedActivitiesForDoc(
+                conn, file_id, config["SOLRIZE"]["FLATTENED_ACTIVITY_FETCH_SIZE"]
+            )
+            first_flattened_activity = next(flattened_activities, None)
 
-            if flattened_activities is None or flattened_activities[0] is None:
+            if first_flattened_activity is None:
                 raise SolrizeSourceError(
                     "Flattened activities not found for hash: " + file_hash + " and id: " + file_id
                 )
 
-            solr_cores["activity"] = addCore("activity")
-
-            for core_name in explode_elements:
-                solr_cores[core_name] = addCore(core_name)
-
-            for core_name in solr_cores:
-                try:
-                    solr_cores[core_name].ping()
-                except Exception as e:
-                    e_message = e.args[0] if hasattr(e, "args") else ""
-                    raise SolrPingError(
-                        "PINGING hash: "
-                        + file_hash
-                        + " and id: "
-                        + file_id
-                        + ", from collection with name "
-                        + core_name
-                        + ": "
-                        + e_message
-                    )
+            solr_connections.get_cores("hash: " + file_hash + " and id: " + file_id)
 
             db.updateSolrizeStartDate(conn, file_id)
 
-            logger.info("Removing all docs for doc with hash: " + file_hash + " and id: " + file_id)
+            # in incremental mode, only docs that have changed since the last successful solrize are sent, unless
+            # a full reindex was asked for, or there are no fingerprints from then to compare with
+            incremental = config["SOLRIZE"]["INCREMENTAL"] == "yes"
+            previous_fingerprints = {}
+            if incremental and not solrize_reindex:
+                previous_fingerprints = db.getSolrFingerprints(conn, file_id)
+            full_reindex = len(previous_fingerprints) == 0
 
-            for core_name in solr_cores:
-                try:
-                    solr_cores[core_name].delete(q="iati_activities_document_id:" + file_id)
-                except Exception as e:
-                    e_message = e.args[0] if hasattr(e, "args") else ""
-                    raise SolrError(
-                        "DELETING hash: "
-                        + file_hash
-                        + " and id: "
-                        + file_id
-                        + ", from collection with name "
-                        + core_name
-                        + ": "
-                        + e_message
-                    )
+            # otherwise every doc is sent as a new generation, alongside the old one, which is only deleted once
+            # the new generation is complete, so the document doesn't disappear from Solr while it's reindexed
+            generation = time.time_ns()
+            if full_reindex:
+                db.deleteSolrFingerprints(conn, file_id)
 
             logger.info("Adding docs for hash: " + file_hash + " and id: " + file_id)
 
             identifier_indices = {}
+            write_buffers = {
+                core_name: SolrWriteBuffer(
+                    core_name,
+                    file_hash,
+                    file_id,
+                    generation,
+                    previous_fingerprints.get(core_name, {}) if incremental else None,
+                )
+                for core_name in solr_cores
+            }
 
-            for fa in flattened_activities[0]:
-                if "iati_identifier" not in fa:
+            for fa, hashed_iati_identifier, xml_future, json_future in prefetch_lake_blobs(
+                blob_service_client, file_id, chain([first_flattened_activity], flattened_activities)
+            ):
+                if hashed_iati_identifier is None:
                     logger.warning(
                         "Encountered an activity in file id: {} hash: {} "
                         "that has an empty <iati-identifier> element. "
@@ -174,14 +368,10 @@ def process_hash_list(document_datasets):
                     )
 
                     continue
-                hashed_iati_identifier = utils.get_hash_for_identifier(fa["iati_identifier"])
                 blob_name = "{}/{}.xml".format(file_id, hashed_iati_identifier)
 
                 try:
-                    blob_client = blob_service_client.get_blob_client(
-                        container=config["ACTIVITIES_LAKE_CONTAINER_NAME"], blob=blob_name
-                    )
-                    downloader = blob_client.download_blob()
+                    xml_bytes = xml_future.result()
                 except:
                     db.resetUnfoundLakify(conn, file_id)
                     raise SolrizeSourceError(
@@ -195,7 +385,7 @@ def process_hash_list(document_datasets):
                     )
 
                 try:
-                    fa["iati_xml"] = utils.get_text_from_blob(downloader, blob_name)
+                    fa["iati_xml"] = utils.get_text_from_bytes(xml_bytes, blob_name)
                 except:
                     raise SolrizeSourceError(
                         "Could not identify charset for blob: "
@@ -209,10 +399,7 @@ def process_hash_list(document_datasets):
                 json_blob_name = "{}/{}.json".format(file_id, hashed_iati_identifier)
 
                 try:
-                    json_blob_client = blob_service_client.get_blob_client(
-                        container=config["ACTIVITIES_LAKE_CONTAINER_NAME"], blob=json_blob_name
-                    )
-                    json_downloader = json_blob_client.download_blob()
+                    json_bytes = json_future.result()
                 except:
                     db.resetUnfoundLakify(conn, file_id)
                     raise SolrizeSourceError(
@@ -226,7 +413,7 @@ def process_hash_list(document_datasets):
                     )
 
                 try:
-                    fa["iati_json"] = utils.get_text_from_blob(json_downloader, json_blob_name)
+                    fa["iati_json"] = utils.get_text_from_bytes(json_bytes, json_blob_name)
                 except:
                     raise SolrizeSourceError(
                         "Could not identify charset for blob: "
@@ -269,7 +456,7 @@ def process_hash_list(document_datasets):
                     file_id, hashed_iati_identifier, identifier_indices[hashed_iati_identifier]
                 )
 
-                addToSolr("activity", [fa], file_hash, file_id)
+                write_buffers["activity"].add([fa])
 
                 # don't index iati_xml or iati_json into exploded elements
                 del fa["iati_xml"]
@@ -278,10 +465,24 @@ def process_hash_list(document_datasets):
                 # Now index explode_elements
                 for element_name, element_data in sub_list_data.items():
                     results = get_explode_element_data(element_name, element_data, fa)
-                    addToSolr(element_name, results, file_hash, file_id)
+                    write_buffers[element_name].add(results)
+
+            for write_buffer in write_buffers.values():
+                write_buffer.flush()
+
+            for write_buffer in write_buffers.values():
+                if full_reindex:
+                    write_buffer.delete_older_generations()
+                else:
+                    write_buffer.delete_vanished()
 
             logger.info("Updating DB with successful Solrize for hash: " + file_hash + " and id: " + file_id)
-            db.completeSolrize(conn, file_id)
+            fingerprints = None
+            if incremental:
+                fingerprints = chain.from_iterable(
+                    write_buffer.get_fingerprints() for write_buffer in write_buffers.values()
+                )
+            db.completeSolrize(conn, file_id, fingerprints)
 
         except SolrizeSourceError as e:
             logger.warning(e.message)
@@ -294,28 +495,16 @@ def process_hash_list(document_datasets):
         except SolrError as e:
             logger.warning(e.message)
             db.updateSolrError(conn, file_id, e.message)
+            solr_connections.mark_unhealthy()
+            # end the other cores' requests now, rather than keeping them open against Solr while sleeping
+            for write_buffer in write_buffers.values():
+                write_buffer.abort()
             if e.type == "Server" or e.type == "Timeout" or e.type == "Connection":
                 sleep_solr(file_hash, file_id, e.type)
-            # delete to keep atomic
-            logger.warning(
-                "Removing docs after Solr Error for hash: "
-                + file_hash
-                + " and id: "
-                + file_id
-                + " to keep things atomic"
-            )
-            for core_name in solr_cores:
-                try:
-                    solr_cores[core_name].delete(q="iati_activities_document_id:" + file_id)
-                except:
-                    logger.error(
-                        "Failed to remove docs with hash: "
-                        + file_hash
-                        + " and id: "
-                        + file_id
-                        + ", from collection with name "
-                        + core_name
-                    )
+            # the docs already in Solr are left there, as any of the old generation that the new one hasn't
+            # replaced yet are deleted once a later solrize completes. The fingerprints are forgotten, so that
+            # will be a full reindex
+            db.deleteSolrFingerprints(conn, file_id)
         except Exception as e:
             sentry_sdk.capture_exception(e)
             message = "Unidentified ERROR with Solrizing hash: " + file_hash + " and id: " + file_id
@@ -332,134 +521,409 @@ def process_hash_list(document_datasets):
                 logger.warning(e.args[0])
             except:
                 pass
+        finally:
+            # end any requests left open by an error, rather than leaving them waiting for more docs
+            for write_buffer in write_buffers.values():
+                write_buffer.abort()
 
     conn.close()
 
 
 def get_explode_element_data(element_name, element_data, activity_data):
-    # copy
-    starting_data = activity_data.copy()
+    """Makes a Solr doc for each of an activity's explode elements, e.g. each of its transactions
+
+    Each doc has the element's own data, and the activity's data apart from the fields flattened from all of
+    the activity's explode elements of the same name. The activity's data is shared by the docs rather than
+    copied into each one, so they're read-only views.
 
-    # remove any keys from main data
-    for k in list(starting_data.keys()):
-        if k.startswith(element_name + "_"):
-            del starting_data[k]
+    :param str element_name: The name of the explode element
+    :param list element_data: The flattened data of each explode element
+    :param dict activity_data: The activity's Solr doc, including its id
+    :return: A list of the docs, as mappings
+    """
+    prefix = element_name + "_"
+    starting_data = {k: v for k, v in activity_data.items() if not k.startswith(prefix)}
 
-    # now process
     out = []
     for idx, e_d in enumerate(element_data):
-        this_data = starting_data.copy()
-        this_data.update(e_d)
         # The id should include the idx so that 2 items that are exactly the
         # same don't become 1 in the solr results
         # https://github.com/IATI/refresher/issues/266
-        this_data["id"] = utils.get_hash_for_identifier(json.dumps(this_data) + str(idx))
-        out.append(this_data)
+        # Only the element's own data is hashed, as the activity's is the same for all of them, and the
+        # activity's id is unique to the activity
+        row_id = utils.get_hash_for_identifier(json.dumps(e_d, sort_keys=True) + activity_data["id"] + str(idx))
+        out.append(ChainMap({"id": row_id}, e_d, starting_data))
 
-    # return
     return out
 
 
-def addToSolr(core_name, batch, file_hash, file_id):
-    """Code calling this should make sure an id element is already set in each doc."""
+def get_update_params(commit_within):
+    """Returns the query parameters of a request to a core's JSON update handler, see SolrUpdateStream"""
+    params = {"wt": "json"}
+    if commit_within:
+        params["commitWithin"] = commit_within
+    return params
 
-    clean_batch = []
 
-    for doc in batch:
-        cleanDoc = {}
+def serialise_doc(doc):
+    """Serialises a doc as JSON, with its keys sorted so the same doc always gives the same JSON"""
+    return json.dumps(doc, sort_keys=True, default=str)
 
-        for key in doc:
-            if doc[key] != "":
-                cleanDoc[key] = doc[key]
 
-        clean_batch.append(cleanDoc)
+def get_doc_fingerprint(doc):
+    """Fingerprints the activity or element data of a doc, i.e. everything apart from its DOCUMENT_FIELDS"""
+    activity_data = {key: value for key, value in doc.items() if key not in DOCUMENT_FIELDS}
+    return hashlib.sha1(serialise_doc(activity_data).encode("utf-8")).hexdigest()
 
-    batch = clean_batch
-    del clean_batch
 
-    try:
-        chunk_length = config["SOLRIZE"]["MAX_BATCH_LENGTH"]
-        if len(batch) > chunk_length:
+class SolrUpdateStream:
+    """One request to a Solr core's JSON update handler, with the docs streamed into its body as they're written
+
+    The request is sent on its own thread with a chunked body, which reads the docs from a queue of at most
+    STREAM_QUEUE_LENGTH docs, so only those are held in memory rather than the whole request. close() ends the
+    request, and raises a SolrError if it failed.
+
+    :param pysolr.Solr solr: The client for the core, whose session, URL and credentials are used
+    :param int commit_within: Milliseconds within which Solr should commit the docs, or None to leave it to the
+        core's autoCommit settings
+    """
+
+    def __init__(self, solr, commit_within=None):
+        self.queue = queue.Queue(maxsize=config["SOLRIZE"]["STREAM_QUEUE_LENGTH"])
+        self.response = None
+        self.error = None
+        params = get_update_params(commit_within)
+        self.thread = threading.Thread(target=self._send, args=(solr, params), daemon=True)
+        self.thread.start()
+
+    def _body(self):
+        yield b"["
+        first = True
+        while True:
+            doc_bytes = self.queue.get()
+            if doc_bytes is None:
+                break
+            if not first:
+                yield b","
+            first = False
+            yield doc_bytes
+        yield b"]"
+
+    def _send(self, solr, params):
+        try:
+            self.response = solr.get_session().post(
+                solr.url.rstrip("/") + "/update",
+                params=params,
+                data=self._body(),
+                headers={"Content-Type": "application/json"},
+                auth=solr.auth,
+                timeout=solr.timeout,
+            )
+        except Exception as e:
+            self.error = e
+
+    def _put(self, item):
+        # if the request has died it will stop reading the queue, so don't wait on it forever
+        while True:
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                if not self.thread.is_alive():
+                    self._raise_error()
+                    raise SolrError("Request ended before all the docs were sent")
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise SolrError(repr(self.error))
+        if self.response is not None and self.response.status_code != 200:
+            raise SolrError(
+                "Solr responded with an error (HTTP " + str(self.response.status_code) + "): " + self.response.text
+            )
+
+    def write(self, doc_bytes):
+        self._put(doc_bytes)
+
+    def close(self):
+        self._put(None)
+        self.thread.join()
+        self._raise_error()
+
+
+class SolrWriteBuffer:
+    """Streams the docs for one Solr core across all the activities of a document to Solr as they're added.
+
+    Each doc is serialised to JSON as it's added, skipping empty values, and written into the body of an update
+    request (see SolrUpdateStream). A request is ended, and the next doc starts a new one, once it has
+    MAX_BATCH_LENGTH docs or MAX_BATCH_BYTES bytes. Call flush() once all docs have been added to end the last
+    request. A failed request raises a SolrError. If COMMIT_WITHIN is set, each request asks Solr to commit its
+    docs within that many milliseconds, so commits are amortised across requests and documents.
+
+    Each doc is given the generation of the solrize (GENERATION_FIELD), and once all the docs have been sent
+    delete_older_generations() deletes the document's docs from earlier solrizes.
+
+    If previous_fingerprints is given (the fingerprints of the docs already in Solr for the document, by id), a
+    fingerprint is kept of every doc added (see get_doc_fingerprint), and delete_vanished() deletes the docs that
+    weren't added this time. Docs whose fingerprint hasn't changed aren't sent again. Only their DOCUMENT_FIELDS
+    and generation are set, with atomic updates, which need every field of the core's schema to be stored or
+    have docValues (see get_unstored_fields). These are sent in their own requests, rather than streamed, so the
+    docs can be added whole instead if Solr doesn't have one of them (see send_document_fields_updates).
+    """
+
+    def __init__(self, core_name, file_hash, file_id, generation, previous_fingerprints=None):
+        self.core_name = core_name
+        self.file_hash = file_hash
+        self.file_id = file_id
+        self.generation = generation
+        self.stream = None
+        self.batch_length = 0
+        self.batch_bytes = 0
+        self.previous_fingerprints = previous_fingerprints
+        self.fingerprints = {} if previous_fingerprints is not None else None
+        self.document_fields_updates = []
+        self.document_fields_updates_bytes = 0
+
+    def add(self, docs):
+        """Code calling this should make sure an id element is already set in each doc."""
+        for doc in docs:
+            # docs are serialised here, so callers are free to change them once added
+            clean_doc = {key: value for key, value in doc.items() if value != ""}
+            # the generation is added to the end of the serialised doc, which always has at least an id
+            doc_json = serialise_doc(clean_doc)
+            doc_bytes = (
+                doc_json[:-1] + ", " + json.dumps(GENERATION_FIELD) + ": " + str(self.generation) + "}"
+            ).encode("utf-8")
+            if self.fingerprints is not None:
+                fingerprint = get_doc_fingerprint(clean_doc)
+                self.fingerprints[clean_doc["id"]] = fingerprint
+                if self.previous_fingerprints.get(clean_doc["id"]) == fingerprint:
+                    self.add_document_fields_update(self.get_document_fields_update(clean_doc), doc_bytes)
+                    continue
+            self.write(doc_bytes)
+
+    def get_document_fields_update(self, clean_doc):
+        """Serialises an atomic update of a doc's DOCUMENT_FIELDS and generation, removing any it no longer has
+
+        _version_ 1 makes Solr reject the update if it doesn't have the doc, rather than make a doc of only these.
+        """
+        update = {field: {"set": clean_doc.get(field)} for field in DOCUMENT_FIELDS}
+        update[GENERATION_FIELD] = {"set": self.generation}
+        update["id"] = clean_doc["id"]
+        update["_version_"] = 1
+        return serialise_doc(update).encode("utf-8")
+
+    def add_document_fields_update(self, update_bytes, doc_bytes):
+        """Keeps an atomic update, and the whole doc in case Solr doesn't have it, until there's a batch to send"""
+        self.document_fields_updates.append((update_bytes, doc_bytes))
+        self.document_fields_updates_bytes += len(doc_bytes)
+        if (
+            len(self.document_fields_updates) >= config["SOLRIZE"]["MAX_BATCH_LENGTH"]
+            or self.document_fields_updates_bytes >= config["SOLRIZE"]["MAX_BATCH_BYTES"]
+        ):
+            self.send_document_fields_updates()
+
+    def send_document_fields_updates(self):
+        """Sends the atomic updates kept by add_document_fields_update in one request
+
+        If Solr doesn't have one of the docs (e.g. it was deleted from Solr since the last solrize), it rejects
+        that update with a version conflict (HTTP 409), and stops there. The whole docs are then all added instead,
+        which replaces any that were updated.
+        """
+        updates = self.document_fields_updates
+        self.document_fields_updates = []
+        self.document_fields_updates_bytes = 0
+        if len(updates) == 0:
+            return
+
+        solr = solr_cores[self.core_name]
+        try:
+            response = solr.get_session().post(
+                solr.url.rstrip("/") + "/update",
+                params=get_update_params(config["SOLRIZE"]["COMMIT_WITHIN"] or None),
+                data=b"[" + b",".join(update_bytes for update_bytes, _ in updates) + b"]",
+                headers={"Content-Type": "application/json"},
+                auth=solr.auth,
+                timeout=solr.timeout,
+            )
+        except Exception as e:
+            raise self.get_error(SolrError(repr(e)))
+        if response.status_code == 409:
             logger.info(
-                "Batch length of "
-                + str(len(batch))
-                + " "
-                + core_name
-                + " greater than "
-                + str(config["SOLRIZE"]["MAX_BATCH_LENGTH"])
-                + " for hash: "
-                + file_hash
-                + " id: "
-                + file_id
+                "Adding whole docs as Solr is missing some unchanged docs for hash: "
+                + self.file_hash
+                + " and id: "
+                + self.file_id
+                + ", from collection with name "
+                + self.core_name
             )
-            for i in range(0, len(batch), chunk_length):
-                solr_cores[core_name].add(batch[i : i + chunk_length])
-        else:
-            solr_cores[core_name].add(batch)
-    except Exception as e:
+            for _, doc_bytes in updates:
+                self.write(doc_bytes)
+        elif response.status_code != 200:
+            raise self.get_error(
+                SolrError("Solr responded with an error (HTTP " + str(response.status_code) + "): " + response.text)
+            )
+
+    def write(self, doc_bytes):
+        try:
+            if self.stream is None:
+                self.stream = SolrUpdateStream(solr_cores[self.core_name], config["SOLRIZE"]["COMMIT_WITHIN"] or None)
+            self.stream.write(doc_bytes)
+        except Exception as e:
+            error = self.get_error(e)
+            self.abort()
+            raise error
+        self.batch_length += 1
+        self.batch_bytes += len(doc_bytes)
+
+        if (
+            self.batch_length >= config["SOLRIZE"]["MAX_BATCH_LENGTH"]
+            or self.batch_bytes >= config["SOLRIZE"]["MAX_BATCH_BYTES"]
+        ):
+            self.flush()
+
+    def flush(self):
+        self.send_document_fields_updates()
+        if self.stream is None:
+            return
+
+        stream = self.stream
+        self.stream = None
+        try:
+            stream.close()
+        except Exception as e:
+            raise self.get_error(e)
+        finally:
+            self.batch_length = 0
+            self.batch_bytes = 0
+
+    def abort(self):
+        """Ends the current request without raising, for when the document's docs won't all be added anyway
+
+        Any docs already written to the request are still added, as with earlier requests, and are replaced or
+        deleted by a later solrize of the document.
+        """
+        self.document_fields_updates = []
+        self.document_fields_updates_bytes = 0
+        try:
+            self.flush()
+        except SolrError:
+            pass
+
+    def get_error(self, e):
         e_message = ""
-        if hasattr(e, "args"):
+        if hasattr(e, "args") and len(e.args) > 0:
             e_message = e.args[0]
-        raise SolrError(
+        return SolrError(
             "ADDING hash: "
-            + file_hash
+            + self.file_hash
             + " and id: "
-            + file_id
+            + self.file_id
             + " batch length: "
-            + str(len(batch))
+            + str(self.batch_length)
             + ", from collection with name "
-            + core_name
+            + self.core_name
             + ": "
             + e_message
         )
 
+    def delete_older_generations(self):
+        """Deletes the document's docs that aren't from this generation, i.e. weren't added by this solrize"""
+        try:
+            solr_cores[self.core_name].delete(
+                q="iati_activities_document_id:"
+                + self.file_id
+                + " AND -"
+                + GENERATION_FIELD
+                + ":"
+                + str(self.generation)
+            )
+        except Exception as e:
+            e_message = e.args[0] if hasattr(e, "args") else ""
+            raise SolrError(
+                "DELETING older generations for hash: "
+                + self.file_hash
+                + " and id: "
+                + self.file_id
+                + ", from collection with name "
+                + self.core_name
+                + ": "
+                + e_message
+            )
+
+    def delete_vanished(self):
+        """Deletes the docs with previous fingerprints that weren't added this time"""
+        if self.fingerprints is None:
+            return
+
+        vanished_ids = [solr_id for solr_id in self.previous_fingerprints if solr_id not in self.fingerprints]
+        for i in range(0, len(vanished_ids), config["SOLRIZE"]["MAX_BATCH_LENGTH"]):
+            try:
+                solr_cores[self.core_name].delete(id=vanished_ids[i : i + config["SOLRIZE"]["MAX_BATCH_LENGTH"]])
+            except Exception as e:
+                e_message = e.args[0] if hasattr(e, "args") else ""
+                raise SolrError(
+                    "DELETING vanished docs for hash: "
+                    + self.file_hash
+                    + " and id: "
+                    + self.file_id
+                    + ", from collection with name "
+                    + self.core_name
+                    + ": "
+                    + e_message
+                )
+
+    def get_fingerprints(self):
+        """Returns (core name, id, fingerprint) tuples for the docs added"""
+        return ((self.core_name, solr_id, fingerprint) for solr_id, fingerprint in self.fingerprints.items())
+
 
 def service_loop():
     logger.info("Start service loop")
 
+    listener = db.StageListener([db.DOCUMENT_FLATTENED_CHANNEL, db.DOCUMENT_LAKIFIED_CHANNEL])
+
     while True:
         main()
-        time.sleep(60)
+        listener.wait(config["SERVICE_LOOP_MAX_WAIT"])
+
+
+def process_claimed_datasets(run_started):
+    """Claims and processes unsolrized datasets until there are none left, see db.iterateClaimed"""
+    process_hash_list(
+        db.iterateClaimed(
+            db.claimUnsolrizedDatasets, config["DB_CLAIM_BATCH_SIZE"], config["DB_CLAIM_LEASE_SECONDS"], run_started
+        )
+    )
 
 
 def main():
     logger.info("Starting to Solrize...")
 
+    run_started = datetime.now()
+
     conn = db.getDirectConnection()
 
     logger.info("Got DB connection")
 
-    file_hashes = db.getUnsolrizedDatasets(conn)
+    num_datasets = db.getNumUnsolrizedDatasets(conn, config["DB_CLAIM_LEASE_SECONDS"], run_started)
 
-    set_prom_metric("datasets_to_solrize", len(file_hashes))
+    set_prom_metric("datasets_to_solrize", num_datasets)
 
     logger.info("Got unsolrized datasets")
 
     if config["SOLRIZE"]["PARALLEL_PROCESSES"] == 1:
-        logger.info("Solrizing " + str(len(file_hashes)) + " IATI docs in a a single process")
-        process_hash_list(file_hashes)
+        logger.info("Solrizing " + str(num_datasets) + " IATI docs in a a single process")
+        process_claimed_datasets(run_started)
     else:
-        chunked_hash_lists = list(utils.chunk_list(file_hashes, config["SOLRIZE"]["PARALLEL_PROCESSES"]))
-
-        processes = []
-
         logger.info(
             "Solrizing "
-            + str(len(file_hashes))
+            + str(num_datasets)
             + " IATI docs in a maximum of "
             + str(config["SOLRIZE"]["PARALLEL_PROCESSES"])
             + " parallel processes"
         )
 
-        for chunk in chunked_hash_lists:
-            if len(chunk) == 0:
-                continue
-            process = Process(target=process_hash_list, args=(chunk,))
-            process.start()
-            processes.append(process)
-
-        for process in processes:
-            process.join()
+        utils.run_in_processes(process_claimed_datasets, (run_started,), config["SOLRIZE"]["PARALLEL_PROCESSES"])
 
     conn.close()
     logger.info("Finished.")
@@ -1,6 +1,11 @@
+import codecs
 import datetime
 import hashlib
+import multiprocessing
 import re
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any
 
 import chardet
@@ -10,51 +15,280 @@ from library.logger import getLogger
 logger = getLogger("utils")
 
 
-def get_text_from_blob(downloader, file_hash, with_encoding=False):
-    # save off bytes if we need to detect charset later
-    downloadBytes = downloader.content_as_bytes()
+# Blob metadata key the charset of a blob is cached under, so it's only detected once per blob
+CHARSET_METADATA_KEY = "charset"
+
+# Byte order marks, longest first as the UTF-32 LE BOM starts with the UTF-16 LE one
+BOMS = [
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+]
+
+XML_DECLARATION_ENCODING = re.compile(rb"""^\s*<\?xml[^>]*?encoding\s*=\s*["']([A-Za-z][A-Za-z0-9._-]*)["']""")
+
+
+def get_utf8_bytes_from_blob(downloader, file_hash):
+    """Returns a downloaded blob's content as UTF-8 bytes, along with the charset it was in
+
+    Content that's already UTF-8 is returned as it is, without decoding it, and anything else is decoded once.
+    """
+    charset = get_cached_charset(downloader)
+    blob_bytes = downloader.content_as_bytes()
+    if charset is not None:
+        try:
+            return (get_utf8_bytes(blob_bytes, charset), charset)
+        except (UnicodeDecodeError, LookupError):
+            logger.warning("Cached charset " + charset + " does not decode file with hash " + file_hash)
+    charset = get_charset_for_bytes(blob_bytes, file_hash)
+    return (get_utf8_bytes(blob_bytes, charset), charset)
+
+
+def get_utf8_bytes(blob_bytes, charset):
+    if codecs.lookup(charset).name == "utf-8":
+        return blob_bytes
+    return blob_bytes.decode(charset).encode("utf-8")
+
+
+def get_cached_charset(downloader):
+    """Returns the charset cached in a downloaded blob's metadata by cache_charset, or None"""
+    return (downloader.properties.metadata or {}).get(CHARSET_METADATA_KEY)
+
+
+def cache_charset(blob_client, charset):
+    """Caches the charset of a blob in its metadata, for get_cached_charset
+
+    The metadata is kept when the blob is copied, e.g. from the source to the clean container.
+    """
+    blob_client.set_blob_metadata({CHARSET_METADATA_KEY: charset})
+
+
+def get_text_from_bytes(blob_bytes, file_hash, with_encoding=False):
     try:
         if with_encoding:
-            return (downloader.content_as_text(), "utf-8")
-        return downloader.content_as_text()
-    except UnicodeDecodeError:
+            return (blob_bytes.decode("utf-8"), "utf-8")
+        return blob_bytes.decode("utf-8")
+    except UnicodeDecodeError as e:
         logger.info("File is not UTF-8, trying to detect encoding for file with hash " + file_hash)
-        pass
+        invalid_offset = e.start
 
     # If not UTF-8 try to detect charset and decode
     try:
-        detect_result = chardet.detect(downloadBytes)
-        charset = detect_result["encoding"]
-        if charset:
-            logger.info(
-                "Charset detected: "
-                + charset
-                + " Confidence: "
-                + str(detect_result["confidence"])
-                + " Language: "
-                + detect_result["language"]
-                + " for file with hash "
-                + file_hash
-            )
-            if with_encoding:
-                return (downloader.content_as_text(encoding=charset), charset)
-            return downloader.content_as_text(encoding=charset)
-        logger.warning("No Charset detected for file with hash " + file_hash + ". Likely a non-text file.")
+        charset = detect_non_utf8_charset(blob_bytes, invalid_offset, file_hash)
+        if with_encoding:
+            return (blob_bytes.decode(charset), charset)
+        return blob_bytes.decode(charset)
+    except (ValueError, LookupError):
+        # detect_charset raises a ValueError if it can't find a charset, and UnicodeDecodeError is one too
+        logger.warning("Could not determine charset to decode for file with hash " + file_hash)
         raise
-    except:
+
+
+def get_charset_for_bytes(blob_bytes, file_hash):
+    """Works out the charset of some bytes without decoding them into a str
+
+    Returns "utf-8" if the bytes are valid UTF-8, otherwise the charset detected by detect_non_utf8_charset.
+    """
+    invalid_offset = get_invalid_utf8_offset(blob_bytes)
+    if invalid_offset is None:
+        return "utf-8"
+
+    logger.info("File is not UTF-8, trying to detect encoding for file with hash " + file_hash)
+
+    try:
+        return detect_non_utf8_charset(blob_bytes, invalid_offset, file_hash)
+    except (ValueError, LookupError):
+        # detect_charset raises a ValueError if it can't find a charset, and UnicodeDecodeError is one too
         logger.warning("Could not determine charset to decode for file with hash " + file_hash)
         raise
 
 
+def get_invalid_utf8_offset(blob_bytes, chunk_size=1024 * 1024):
+    """Returns the (approximate) offset of the first byte that isn't valid UTF-8, or None if they all are"""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    blob_view = memoryview(blob_bytes)
+    i = 0
+    try:
+        for i in range(0, len(blob_view), chunk_size):
+            decoder.decode(blob_view[i : i + chunk_size])
+        decoder.decode(b"", final=True)
+    except UnicodeDecodeError as e:
+        return min(i + e.start, len(blob_view) - 1)
+    return None
+
+
+def sniff_charset(blob_bytes):
+    """Returns the charset given by a BOM or the XML declaration at the start of the bytes, or None"""
+    for bom, charset in BOMS:
+        if blob_bytes[: len(bom)] == bom:
+            return charset
+
+    declaration = XML_DECLARATION_ENCODING.match(blob_bytes[:1024])
+    if declaration is None:
+        return None
+    charset = declaration.group(1).decode("ascii")
+    try:
+        codecs.lookup(charset)
+    except LookupError:
+        return None
+    return charset
+
+
+def detect_non_utf8_charset(blob_bytes, invalid_offset, file_hash, sample_size=64 * 1024):
+    """Detects the charset of bytes that aren't valid UTF-8
+
+    This uses the BOM or XML declaration if there is one (and it doesn't claim UTF-8), otherwise runs chardet
+    on a sample of the bytes around the first one that isn't valid UTF-8, rather than the whole thing.
+    """
+    charset = sniff_charset(blob_bytes)
+    if charset is not None and codecs.lookup(charset).name != "utf-8":
+        logger.info("Charset declared: " + charset + " for file with hash " + file_hash)
+        return charset
+
+    sample_start = max(invalid_offset - sample_size // 2, 0)
+    return detect_charset(blob_bytes[sample_start : sample_start + sample_size], file_hash)
+
+
+def detect_charset(blob_bytes, file_hash):
+    detect_result = chardet.detect(blob_bytes)
+    charset = detect_result["encoding"]
+    if charset:
+        logger.info(
+            "Charset detected: "
+            + charset
+            + " Confidence: "
+            + str(detect_result["confidence"])
+            + " Language: "
+            + detect_result["language"]
+            + " for file with hash "
+            + file_hash
+        )
+        return charset
+    logger.warning("No Charset detected for file with hash " + file_hash + ". Likely a non-text file.")
+    raise ValueError("No charset detected for file with hash " + file_hash)
+
+
 def get_hash_for_identifier(id):
     identifier_hash = hashlib.sha1()
     identifier_hash.update(id.encode())
     return identifier_hash.hexdigest()
 
 
-def chunk_list(a_list, n):
-    for i in range(0, n):
-        yield a_list[i::n]
+def run_in_processes(process_function, args, parallel_processes):
+    """Runs process_function(*args) in parallel_processes worker processes, and waits for them all to finish"""
+    processes = []
+    for _ in range(parallel_processes):
+        process = multiprocessing.Process(target=process_function, args=args)
+        process.start()
+        processes.append(process)
+
+    for process in processes:
+        process.join()
+
+
+class ChunkReader:
+    """A file-like object that reads from an iterable of bytes chunks, e.g. a blob downloader's chunks()
+
+    read() returns at most the rest of the current chunk, so chunks are never joined together.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.chunk = b""
+        self.offset = 0
+
+    def read(self, size=-1):
+        while self.offset >= len(self.chunk):
+            try:
+                self.chunk = next(self.chunks)
+            except StopIteration:
+                return b""
+            self.offset = 0
+        if size is None or size < 0:
+            size = len(self.chunk) - self.offset
+        data = self.chunk[self.offset : self.offset + size]
+        self.offset += len(data)
+        return data
+
+
+class StagedBlockBlobWriter:
+    """A file-like object that uploads to a block blob a block at a time, so the whole blob is never in memory
+
+    Nothing is visible in the blob until commit() is called, which replaces any existing blob.
+    """
+
+    def __init__(self, blob_client, block_size=4 * 1024 * 1024):
+        self.blob_client = blob_client
+        self.block_size = block_size
+        # block ids must all be the same length, and be unique to this upload as uncommitted blocks are per blob
+        self.block_id_prefix = uuid.uuid4().hex
+        self.block_ids = []
+        self.buffer = bytearray()
+        self.length = 0
+
+    def write(self, data):
+        self.buffer += data
+        self.length += len(data)
+        while len(self.buffer) >= self.block_size:
+            self._stage_block(bytes(self.buffer[: self.block_size]))
+            del self.buffer[: self.block_size]
+        return len(data)
+
+    def _stage_block(self, data):
+        block_id = "{}{:08d}".format(self.block_id_prefix, len(self.block_ids))
+        self.blob_client.stage_block(block_id, data, length=len(data))
+        self.block_ids.append(block_id)
+
+    def commit(self, **kwargs):
+        """Stages anything still buffered and commits the blob. kwargs are passed to commit_block_list"""
+        if self.buffer:
+            self._stage_block(bytes(self.buffer))
+            self.buffer = bytearray()
+        return self.blob_client.commit_block_list(self.block_ids, **kwargs)
+
+
+class BoundedExecutor:
+    """A thread pool whose submit() blocks while max_pending tasks are already queued or running
+
+    This gives backpressure to the code feeding the pool, so it can't get too far ahead of the workers.
+    """
+
+    def __init__(self, max_workers, max_pending, initializer=None):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, initializer=initializer)
+        self.semaphore = threading.BoundedSemaphore(max(max_pending, max_workers))
+
+    def submit(self, fn, *args, **kwargs):
+        self.semaphore.acquire()
+        try:
+            future = self.executor.submit(fn, *args, **kwargs)
+        except BaseException:
+            self.semaphore.release()
+            raise
+        future.add_done_callback(lambda _: self.semaphore.release())
+        return future
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+        return False
+
+
+def raise_first_failure(futures, wait=False):
+    """Removes finished futures from the list, raising the exception of the first one that failed
+
+    If wait is True, waits for all of the futures to finish first.
+    """
+    for future in list(futures):
+        if wait or future.done():
+            future.result()
+            futures.remove(future)
 
 
 class TimeZoneFixedOffset(datetime.tzinfo):
@@ -1,8 +1,8 @@
+import gzip
 import json
-import time
+import threading
 import traceback
 from datetime import datetime, timedelta
-from multiprocessing import Process
 
 import requests
 import sentry_sdk
@@ -13,238 +13,342 @@ from azure.storage.queue import QueueServiceClient
 import library.db as db
 import library.utils as utils
 from constants.config import config
+from library.http import AdaptiveConcurrencyLimiter, requests_retry_session
 from library.logger import getLogger
 from library.prometheus import set_prom_metric
 
 logger = getLogger("validate")
 
+# The version of the validator that made the last full validation report the process has had (see
+# db.getValidatorVersion), kept across runs so validations can be reused from the start of the next one
+validator_version: dict[str, str | None] = {}
+
 
 def process_hash_list(document_datasets):
+    """Validates documents on a pool of threads, which share a pool of keep-alive connections to the validator
 
-    conn = db.getDirectConnection()
-    now = datetime.now()
+    The number of requests in flight to the validator starts at CONCURRENCY, and adapts to how the validator
+    copes, up to MAX_CONCURRENCY (see AdaptiveConcurrencyLimiter). Each thread has its own DB connection.
 
-    for file_data in document_datasets:
-        try:
-            file_hash = file_data[0]
-            downloaded = file_data[1]
-            file_id = file_data[2]
-            file_url = file_data[3]
-            publisher = file_data[4]
-            publisher_name = file_data[5]
-            file_schema_valid = file_data[6]
-            publisher_black_flag = file_data[7] is not None
-
-            if file_schema_valid is False and downloaded > (
-                now - timedelta(hours=config["VALIDATION"]["SAFETY_CHECK_PERIOD"])
-            ):
-                logger.info(
-                    "Skipping Schema Invalid file for Full Validation until "
-                    f"{config['VALIDATION']['SAFETY_CHECK_PERIOD']}hrs after download: "
-                    f"{downloaded.isoformat()} for hash: {file_hash} and id: {file_id}"
-                )
-                continue
+    Validations of the same content are only reused once a report from the validator has shown the process which
+    version of it is running (see validator_version), and only if they were made by that version.
+    """
+    max_concurrency = config["VALIDATION"]["MAX_CONCURRENCY"]
+    session = requests_retry_session(retries=3, pool_maxsize=max_concurrency)
+    limiter = AdaptiveConcurrencyLimiter(config["VALIDATION"]["CONCURRENCY"], max_concurrency)
+    now = datetime.now()
+    thread_data = threading.local()
+    connections = []
 
-            if file_schema_valid is False and publisher_black_flag is True:
-                logger.info(
-                    "Skipping Schema Invalid file for Full Validation since publisher: "
-                    f"{publisher} is black flagged for hash: {file_hash} and id: {file_id}"
-                )
-                continue
+    def connect():
+        thread_data.conn = db.getDirectConnection()
+        connections.append(thread_data.conn)
 
-            blob_name = file_hash + ".xml"
+    def process(file_data):
+        process_document(thread_data.conn, session, limiter, validator_version, now, file_data)
 
-            blob_service_client = BlobServiceClient.from_connection_string(config["STORAGE_CONNECTION_STR"])
-            blob_client = blob_service_client.get_blob_client(
-                container=config["SOURCE_CONTAINER_NAME"], blob=blob_name
+    try:
+        # documents are only taken from document_datasets as there's room for them, so they're only claimed
+        # (see db.iterateClaimed) shortly before they're processed
+        with utils.BoundedExecutor(max_concurrency, max_concurrency, initializer=connect) as executor:
+            futures = []
+            for file_data in document_datasets:
+                futures.append(executor.submit(process, file_data))
+                utils.raise_first_failure(futures)
+            utils.raise_first_failure(futures, wait=True)
+    finally:
+        for conn in connections:
+            conn.close()
+        session.close()
+
+
+def process_document(conn, session, limiter, validator_version, now, file_data):
+    """Validates one document, recording the outcome in the DB on conn
+
+    validator_version is shared by the documents being validated, and is updated from each full validation
+    report, see the module's validator_version.
+    """
+    try:
+        file_hash = file_data[0]
+        downloaded = file_data[1]
+        file_id = file_data[2]
+        file_url = file_data[3]
+        publisher = file_data[4]
+        publisher_name = file_data[5]
+        file_schema_valid = file_data[6]
+        publisher_black_flag = file_data[7] is not None
+        regenerate_validation_report = file_data[8]
+
+        if file_schema_valid is False and downloaded > (
+            now - timedelta(hours=config["VALIDATION"]["SAFETY_CHECK_PERIOD"])
+        ):
+            logger.info(
+                "Skipping Schema Invalid file for Full Validation until "
+                f"{config['VALIDATION']['SAFETY_CHECK_PERIOD']}hrs after download: "
+                f"{downloaded.isoformat()} for hash: {file_hash} and id: {file_id}"
             )
+            db.releaseValidationClaim(conn, file_id)
+            return
 
-            downloader = blob_client.download_blob()
-
-            try:
-                payload = utils.get_text_from_blob(downloader, file_hash)
-            except:
-                logger.warning(f"Could not identify charset for hash: {file_hash} and id: {file_id}")
-                continue
-
-            if file_schema_valid is None:
-                logger.info(f"Schema Validating file hash: {file_hash} and id: {file_id}")
-                schema_headers = {
-                    config["VALIDATION"]["SCHEMA_VALIDATION_KEY_NAME"]: config["VALIDATION"][
-                        "SCHEMA_VALIDATION_KEY_VALUE"
-                    ]
-                }
-                schema_response = requests.post(
-                    config["VALIDATION"]["SCHEMA_VALIDATION_URL"],
-                    data=payload.encode("utf-8"),
-                    headers=schema_headers,
-                    timeout=config["VALIDATION"]["SCHEMA_VALIDATION_TIMEOUT"],
-                )
-                db.updateValidationRequestDate(conn, file_id)
-
-                if schema_response.status_code != 200:
-                    if schema_response.status_code >= 400 and schema_response.status_code < 500:  # client errors
-                        # log in db and 'continue' to break out of for loop for this file
-                        db.updateValidationError(conn, file_id, schema_response.status_code)
-                        logger.warning(
-                            f"Schema Validator reports Client Error HTTP {schema_response.status_code} "
-                            f"for hash: {file_hash} and id: {file_id}"
-                        )
-                        continue
-                    elif schema_response.status_code >= 500:  # server errors
-                        # log in db and 'continue' to break out of for loop for this file
-                        db.updateValidationError(conn, file_id, schema_response.status_code)
-                        logger.warning(
-                            f"Schema Validator reports Server Error HTTP {schema_response.status_code} "
-                            f"for hash: {file_hash} and id: {file_id}"
-                        )
-                        continue
-                    else:
-                        logger.error(
-                            f"Schema Validator reports HTTP {schema_response.status_code} "
-                            f"for hash: {file_hash} and id: {file_id}"
-                        )
-                try:
-                    body = schema_response.json()
-                    if body["valid"] is True or body["valid"] is False:
-                        db.updateDocumentSchemaValidationStatus(conn, file_id, body["valid"])
-                        file_schema_valid = body["valid"]
-                    else:
-                        raise
-                except:
-                    logger.error(
-                        f"Unexpected response body from Schema validator for hash: {file_hash} and id: {file_id}"
+        if file_schema_valid is False and publisher_black_flag is True:
+            logger.info(
+                "Skipping Schema Invalid file for Full Validation since publisher: "
+                f"{publisher} is black flagged for hash: {file_hash} and id: {file_id}"
+            )
+            db.releaseValidationClaim(conn, file_id)
+            return
+
+        # the same content may have been validated already, e.g. if the dataset moved URL or was re-added
+        if not regenerate_validation_report and len(validator_version) > 0:
+            cached_validation = db.getCachedValidation(conn, file_hash, validator_version)
+            if cached_validation is not None:
+                validation_id, cached_schema_valid = cached_validation
+                if cached_schema_valid is False and (
+                    publisher_black_flag is True
+                    or downloaded > (now - timedelta(hours=config["VALIDATION"]["SAFETY_CHECK_PERIOD"]))
+                ):
+                    logger.info(
+                        "Skipping Schema Invalid file for reusing validation until the safety check allows "
+                        f"Full Validation for hash: {file_hash} and id: {file_id}"
                     )
-                    continue
-
-            if file_schema_valid is False and downloaded > (
-                now - timedelta(hours=config["VALIDATION"]["SAFETY_CHECK_PERIOD"])
-            ):
+                    db.updateDocumentSchemaValidationStatus(conn, file_id, False)
+                    db.releaseValidationClaim(conn, file_id)
+                    return
                 logger.info(
-                    "Skipping Schema Invalid file for Full Validation until "
-                    f"{config['VALIDATION']['SAFETY_CHECK_PERIOD']}hrs after "
-                    f"download: {downloaded.isoformat()} for hash: {file_hash} and id: {file_id}"
+                    f"Reusing validation id: {validation_id} of the same content for hash: {file_hash} "
+                    f"and id: {file_id}"
                 )
-                continue
+                db.reuseValidation(conn, file_id, file_url, publisher, publisher_name, validation_id)
+                return
 
-            if file_schema_valid is False and publisher_black_flag is True:
-                logger.info(
-                    f"Skipping Schema Invalid file for Full Validation since publisher: {publisher} "
-                    f"is flagged for hash: {file_hash} and id: {file_id}"
-                )
-                continue
+        # the place under the limit is taken before downloading, so the limit also bounds the documents in memory
+        with limiter.slot() as slot:
+            validate_document(conn, session, slot, validator_version, now, file_data)
 
-            logger.info(f"Full Validating file hash: {file_hash} and id: {file_id}")
+    except AzureExceptions.ResourceNotFoundError:
+        logger.warning(
+            f"Blob not found for hash: {file_hash} and id: {file_id} updating "
+            "as Not Downloaded for the refresher to pick up."
+        )
+        db.updateFileAsNotDownloaded(conn, file_id)
+    except Exception as e:
+        sentry_sdk.capture_exception(e)
+        logger.error(f"ERROR with validating {file_hash}")
+        print(traceback.format_exc())
+        if hasattr(e, "message"):
+            logger.error(e.message)
+        if hasattr(e, "msg"):
+            logger.error(e.msg)
+        try:
+            logger.warning(e.args[0])
+        except:
+            pass
 
-            full_headers = {
-                config["VALIDATION"]["FULL_VALIDATION_KEY_NAME"]: config["VALIDATION"]["FULL_VALIDATION_KEY_VALUE"]
-            }
 
-            full_url = config["VALIDATION"]["FULL_VALIDATION_URL"]
+def validate_document(conn, session, slot, validator_version, now, file_data):
+    """Schema and then fully validates a document with the Validator API, making the requests with slot"""
+    file_hash = file_data[0]
+    downloaded = file_data[1]
+    file_id = file_data[2]
+    file_url = file_data[3]
+    publisher = file_data[4]
+    publisher_name = file_data[5]
+    file_schema_valid = file_data[6]
+    publisher_black_flag = file_data[7] is not None
 
-            # only need meta=true for invalid files to "clean" them later
-            if file_schema_valid is False:
-                full_url += "?meta=true"
-            full_response = requests.post(
-                full_url,
-                data=payload.encode("utf-8"),
-                headers=full_headers,
-                timeout=config["VALIDATION"]["FULL_VALIDATION_TIMEOUT"],
-            )
-            db.updateValidationRequestDate(conn, file_id)
-
-            if full_response.status_code != 200:
-                # 'expected' error codes returned from Validator
-                if (
-                    full_response.status_code == 400
-                    or full_response.status_code == 413
-                    or full_response.status_code == 422
-                ):
-                    # log db and move on to save the validation report
-                    db.updateValidationError(conn, file_id, full_response.status_code)
-                elif full_response.status_code >= 400 and full_response.status_code < 500:  # unexpected client errors
-                    # log in db and 'continue' to break out of for loop for this file
-                    db.updateValidationError(conn, file_id, full_response.status_code)
-                    logger.warning(
-                        f"Full Validator reports Client Error HTTP {full_response.status_code} "
-                        f"for hash: {file_hash} and id: {file_id}"
-                    )
-                    continue
-                elif full_response.status_code >= 500:  # server errors
-                    # log in db and 'continue' to break out of for loop for this file
-                    db.updateValidationError(conn, file_id, full_response.status_code)
-                    logger.warning(
-                        f"Full Validator reports Server Error HTTP {full_response.status_code} "
-                        f"for hash: {file_hash} and id: {file_id}"
-                    )
-                    continue
-                else:
-                    logger.error(
-                        f"Full Validator reports HTTP {full_response.status_code} "
-                        f"for hash: {file_hash} and id: {file_id}"
-                    )
+    blob_name = file_hash + ".xml"
 
-            report = full_response.json()
+    blob_service_client = BlobServiceClient.from_connection_string(config["STORAGE_CONNECTION_STR"])
+    blob_client = blob_service_client.get_blob_client(container=config["SOURCE_CONTAINER_NAME"], blob=blob_name)
 
-            state = report.get("valid", None)
+    downloader = blob_client.download_blob()
 
-            db.updateValidationState(
-                conn, file_id, file_hash, file_url, publisher, state, json.dumps(report), publisher_name
-            )
+    try:
+        payload, charset = utils.get_utf8_bytes_from_blob(downloader, file_hash)
+    except:
+        logger.warning(f"Could not identify charset for hash: {file_hash} and id: {file_id}")
+        return
+
+    # cache the charset on the blob, and so on its copy in the clean container, so it isn't detected again
+    if utils.get_cached_charset(downloader) != charset:
+        try:
+            utils.cache_charset(blob_client, charset)
+        except AzureExceptions.AzureError as e:
+            logger.warning(f"Could not cache charset for hash: {file_hash} and id: {file_id}: {e}")
+
+    # the same body is sent to both validator APIs, so it's only compressed once
+    content_headers = {}
+    if config["VALIDATION"]["GZIP_REQUESTS"] == "yes":
+        payload = gzip.compress(payload, compresslevel=config["VALIDATION"]["GZIP_LEVEL"])
+        content_headers["Content-Encoding"] = "gzip"
+
+    if file_schema_valid is None:
+        logger.info(f"Schema Validating file hash: {file_hash} and id: {file_id}")
+        schema_headers = {
+            config["VALIDATION"]["SCHEMA_VALIDATION_KEY_NAME"]: config["VALIDATION"]["SCHEMA_VALIDATION_KEY_VALUE"],
+            **content_headers,
+        }
+        schema_response = slot.request(
+            session,
+            "POST",
+            config["VALIDATION"]["SCHEMA_VALIDATION_URL"],
+            data=payload,
+            headers=schema_headers,
+            timeout=config["VALIDATION"]["SCHEMA_VALIDATION_TIMEOUT"],
+        )
+        db.updateValidationRequestDate(conn, file_id)
+
+        if schema_response.status_code != 200:
+            if schema_response.status_code >= 400 and schema_response.status_code < 500:  # client errors
+                # log in db and 'return' to move on from this file
+                db.updateValidationError(conn, file_id, schema_response.status_code)
+                logger.warning(
+                    f"Schema Validator reports Client Error HTTP {schema_response.status_code} "
+                    f"for hash: {file_hash} and id: {file_id}"
+                )
+                return
+            elif schema_response.status_code >= 500:  # server errors
+                # log in db and 'return' to move on from this file
+                db.updateValidationError(conn, file_id, schema_response.status_code)
+                logger.warning(
+                    f"Schema Validator reports Server Error HTTP {schema_response.status_code} "
+                    f"for hash: {file_hash} and id: {file_id}"
+                )
+                return
+            else:
+                logger.error(
+                    f"Schema Validator reports HTTP {schema_response.status_code} "
+                    f"for hash: {file_hash} and id: {file_id}"
+                )
+        try:
+            body = schema_response.json()
+            if body["valid"] is True or body["valid"] is False:
+                db.updateDocumentSchemaValidationStatus(conn, file_id, body["valid"])
+                file_schema_valid = body["valid"]
+            else:
+                raise
+        except:
+            logger.error(f"Unexpected response body from Schema validator for hash: {file_hash} and id: {file_id}")
+            return
+
+    if file_schema_valid is False and downloaded > (
+        now - timedelta(hours=config["VALIDATION"]["SAFETY_CHECK_PERIOD"])
+    ):
+        logger.info(
+            "Skipping Schema Invalid file for Full Validation until "
+            f"{config['VALIDATION']['SAFETY_CHECK_PERIOD']}hrs after "
+            f"download: {downloaded.isoformat()} for hash: {file_hash} and id: {file_id}"
+        )
+        db.releaseValidationClaim(conn, file_id)
+        return
 
-        except AzureExceptions.ResourceNotFoundError:
+    if file_schema_valid is False and publisher_black_flag is True:
+        logger.info(
+            f"Skipping Schema Invalid file for Full Validation since publisher: {publisher} "
+            f"is flagged for hash: {file_hash} and id: {file_id}"
+        )
+        db.releaseValidationClaim(conn, file_id)
+        return
+
+    logger.info(f"Full Validating file hash: {file_hash} and id: {file_id}")
+
+    full_headers = {
+        config["VALIDATION"]["FULL_VALIDATION_KEY_NAME"]: config["VALIDATION"]["FULL_VALIDATION_KEY_VALUE"],
+        **content_headers,
+    }
+
+    full_url = config["VALIDATION"]["FULL_VALIDATION_URL"]
+
+    # only need meta=true for invalid files to "clean" them later
+    if file_schema_valid is False:
+        full_url += "?meta=true"
+    full_response = slot.request(
+        session,
+        "POST",
+        full_url,
+        data=payload,
+        headers=full_headers,
+        timeout=config["VALIDATION"]["FULL_VALIDATION_TIMEOUT"],
+    )
+    db.updateValidationRequestDate(conn, file_id)
+
+    if full_response.status_code != 200:
+        # 'expected' error codes returned from Validator
+        if full_response.status_code == 400 or full_response.status_code == 413 or full_response.status_code == 422:
+            # log db and move on to save the validation report
+            db.updateValidationError(conn, file_id, full_response.status_code)
+        elif full_response.status_code >= 400 and full_response.status_code < 500:  # unexpected client errors
+            # log in db and 'return' to move on from this file
+            db.updateValidationError(conn, file_id, full_response.status_code)
             logger.warning(
-                f"Blob not found for hash: {file_hash} and id: {file_id} updating "
-                "as Not Downloaded for the refresher to pick up."
+                f"Full Validator reports Client Error HTTP {full_response.status_code} "
+                f"for hash: {file_hash} and id: {file_id}"
+            )
+            return
+        elif full_response.status_code >= 500:  # server errors
+            # log in db and 'return' to move on from this file
+            db.updateValidationError(conn, file_id, full_response.status_code)
+            logger.warning(
+                f"Full Validator reports Server Error HTTP {full_response.status_code} "
+                f"for hash: {file_hash} and id: {file_id}"
+            )
+            return
+        else:
+            logger.error(
+                f"Full Validator reports HTTP {full_response.status_code} for hash: {file_hash} and id: {file_id}"
             )
-            db.updateFileAsNotDownloaded(conn, file_id)
-        except Exception as e:
-            sentry_sdk.capture_exception(e)
-            logger.error(f"ERROR with validating {file_hash}")
-            print(traceback.format_exc())
-            if hasattr(e, "message"):
-                logger.error(e.message)
-            if hasattr(e, "msg"):
-                logger.error(e.msg)
-            try:
-                logger.warning(e.args[0])
-            except:
-                pass
 
-    conn.close()
+    report = full_response.json()
+
+    state = report.get("valid", None)
+
+    if "apiVersion" in report:
+        validator_version.update(db.getValidatorVersion(report))
+
+    db.updateValidationState(
+        conn,
+        file_id,
+        file_hash,
+        file_url,
+        publisher,
+        state,
+        json.dumps(report),
+        publisher_name,
+        file_schema_valid,
+        full_response.status_code if full_response.status_code != 200 else None,
+    )
+
+
+def process_claimed_datasets(run_started):
+    """Claims and validates unvalidated datasets until there are none left, see db.iterateClaimed"""
+    process_hash_list(
+        db.iterateClaimed(
+            db.claimUnvalidatedDatasets, config["DB_CLAIM_BATCH_SIZE"], config["DB_CLAIM_LEASE_SECONDS"], run_started
+        )
+    )
 
 
 def validate():
     logger.info("Starting validation...")
 
+    run_started = datetime.now()
+
     conn = db.getDirectConnection()
 
-    file_hashes = db.getUnvalidatedDatasets(conn)
+    num_datasets = db.getNumUnvalidatedDatasets(conn, config["DB_CLAIM_LEASE_SECONDS"], run_started)
 
-    set_prom_metric("datasets_to_validate", len(file_hashes))
+    set_prom_metric("datasets_to_validate", num_datasets)
 
     if config["VALIDATION"]["PARALLEL_PROCESSES"] == 1:
-        logger.info(f"Processing {len(file_hashes)} IATI files in a single process for validation")
-        process_hash_list(file_hashes)
+        logger.info(f"Processing {num_datasets} IATI files in a single process for validation")
+        process_claimed_datasets(run_started)
     else:
-        chunked_hash_lists = list(utils.chunk_list(file_hashes, config["VALIDATION"]["PARALLEL_PROCESSES"]))
-
-        processes = []
-
         logger.info(
-            f"Processing {len(file_hashes)} IATI files in a maximum of "
+            f"Processing {num_datasets} IATI files in a maximum of "
             f"{config['VALIDATION']['PARALLEL_PROCESSES']} parallel processes for validation"
         )
 
-        for chunk in chunked_hash_lists:
-            if len(chunk) == 0:
-                continue
-            process = Process(target=process_hash_list, args=(chunk,))
-            process.start()
-            processes.append(process)
-
-        for process in processes:
-            process.join()
+        utils.run_in_processes(process_claimed_datasets, (run_started,), config["VALIDATION"]["PARALLEL_PROCESSES"])
 
     conn.close()
     logger.info("Finished validation.")
@@ -324,7 +428,9 @@ def safety_check():
 def service_loop():
     logger.info("Start service loop")
 
+    listener = db.StageListener([db.DOCUMENT_DOWNLOADED_CHANNEL])
+
     while True:
         safety_check()
         validate()
-        time.sleep(60)
+        listener.wait(config["SERVICE_LOOP_MAX_WAIT"])
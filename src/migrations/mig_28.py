@@ -0,0 +1,31 @@
+upgrade = """
+CREATE TABLE public.flattened_activity (
+    document_id character varying NOT NULL,
+    activity_index integer NOT NULL,
+    activity jsonb NOT NULL,
+    PRIMARY KEY (document_id, activity_index)
+);
+ALTER TABLE ONLY public.flattened_activity
+    ADD CONSTRAINT related_document FOREIGN KEY (document_id) REFERENCES public.document(id) ON DELETE CASCADE;
+INSERT INTO public.flattened_activity (document_id, activity_index, activity)
+    SELECT document.id, activities.activity_index - 1, activities.activity
+    FROM public.document,
+        jsonb_array_elements(document.flattened_activities) WITH ORDINALITY AS activities(activity, activity_index)
+    WHERE jsonb_typeof(document.flattened_activities) = 'array';
+ALTER TABLE public.document DROP COLUMN flattened_activities;
+"""
+downgrade = """
+ALTER TABLE public.document ADD COLUMN flattened_activities jsonb;
+UPDATE public.document
+SET flattened_activities = '[]'
+WHERE flatten_end IS NOT NULL;
+UPDATE public.document
+SET flattened_activities = activities.flattened_activities
+FROM (
+    SELECT document_id, jsonb_agg(activity ORDER BY activity_index) AS flattened_activities
+    FROM public.flattened_activity
+    GROUP BY document_id
+) AS activities
+WHERE document.id = activities.document_id;
+DROP TABLE public.flattened_activity;
+"""
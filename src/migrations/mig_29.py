@@ -0,0 +1,10 @@
+upgrade = """
+ALTER TABLE public.document ADD COLUMN cached_dataset_etag character varying;
+ALTER TABLE public.document ADD COLUMN cached_dataset_last_modified character varying;
+ALTER TABLE public.document ADD COLUMN cached_dataset_content_length bigint;
+"""
+downgrade = """
+ALTER TABLE public.document DROP COLUMN cached_dataset_etag;
+ALTER TABLE public.document DROP COLUMN cached_dataset_last_modified;
+ALTER TABLE public.document DROP COLUMN cached_dataset_content_length;
+"""
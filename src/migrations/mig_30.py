@@ -0,0 +1,15 @@
+upgrade = """
+ALTER TABLE public.validation ADD COLUMN file_schema_valid BOOLEAN;
+ALTER TABLE public.validation ADD COLUMN validation_api_error INTEGER;
+UPDATE public.validation
+SET file_schema_valid = public.document.file_schema_valid,
+    validation_api_error = public.document.validation_api_error
+FROM public.document
+WHERE public.document.validation = public.validation.id;
+CREATE INDEX validation_document_hash ON public.validation USING btree (document_hash);
+"""
+downgrade = """
+DROP INDEX public.validation_document_hash;
+ALTER TABLE public.validation DROP COLUMN validation_api_error;
+ALTER TABLE public.validation DROP COLUMN file_schema_valid;
+"""
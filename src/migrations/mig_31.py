@@ -0,0 +1,14 @@
+upgrade = """
+CREATE TABLE public.solr_fingerprint (
+    document_id character varying NOT NULL,
+    core character varying NOT NULL,
+    solr_id character varying NOT NULL,
+    fingerprint character varying NOT NULL,
+    PRIMARY KEY (document_id, core, solr_id)
+);
+ALTER TABLE ONLY public.solr_fingerprint
+    ADD CONSTRAINT related_document FOREIGN KEY (document_id) REFERENCES public.document(id) ON DELETE CASCADE;
+"""
+downgrade = """
+DROP TABLE public.solr_fingerprint;
+"""
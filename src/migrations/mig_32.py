@@ -0,0 +1,6 @@
+upgrade = """
+ALTER TABLE public.document ADD COLUMN validation_start TIMESTAMP WITHOUT TIME ZONE;
+"""
+downgrade = """
+ALTER TABLE public.document DROP COLUMN validation_start;
+"""
@@ -0,0 +1,121 @@
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+import library.db as db
+from constants.config import config
+from tests.integration.common_setup_and_teardown import setup_and_teardown  # noqa: F401
+from tests.integration.utilities import get_dataset, get_db_connection
+
+LEASE_SECONDS = 60 * 60
+
+
+def add_document(conn, doc_id, **columns):
+    """Adds a downloaded document, with the given columns set"""
+    columns = {
+        "id": doc_id,
+        "hash": doc_id + "-hash",
+        "url": "https://example.org/" + doc_id + ".xml",
+        "first_seen": datetime.now(),
+        "last_seen": datetime.now(),
+        "downloaded": datetime.now(),
+        **columns,
+    }
+    with conn.cursor() as curs:
+        curs.execute(
+            "INSERT INTO document ({}) VALUES ({})".format(
+                ", ".join(columns), ", ".join("%(" + column + ")s" for column in columns)
+            ),
+            columns,
+        )
+    conn.commit()
+
+
+def add_flattened_document(conn, doc_id, **columns):
+    """Adds a document that has been validated, flattened and lakified, so is ready to be solrized"""
+    with conn.cursor() as curs:
+        curs.execute(
+            """
+            INSERT INTO validation (document_id, document_hash, document_url, created, valid, report)
+            VALUES (%(id)s, %(hash)s, %(url)s, %(now)s, true, %(report)s)
+            RETURNING id
+            """,
+            {
+                "id": doc_id,
+                "hash": doc_id + "-hash",
+                "url": "https://example.org/" + doc_id + ".xml",
+                "now": datetime.now(),
+                "report": json.dumps({"iatiVersion": "2.03", "fileType": "iati-activities"}),
+            },
+        )
+        validation_id = curs.fetchone()[0]
+    add_document(
+        conn,
+        doc_id,
+        validation=validation_id,
+        clean_end=datetime.now(),
+        flatten_end=datetime.now(),
+        lakify_end=datetime.now(),
+        **columns,
+    )
+    with conn.cursor() as curs:
+        curs.execute(
+            "INSERT INTO flattened_activity (document_id, activity_index, activity) VALUES (%s, 0, '{}')",
+            (doc_id,),
+        )
+    conn.commit()
+
+
+@pytest.mark.parametrize(
+    "setup_and_teardown", ["src/tests/integration/unified-pipeline-test-env-setup.env"], indirect=True
+)
+def test_solrize_retry_is_only_claimed_once(setup_and_teardown):  # noqa: F811
+    conn = get_db_connection(config)
+    add_flattened_document(
+        conn, "errored", solrize_start=datetime.now() - timedelta(minutes=5), solr_api_error="Solr Server Error"
+    )
+
+    first_claim = db.claimUnsolrizedDatasets(conn, 10, LEASE_SECONDS, datetime.now())
+
+    assert [document[1] for document in first_claim] == ["errored"]
+    assert first_claim[0][2] == "Solr Server Error"
+    assert get_dataset(config, "errored")["solr_api_error"] is None
+
+    # a run that started after the first claim, while the retry is still running
+    assert db.claimUnsolrizedDatasets(conn, 10, LEASE_SECONDS, datetime.now()) == []
+
+
+@pytest.mark.parametrize(
+    "setup_and_teardown", ["src/tests/integration/unified-pipeline-test-env-setup.env"], indirect=True
+)
+def test_validate_retries_only_errors_before_the_lease_expires(setup_and_teardown):  # noqa: F811
+    conn = get_db_connection(config)
+    add_document(conn, "errored", validation_start=datetime.now() - timedelta(minutes=5), validation_api_error=500)
+    add_document(conn, "started", validation_start=datetime.now() - timedelta(minutes=5))
+
+    first_claim = db.claimUnvalidatedDatasets(conn, 10, LEASE_SECONDS, datetime.now())
+
+    assert [document[2] for document in first_claim] == ["errored"]
+    assert get_dataset(config, "errored")["validation_api_error"] is None
+    assert db.claimUnvalidatedDatasets(conn, 10, LEASE_SECONDS, datetime.now()) == []
+
+
+@pytest.mark.parametrize(
+    "setup_and_teardown", ["src/tests/integration/unified-pipeline-test-env-setup.env"], indirect=True
+)
+def test_validate_claims_schema_invalid_documents_after_the_safety_check(setup_and_teardown):  # noqa: F811
+    conn = get_db_connection(config)
+    safety_check_period = timedelta(hours=config["VALIDATION"]["SAFETY_CHECK_PERIOD"])
+    add_document(conn, "waiting", file_schema_valid=False)
+    add_document(
+        conn,
+        "checked",
+        file_schema_valid=False,
+        downloaded=datetime.now() - safety_check_period - timedelta(minutes=5),
+    )
+
+    claimed = db.claimUnvalidatedDatasets(conn, 10, LEASE_SECONDS, datetime.now())
+
+    assert [document[2] for document in claimed] == ["checked"]
+    assert db.getNumUnvalidatedDatasets(conn, LEASE_SECONDS, datetime.now()) == 0
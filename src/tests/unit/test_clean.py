@@ -0,0 +1,85 @@
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import pytest
+from azure.core import exceptions as AzureExceptions
+from lxml import etree
+
+from library.clean import copy_batch, write_valid_activities
+from library.utils import ChunkReader
+
+DOCUMENT_XML = """<?xml version="1.0" encoding="ISO-8859-1"?>
+<iati-activities version="2.03" generated-datetime="2023-01-01T00:00:00" xmlns:x="http://example.org/x">
+ <iati-activity x:a="1"><iati-identifier>A</iati-identifier></iati-activity>
+ <iati-activity><iati-identifier>Bé</iati-identifier></iati-activity>
+ <iati-activity><iati-identifier>C</iati-identifier></iati-activity>
+</iati-activities>
+"""
+DOCUMENT = DOCUMENT_XML.encode("iso-8859-1")
+
+
+def test_write_valid_activities():
+    chunks = [DOCUMENT[i : i + 7] for i in range(0, len(DOCUMENT), 7)]
+    output = BytesIO()
+
+    assert 2 == write_valid_activities(ChunkReader(chunks), {1, 2}, output)
+
+    root = etree.fromstring(output.getvalue())
+    assert root.tag == "iati-activities"
+    assert root.attrib["version"] == "2.03"
+    assert root.attrib["generated-datetime"] == "2023-01-01T00:00:00"
+    assert ["Bé", "C"] == root.xpath("iati-activity/iati-identifier/text()")
+
+
+def test_write_valid_activities_drops_other_children_of_root():
+    document = b"""<?xml version="1.0"?>
+<x:root xmlns:x="http://example.org/x" version="2.03">
+ <!-- comment -->
+ <?pi data?>
+ <iati-activity><iati-identifier>A</iati-identifier></iati-activity>
+ <other><iati-activity><iati-identifier>nested</iati-identifier></iati-activity></other>
+ <iati-activity><iati-identifier>B</iati-identifier></iati-activity>
+</x:root>
+"""
+    output = BytesIO()
+
+    assert 1 == write_valid_activities(BytesIO(document), {1}, output)
+
+    root = etree.fromstring(output.getvalue())
+    assert root.tag == "{http://example.org/x}root"
+    assert root.attrib["version"] == "2.03"
+    assert ["iati-activity"] == [child.tag for child in root]
+    assert ["B"] == root.xpath("iati-activity/iati-identifier/text()")
+
+
+def test_write_valid_activities_syntax_error():
+    with pytest.raises(etree.XMLSyntaxError):
+        write_valid_activities(BytesIO(DOCUMENT[:-30]), {0}, BytesIO())
+    with pytest.raises(etree.XMLSyntaxError):
+        write_valid_activities(BytesIO(b""), {0}, BytesIO())
+
+
+def test_copy_batch(mocker):
+    mocker.patch("library.clean.time.sleep")
+    db = mocker.patch("library.clean.db")
+    copy_statuses = {
+        "a.xml": {"copy_status": "success"},
+        "b.xml": {"copy_status": "pending"},
+        "c.xml": AzureExceptions.ResourceNotFoundError(),
+    }
+
+    def get_blob_client(container, blob):
+        blob_client = mocker.Mock()
+        blob_client.start_copy_from_url.side_effect = [copy_statuses[blob]]
+        blob_client.get_blob_properties.return_value.copy.status = "success"
+        return blob_client
+
+    blob_service_client = mocker.Mock()
+    blob_service_client.get_blob_client.side_effect = get_blob_client
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        copy_batch(mocker.Mock(), blob_service_client, executor, [("a", "id-a"), ("b", "id-b"), ("c", "id-c")])
+
+    db.startCleanBatch.assert_called_once_with(mocker.ANY, ["id-a", "id-b", "id-c"])
+    db.updateFileAsNotDownloaded.assert_called_once_with(mocker.ANY, "id-c")
+    db.completeCleanBatch.assert_called_once_with(mocker.ANY, ["id-a", "id-b"])
@@ -1,5 +1,6 @@
 import json
 import os.path
+from io import BytesIO
 
 import pytest
 
@@ -49,6 +50,41 @@ def test_flattener(filename):
     assert expected == output
 
 
+@pytest.mark.parametrize("filename", FLATTENER_FILES)
+def test_flattener_bytes(filename):
+    xml_filename = os.path.join(
+        os.path.dirname(os.path.realpath(__file__)), "fixtures_flatten_flatterer", filename + ".input.xml"
+    )
+
+    with open(xml_filename, "rb") as fp:
+        xml_bytes = fp.read()
+
+    worker = Flattener()
+
+    assert json.dumps(worker.process(BytesIO(xml_bytes))) == json.dumps(worker.process(xml_filename))
+
+
+def test_flattener_encoding_override():
+    xml = '<iati-activities version="2.03"><iati-activity><title><narrative>Coop\u00e9ration</narrative></title>'
+    xml += "</iati-activity></iati-activities>"
+
+    worker = Flattener()
+    output = worker.process(BytesIO(xml.encode("windows-1252")), encoding="windows-1252")
+
+    assert output == [{"dataset_version": "2.03", "title_narrative": "Coop\u00e9ration"}]
+
+
+def test_flattener_iterate():
+    xml = '<iati-activities version="2.03"><iati-activity><iati-identifier>A</iati-identifier></iati-activity>'
+    xml += "<iati-activity><iati-identifier>B</iati-identifier></iati-activity></iati-activities>"
+
+    worker = Flattener()
+    activities = worker.iterate(BytesIO(xml.encode("utf-8")))
+
+    assert next(activities) == {"dataset_version": "2.03", "iati_identifier": "A"}
+    assert list(activities) == [{"dataset_version": "2.03", "iati_identifier": "B"}]
+
+
 FLATTENER_EXCEPTION_FILES = [("not-iati", "Non-IATI XML")]
 
 
@@ -0,0 +1,46 @@
+import pytest
+import requests
+
+from library.http import AdaptiveConcurrencyLimiter
+
+
+def test_adaptive_concurrency_limiter_grows_on_success(mocker):
+    session = mocker.Mock()
+    session.request.return_value = mocker.Mock(status_code=200)
+    limiter = AdaptiveConcurrencyLimiter(2, 3)
+
+    for _ in range(10):
+        limiter.request(session, "POST", "https://example.org")
+
+    assert limiter.limit == 3
+    assert limiter.in_flight == 0
+
+
+def test_adaptive_concurrency_limiter_backs_off_when_overloaded(mocker):
+    session = mocker.Mock()
+    session.request.side_effect = [mocker.Mock(status_code=429), mocker.Mock(status_code=503), requests.Timeout()]
+    limiter = AdaptiveConcurrencyLimiter(16, 16)
+
+    limiter.request(session, "POST", "https://example.org")
+    assert limiter.limit == 8
+    limiter.request(session, "POST", "https://example.org")
+    assert limiter.limit == 4
+    with pytest.raises(requests.Timeout):
+        limiter.request(session, "POST", "https://example.org")
+    assert limiter.limit == 2
+    assert limiter.in_flight == 0
+
+
+def test_adaptive_concurrency_limiter_slot_covers_several_requests(mocker):
+    session = mocker.Mock()
+    session.request.side_effect = [mocker.Mock(status_code=200), mocker.Mock(status_code=503)]
+    limiter = AdaptiveConcurrencyLimiter(4, 4)
+
+    with limiter.slot() as slot:
+        assert limiter.in_flight == 1
+        slot.request(session, "POST", "https://example.org/schema")
+        slot.request(session, "POST", "https://example.org/full")
+        assert limiter.in_flight == 1
+
+    assert limiter.limit == 2
+    assert limiter.in_flight == 0
@@ -0,0 +1,81 @@
+import threading
+
+import requests
+from azure.core import exceptions as AzureExceptions
+
+from library.refresher import download_dataset
+
+URL = "https://example.org/dataset.xml"
+
+
+def get_response(mocker, status_code, content=b"", headers=None):
+    response = mocker.MagicMock(status_code=status_code, headers=headers or {})
+    response.__enter__.return_value = response
+    response.iter_content.return_value = iter([content])
+    return response
+
+
+def test_download_dataset_not_modified(mocker):
+    session = mocker.Mock()
+    session.get.return_value = get_response(mocker, 304)
+    blob_service_client = mocker.Mock()
+    blob_client = blob_service_client.get_blob_client.return_value
+    blob_client.get_blob_properties.return_value.size = 100
+    host_semaphores = {"example.org": threading.BoundedSemaphore(1)}
+
+    result = download_dataset(
+        session, host_semaphores, blob_service_client, ("id", "hash", URL, '"etag"', "last modified", 100)
+    )
+
+    assert result == (None, None)
+    assert session.get.call_args.kwargs["headers"]["If-None-Match"] == '"etag"'
+    assert session.get.call_args.kwargs["headers"]["If-Modified-Since"] == "last modified"
+    blob_client.commit_block_list.assert_not_called()
+
+
+def test_download_dataset_not_modified_blob_missing(mocker):
+    session = mocker.Mock()
+    session.get.side_effect = [
+        get_response(mocker, 304),
+        get_response(mocker, 200, b"<iati-activities/>", {"ETag": '"new"'}),
+    ]
+    blob_service_client = mocker.Mock()
+    blob_client = blob_service_client.get_blob_client.return_value
+    blob_client.get_blob_properties.side_effect = AzureExceptions.ResourceNotFoundError()
+    host_semaphores = {"example.org": threading.BoundedSemaphore(1)}
+
+    result = download_dataset(
+        session, host_semaphores, blob_service_client, ("id", "hash", URL, '"etag"', "last modified", 100)
+    )
+
+    assert result == (None, {"etag": '"new"', "last_modified": None, "content_length": 18})
+    assert "If-None-Match" not in session.get.call_args.kwargs["headers"]
+    blob_client.commit_block_list.assert_called_once()
+
+
+def test_download_dataset_records_connection_errors(mocker):
+    clean_containers_by_id = mocker.patch("library.refresher.clean_containers_by_id")
+    session = mocker.Mock()
+    session.get.side_effect = requests.exceptions.SSLError()
+    host_semaphores = {"example.org": threading.BoundedSemaphore(1)}
+
+    result = download_dataset(session, host_semaphores, mocker.Mock(), ("id", "hash", URL, None, None, None))
+
+    assert result == (1, None)
+    clean_containers_by_id.assert_called_once()
+
+
+def test_download_dataset_retries_errors_with_a_conditional_request(mocker):
+    mocker.patch("library.refresher.clean_containers_by_id")
+    session = mocker.Mock()
+    session.get.side_effect = [get_response(mocker, 503), get_response(mocker, 304)]
+    blob_service_client = mocker.Mock()
+    blob_service_client.get_blob_client.return_value.get_blob_properties.return_value.size = 100
+    host_semaphores = {"example.org": threading.BoundedSemaphore(1)}
+    # the validators from the last download are kept when a download errors, see db.updateFileAsDownloadError
+    dataset = ("id", "hash", URL, '"etag"', "last modified", 100)
+
+    assert download_dataset(session, host_semaphores, blob_service_client, dataset) == (503, None)
+    assert download_dataset(session, host_semaphores, blob_service_client, dataset) == (None, None)
+
+    assert session.get.call_args.kwargs["headers"]["If-None-Match"] == '"etag"'
@@ -1,6 +1,19 @@
+import json
+
 import pytest
 
-from library.solrize import get_explode_element_data, validateLatLon
+import library.solrize as solrize
+from library.solrize import (
+    GENERATION_FIELD,
+    SolrConnections,
+    SolrError,
+    SolrPingError,
+    SolrWriteBuffer,
+    get_doc_fingerprint,
+    get_explode_element_data,
+    prefetch_lake_blobs,
+    validateLatLon,
+)
 
 
 def test_validateLatLon_pass_1():
@@ -35,18 +48,20 @@ GET_EXPLODE_ELEMENT_DATA = [
             # These fields of the activity are nothing to do with transactions
             # and should be copied to all output items.
             "iati_identifier": "ID",
+            # The id of the activity is used in the ids of the output items
+            "id": "doc--ID--0",
         },
         [
             {
                 "transaction_value": 100,
                 "transaction_sector_code": 1,
                 "iati_identifier": "ID",
-                "id": "8c9c0d8144b6a0a68b85d0d672c10f52afe290fc",
+                "id": "b750b665399a9380ad7a696bb2aff02e6e9a9f14",
             },
             {
                 "transaction_value": 200,
                 "iati_identifier": "ID",
-                "id": "721c2cd56dedbf5b8e11e21464bc381084ef70fb",
+                "id": "2e49ee6e7ad540578c147aad92491269890ac2ed",
             },
         ],
     ),
@@ -64,17 +79,18 @@ GET_EXPLODE_ELEMENT_DATA = [
         {
             "transaction_value": [100, 100],
             "iati_identifier": "ID",
+            "id": "doc--ID--0",
         },
         [
             {
                 "transaction_value": 100,
                 "iati_identifier": "ID",
-                "id": "8deb2daf9d100142370b844168e08e312fe400aa",
+                "id": "cfedf68fc5c7942e63b259cceb6a9bbcc11a413a",
             },
             {
                 "transaction_value": 100,
                 "iati_identifier": "ID",
-                "id": "71f347cd714d5fc249367dfbe5979fa33f9c0e14",
+                "id": "b72dc53f7cd75447888b7bbc2ba8ab8d0b711af1",
             },
         ],
     ),
@@ -85,3 +101,279 @@ GET_EXPLODE_ELEMENT_DATA = [
 def test_get_explode_element_data(element_name, element_data, activity_data, expected_output):
     out = get_explode_element_data(element_name, element_data, activity_data)
     assert out == expected_output
+
+
+def get_streaming_core(mocker, status_code=200, missing_ids=()):
+    """A mock Solr core whose update requests record the docs in their bodies, streamed or not
+
+    Atomic updates of docs with missing_ids are rejected with a version conflict, as Solr would.
+    """
+    core = mocker.Mock(url="http://solr/activity_solrize/", auth=None, timeout=10)
+    core.requests = []
+
+    def post(url, data, **kwargs):
+        docs = json.loads(data if isinstance(data, bytes) else b"".join(data))
+        core.requests.append(docs)
+        if any("_version_" in doc and doc["id"] in missing_ids for doc in docs):
+            return mocker.Mock(status_code=409, text="version conflict")
+        return mocker.Mock(status_code=status_code, text="error")
+
+    core.get_session.return_value.post.side_effect = post
+    return core
+
+
+def test_solr_write_buffer_batches_by_length(mocker):
+    core = get_streaming_core(mocker)
+    mocker.patch.dict(solrize.solr_cores, {"activity": core})
+    mocker.patch.dict(solrize.config["SOLRIZE"], {"MAX_BATCH_LENGTH": 2, "MAX_BATCH_BYTES": 1000000})
+
+    write_buffer = SolrWriteBuffer("activity", "hash", "id", 1)
+    write_buffer.add([{"id": "1"}, {"id": "2"}, {"id": "3", "empty": ""}])
+
+    assert core.requests == [[{"id": "1", GENERATION_FIELD: 1}, {"id": "2", GENERATION_FIELD: 1}]]
+
+    write_buffer.flush()
+
+    assert core.requests[1] == [{"id": "3", GENERATION_FIELD: 1}]
+    post = core.get_session.return_value.post
+    assert post.call_args.args[0] == "http://solr/activity_solrize/update"
+    assert post.call_args.kwargs["params"] == {"wt": "json"}
+
+
+def test_solr_write_buffer_batches_by_size(mocker):
+    core = get_streaming_core(mocker)
+    mocker.patch.dict(solrize.solr_cores, {"activity": core})
+    mocker.patch.dict(solrize.config["SOLRIZE"], {"MAX_BATCH_LENGTH": 500, "MAX_BATCH_BYTES": 10})
+
+    write_buffer = SolrWriteBuffer("activity", "hash", "id", 1)
+    write_buffer.add([{"id": "1", "text": "a long piece of text"}])
+
+    assert core.requests == [[{"id": "1", "text": "a long piece of text", GENERATION_FIELD: 1}]]
+
+
+def test_solr_write_buffer_commit_within(mocker):
+    core = get_streaming_core(mocker)
+    mocker.patch.dict(solrize.solr_cores, {"activity": core})
+    mocker.patch.dict(solrize.config["SOLRIZE"], {"COMMIT_WITHIN": 10000})
+
+    write_buffer = SolrWriteBuffer("activity", "hash", "id", 1)
+    write_buffer.add([{"id": "1"}])
+    write_buffer.flush()
+
+    assert core.get_session.return_value.post.call_args.kwargs["params"] == {"wt": "json", "commitWithin": 10000}
+
+
+def test_solr_write_buffer_raises_solr_error(mocker):
+    core = get_streaming_core(mocker, status_code=503)
+    mocker.patch.dict(solrize.solr_cores, {"activity": core})
+
+    write_buffer = SolrWriteBuffer("activity", "hash", "id", 1)
+    write_buffer.add([{"id": "1"}])
+
+    with pytest.raises(SolrError) as excinfo:
+        write_buffer.flush()
+
+    assert excinfo.value.status_code == 503
+
+
+def test_solr_write_buffer_raises_solr_error_if_request_dies(mocker):
+    core = mocker.Mock(url="http://solr/activity_solrize/", auth=None, timeout=10)
+    core.get_session.return_value.post.side_effect = Exception("Connection to solr timed out")
+    mocker.patch.dict(solrize.solr_cores, {"activity": core})
+    mocker.patch.dict(solrize.config["SOLRIZE"], {"STREAM_QUEUE_LENGTH": 1})
+
+    write_buffer = SolrWriteBuffer("activity", "hash", "id", 1)
+
+    with pytest.raises(SolrError) as excinfo:
+        write_buffer.add([{"id": "1"}, {"id": "2"}, {"id": "3"}])
+
+    assert excinfo.value.type == "Timeout"
+    assert write_buffer.stream is None
+
+
+def test_prefetch_lake_blobs(mocker):
+    def download_lake_blob(blob_service_client, blob_name):
+        if blob_name.startswith("doc/" + solrize.utils.get_hash_for_identifier("MISSING")):
+            raise Exception("BlobNotFound")
+        return blob_name.encode("utf-8")
+
+    mocker.patch("library.solrize.download_lake_blob", side_effect=download_lake_blob)
+    mocker.patch.dict(solrize.config["SOLRIZE"], {"LAKE_PREFETCH_MAX_IN_FLIGHT": 2})
+
+    activities = [{"iati_identifier": "A"}, {}, {"iati_identifier": "MISSING"}, {"iati_identifier": "B"}]
+
+    results = list(prefetch_lake_blobs(None, "doc", activities))
+
+    assert [item[0] for item in results] == activities
+    assert results[0][1] == solrize.utils.get_hash_for_identifier("A")
+    assert results[0][2].result() == "doc/{}.xml".format(results[0][1]).encode("utf-8")
+    assert results[0][3].result() == "doc/{}.json".format(results[0][1]).encode("utf-8")
+    assert results[1][1:] == (None, None, None)
+    with pytest.raises(Exception):
+        results[2][2].result()
+    assert results[3][2].result() == "doc/{}.xml".format(results[3][1]).encode("utf-8")
+
+
+def get_schema_core(mocker, schema_status_code=200, fields=()):
+    """A mock Solr core whose schema has GENERATION_FIELD, unless schema_status_code says otherwise, and fields"""
+    core = mocker.Mock(url="http://solr/activity_solrize/", auth=None, timeout=10)
+    core.schema_status_code = schema_status_code
+    schema = {
+        "fields/" + GENERATION_FIELD: {"field": {"name": GENERATION_FIELD, "type": "plong"}},
+        "fields": {"fields": list(fields)},
+        "dynamicfields": {"dynamicFields": []},
+        "copyfields": {"copyFields": [{"source": "title", "dest": "text"}]},
+    }
+
+    def get(url, **kwargs):
+        path = url.split("/schema/")[1]
+        status_code = core.schema_status_code if path.startswith("fields/") else 200
+        return mocker.Mock(status_code=status_code, json=mocker.Mock(return_value=schema.get(path)))
+
+    core.get_session.return_value.get.side_effect = get
+    return core
+
+
+def test_solr_connections_pings_on_interval_or_after_error(mocker):
+    mocker.patch.dict(solrize.config["SOLRIZE"], {"SOLR_PING_INTERVAL": 300})
+    monotonic = mocker.patch("library.solrize.time.monotonic", return_value=1000)
+    add_core = mocker.Mock(side_effect=lambda core_name, session: get_schema_core(mocker))
+    solr_connections = SolrConnections(add_core=add_core)
+
+    cores = solr_connections.get_cores("test")
+    solr_connections.get_cores("test")
+
+    assert set(cores) == {"activity", "transaction", "budget"}
+    assert add_core.call_count == 3
+    assert cores["activity"].ping.call_count == 1
+
+    monotonic.return_value = 1300
+    solr_connections.get_cores("test")
+    assert cores["activity"].ping.call_count == 2
+
+    solr_connections.mark_unhealthy()
+    cores["budget"].ping.side_effect = Exception("Connection refused")
+    with pytest.raises(SolrPingError):
+        solr_connections.get_cores("test")
+    assert solr_connections.last_ping is None
+
+
+def test_solr_write_buffer_only_sends_changed_docs(mocker):
+    core = get_streaming_core(mocker)
+    mocker.patch.dict(solrize.solr_cores, {"activity": core})
+    previous_fingerprints = {
+        "unchanged": get_doc_fingerprint({"id": "unchanged", "title": "a"}),
+        "changed": get_doc_fingerprint({"id": "changed", "title": "b"}),
+        "vanished": get_doc_fingerprint({"id": "vanished", "title": "c"}),
+    }
+
+    write_buffer = SolrWriteBuffer("activity", "hash", "id", 1, previous_fingerprints)
+    write_buffer.add([{"id": "unchanged", "title": "a", "empty": ""}, {"id": "changed", "title": "B"}, {"id": "new"}])
+    write_buffer.flush()
+    write_buffer.delete_vanished()
+
+    assert [doc["id"] for doc in core.requests[0]] == ["unchanged"]
+    assert "title" not in core.requests[0][0]
+    assert core.requests[1] == [
+        {"id": "changed", "title": "B", GENERATION_FIELD: 1},
+        {"id": "new", GENERATION_FIELD: 1},
+    ]
+    core.delete.assert_called_once_with(id=["vanished"])
+    assert {solr_id for _, solr_id, _ in write_buffer.get_fingerprints()} == {"unchanged", "changed", "new"}
+
+
+def test_solr_write_buffer_only_updates_document_fields_of_unchanged_activity(mocker):
+    core = get_streaming_core(mocker)
+    mocker.patch.dict(solrize.solr_cores, {"activity": core})
+    activity = {"id": "unchanged", "title": "a", "iati_xml": "<iati-activity/>"}
+    previous_fingerprints = {
+        "unchanged": get_doc_fingerprint(
+            {**activity, "iati_activities_document_hash": "old", "dataset_generated_datetime": "2020-01-01"}
+        )
+    }
+
+    write_buffer = SolrWriteBuffer("activity", "new", "id", 2, previous_fingerprints)
+    write_buffer.add([{**activity, "iati_activities_document_hash": "new", "dataset_version": "2.03"}])
+    write_buffer.flush()
+
+    assert core.requests == [
+        [
+            {
+                "id": "unchanged",
+                "iati_activities_document_hash": {"set": "new"},
+                "dataset_version": {"set": "2.03"},
+                "dataset_generated_datetime": {"set": None},
+                "dataset_linked_data_default": {"set": None},
+                GENERATION_FIELD: {"set": 2},
+                "_version_": 1,
+            }
+        ]
+    ]
+
+
+def test_solr_write_buffer_adds_whole_docs_missing_from_solr(mocker):
+    core = get_streaming_core(mocker, missing_ids=["deleted"])
+    mocker.patch.dict(solrize.solr_cores, {"activity": core})
+    previous_fingerprints = {
+        "unchanged": get_doc_fingerprint({"id": "unchanged", "title": "a"}),
+        "deleted": get_doc_fingerprint({"id": "deleted", "title": "b"}),
+    }
+
+    write_buffer = SolrWriteBuffer("activity", "hash", "id", 2, previous_fingerprints)
+    write_buffer.add([{"id": "unchanged", "title": "a"}, {"id": "deleted", "title": "b"}])
+    write_buffer.flush()
+
+    assert [doc["id"] for doc in core.requests[0]] == ["unchanged", "deleted"]
+    assert core.requests[1] == [
+        {"id": "unchanged", "title": "a", GENERATION_FIELD: 2},
+        {"id": "deleted", "title": "b", GENERATION_FIELD: 2},
+    ]
+
+
+def test_solr_write_buffer_delete_older_generations(mocker):
+    core = mocker.Mock()
+    mocker.patch.dict(solrize.solr_cores, {"activity": core})
+
+    write_buffer = SolrWriteBuffer("activity", "hash", "id", 2)
+    write_buffer.delete_older_generations()
+
+    core.delete.assert_called_once_with(q="iati_activities_document_id:id AND -" + GENERATION_FIELD + ":2")
+
+
+def test_solr_connections_checks_schema_has_generation_field(mocker):
+    cores = {"activity": get_schema_core(mocker), "budget": get_schema_core(mocker, schema_status_code=404)}
+    solr_connections = SolrConnections(cores)
+
+    with pytest.raises(SolrPingError) as excinfo:
+        solr_connections.get_cores("test")
+
+    assert GENERATION_FIELD in excinfo.value.message
+    schema_get = cores["activity"].get_session.return_value.get
+    assert schema_get.call_args.args[0] == "http://solr/activity_solrize/schema/fields/" + GENERATION_FIELD
+
+    cores["budget"].schema_status_code = 200
+    solr_connections.get_cores("test")
+    solr_connections.mark_unhealthy()
+    solr_connections.get_cores("test")
+
+    assert schema_get.call_count == 1
+
+
+def test_solr_connections_checks_schema_fields_are_stored_when_incremental(mocker):
+    mocker.patch.dict(solrize.config["SOLRIZE"], {"INCREMENTAL": "yes"})
+    fields = [
+        {"name": "id", "stored": True, "docValues": False},
+        {"name": "title", "stored": False, "docValues": True},
+        {"name": "text", "stored": False, "docValues": False},
+        {"name": "_root_", "stored": False, "docValues": False},
+        {"name": "description", "stored": False, "docValues": False},
+    ]
+    cores = {"activity": get_schema_core(mocker, fields=fields)}
+    solr_connections = SolrConnections(cores)
+
+    with pytest.raises(SolrPingError) as excinfo:
+        solr_connections.get_cores("test")
+
+    assert "Schema fields description must be" in excinfo.value.message
+    schema_get = cores["activity"].get_session.return_value.get
+    assert schema_get.call_args_list[1].kwargs["params"] == {"wt": "json", "showDefaults": "true"}
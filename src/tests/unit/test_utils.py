@@ -1,12 +1,115 @@
 import pytest
 
-from library.utils import get_hash_for_identifier, parse_xsd_date_value
+from library.utils import (
+    BoundedExecutor,
+    StagedBlockBlobWriter,
+    get_charset_for_bytes,
+    get_hash_for_identifier,
+    get_invalid_utf8_offset,
+    get_text_from_bytes,
+    get_utf8_bytes_from_blob,
+    parse_xsd_date_value,
+    raise_first_failure,
+    sniff_charset,
+)
 
 
 def test_get_hash_for_identifier_1():
     assert "9d989e8d27dc9e0ec3389fc855f142c3d40f0c50" == get_hash_for_identifier("cat")
 
 
+def test_get_text_from_bytes_utf8():
+    assert ("caf\u00e9", "utf-8") == get_text_from_bytes("caf\u00e9".encode("utf-8"), "hash", True)
+
+
+def test_get_text_from_bytes_detects_charset():
+    text = "<narrative>Coop\u00e9ration fran\u00e7aise au d\u00e9veloppement \u00e0 l'\u00e9tranger</narrative>" * 5
+    decoded, charset = get_text_from_bytes(text.encode("windows-1252"), "hash", True)
+    assert decoded == text
+    assert charset != "utf-8"
+
+
+def test_get_charset_for_bytes():
+    assert "utf-8" == get_charset_for_bytes("caf\u00e9".encode("utf-8"), "hash")
+    text = "<narrative>Coop\u00e9ration fran\u00e7aise au d\u00e9veloppement \u00e0 l'\u00e9tranger</narrative>" * 5
+    assert "utf-8" != get_charset_for_bytes(text.encode("windows-1252"), "hash")
+
+
+def test_get_invalid_utf8_offset():
+    assert get_invalid_utf8_offset("caf\u00e9 caf\u00e9".encode("utf-8"), chunk_size=3) is None
+    assert 3 == get_invalid_utf8_offset("caf\u00e9 caf\u00e9".encode("windows-1252"), chunk_size=3)
+
+
+def test_sniff_charset():
+    assert "utf-16" == sniff_charset("<iati-activities/>".encode("utf-16"))
+    assert "ISO-8859-1" == sniff_charset(b'<?xml version="1.0" encoding="ISO-8859-1"?>\n<iati-activities/>')
+    assert sniff_charset(b'<?xml version="1.0" encoding="not-a-charset"?>\n<iati-activities/>') is None
+    assert sniff_charset(b"<iati-activities/>") is None
+
+
+def test_get_text_from_bytes_uses_declaration():
+    text = '<?xml version="1.0" encoding="ISO-8859-1"?>\n<narrative>caf\u00e9</narrative>'
+    assert (text, "ISO-8859-1") == get_text_from_bytes(text.encode("iso-8859-1"), "hash", True)
+
+
+def test_get_utf8_bytes_from_blob_uses_cached_charset(mocker):
+    detect_charset = mocker.patch("library.utils.detect_charset")
+    downloader = mocker.Mock()
+    downloader.properties.metadata = {"charset": "windows-1252"}
+    downloader.content_as_bytes.return_value = "caf\u00e9".encode("windows-1252")
+
+    assert ("caf\u00e9".encode("utf-8"), "windows-1252") == get_utf8_bytes_from_blob(downloader, "hash")
+    detect_charset.assert_not_called()
+
+
+def test_get_utf8_bytes_from_blob(mocker):
+    downloader = mocker.Mock()
+    downloader.properties.metadata = {}
+    utf8_bytes = "caf\u00e9".encode("utf-8")
+    downloader.content_as_bytes.return_value = utf8_bytes
+
+    payload, charset = get_utf8_bytes_from_blob(downloader, "hash")
+    assert payload is utf8_bytes
+    assert charset == "utf-8"
+
+    downloader.properties.metadata = {"charset": "windows-1252"}
+    downloader.content_as_bytes.return_value = "caf\u00e9".encode("windows-1252")
+    assert (utf8_bytes, "windows-1252") == get_utf8_bytes_from_blob(downloader, "hash")
+
+
+def test_bounded_executor_raise_first_failure():
+    def task(value):
+        if value == 3:
+            raise ValueError("task failed")
+        return value
+
+    with BoundedExecutor(2, 2) as executor:
+        futures = [executor.submit(task, value) for value in range(5)]
+        with pytest.raises(ValueError):
+            raise_first_failure(futures, wait=True)
+
+    with BoundedExecutor(2, 2) as executor:
+        futures = [executor.submit(task, value) for value in range(3)]
+        raise_first_failure(futures, wait=True)
+        assert futures == []
+
+
+def test_staged_block_blob_writer(mocker):
+    blob_client = mocker.Mock()
+    writer = StagedBlockBlobWriter(blob_client, block_size=4)
+
+    writer.write(b"abc")
+    writer.write(b"defghij")
+    writer.commit(tags={"document_id": "id"})
+
+    staged = [call.args for call in blob_client.stage_block.call_args_list]
+    assert [data for _, data in staged] == [b"abcd", b"efgh", b"ij"]
+    block_ids = [block_id for block_id, _ in staged]
+    assert len(set(block_ids)) == 3 and len(set(len(block_id) for block_id in block_ids)) == 1
+    blob_client.commit_block_list.assert_called_once_with(block_ids, tags={"document_id": "id"})
+    assert writer.length == 10
+
+
 PARSE_XSD_DATE_VALUE = [
     # just nonsense
     ("cat", None),
@@ -0,0 +1,53 @@
+import json
+from datetime import datetime
+
+import library.db
+import library.validate as validate
+
+VALIDATOR_VERSION = {
+    "apiVersion": "2.3.0",
+    "rulesetCommitSha": "ruleset",
+    "codelistCommitSha": "codelist",
+    "orgIdPrefixFileName": "org-id.json",
+}
+
+
+def get_document(doc_id):
+    """A claimed document (see db.claimUnvalidatedDatasets), which hasn't been schema validated yet"""
+    return (
+        "hash",
+        datetime(2024, 1, 1),
+        doc_id,
+        "https://example.org/" + doc_id,
+        "pub",
+        "pub",
+        None,
+        None,
+        False,
+    )
+
+
+def test_process_hash_list_reuses_validations_made_by_the_version_from_an_earlier_run(mocker):
+    mocker.patch.dict(validate.validator_version, clear=True)
+    db = mocker.patch("library.validate.db")
+    db.getValidatorVersion.side_effect = library.db.getValidatorVersion
+    db.getCachedValidation.return_value = (7, True)
+    mocker.patch("library.validate.BlobServiceClient")
+    mocker.patch("library.validate.utils.get_utf8_bytes_from_blob", return_value=(b"<iati-activities/>", "UTF-8"))
+    mocker.patch("library.validate.utils.get_cached_charset", return_value="UTF-8")
+    session = mocker.patch("library.validate.requests_retry_session").return_value
+    session.request.side_effect = [
+        mocker.Mock(status_code=200, json=mocker.Mock(return_value={"valid": True})),
+        mocker.Mock(status_code=200, json=mocker.Mock(return_value={"valid": True, **VALIDATOR_VERSION})),
+    ]
+
+    validate.process_hash_list([get_document("first")])
+    validate.process_hash_list([get_document("second")])
+
+    assert session.request.call_count == 2
+    assert json.loads(db.updateValidationState.call_args.args[6])["apiVersion"] == "2.3.0"
+    # nothing is reused until the process has had a report, but then it is from the next run's first document
+    db.getCachedValidation.assert_called_once_with(db.getDirectConnection.return_value, "hash", VALIDATOR_VERSION)
+    db.reuseValidation.assert_called_once_with(
+        db.getDirectConnection.return_value, "second", "https://example.org/second", "pub", "pub", 7
+    )